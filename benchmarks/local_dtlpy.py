@@ -0,0 +1,617 @@
+"""
+Local in-memory stand-in for the parts of `dtlpy` used by the handlers, with a synthetic adapter.
+Every remote call sleeps `config.api_delay` and every binary transfer `config.io_delay`, so the
+handlers can be benchmarked without a Dataloop environment.
+
+    from benchmarks import local_dtlpy
+    local_dtlpy.install()   # before importing the handlers
+"""
+import io
+import os
+import json
+import math
+import sys
+import time
+import copy
+import types
+import uuid
+import hashlib
+import shutil
+import datetime
+import threading
+from enum import Enum
+
+import numpy as np
+from PIL import Image
+
+
+class SimulationConfig:
+    def __init__(self):
+        # seconds per platform API call
+        self.api_delay = 0.002
+        # seconds per item binary download
+        self.io_delay = 0.02
+        # fixed seconds per adapter forward call, and per item in the call
+        self.compute_per_call = 0.02
+        self.compute_per_item = 0.005
+        # seconds to build a model (codebase) and to load / save snapshot artifacts
+        self.build_delay = 0.2
+        self.load_delay = 0.5
+        self.save_delay = 0.2
+        # seconds per training epoch
+        self.epoch_delay = 0.05
+        # image side of the synthetic items
+        self.image_size = 256
+        # size of the synthetic weights file
+        self.weights_bytes = 4 * 1024 ** 2
+
+
+config = SimulationConfig()
+_lock = threading.Lock()
+_stats = {'api_calls': 0, 'downloads': 0, 'uploads': 0}
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+def _api_call():
+    with _lock:
+        _stats['api_calls'] += 1
+    time.sleep(config.api_delay)
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat(timespec='microseconds') + 'Z'
+
+
+def _new_id():
+    return uuid.uuid4().hex[:24]
+
+
+_image_bytes = dict()
+
+
+def _image(size):
+    if size not in _image_bytes:
+        buffer = io.BytesIO()
+        Image.fromarray(np.random.randint(0, 255, (size, size, 3), dtype=np.uint8)).save(buffer, format='JPEG')
+        _image_bytes[size] = buffer.getvalue()
+    return _image_bytes[size]
+
+
+###########
+# helpers #
+###########
+class exceptions:
+    class NotFound(Exception):
+        pass
+
+    class TokenExpired(Exception):
+        pass
+
+
+class SnapshotPartitionType(str, Enum):
+    TRAIN = 'train'
+    VALIDATION = 'validation'
+    TEST = 'test'
+
+
+class BucketType:
+    ITEM = 'item'
+    LOCAL = 'local'
+    GCS = 'gcs'
+
+
+class FiltersOperations:
+    IN = '$in'
+    EQUAL = '$eq'
+
+
+class Filters:
+    def __init__(self):
+        self.custom_filter = None
+        self.conditions = list()
+
+    def add(self, field, values, operator=None):
+        self.conditions.append((field, values, operator))
+
+    def sort_by(self, field, value='ascending'):
+        # items are always listed by id
+        pass
+
+    def match(self, item):
+        for field, values, operator in self.conditions:
+            value = item.field(field)
+            if operator == FiltersOperations.IN:
+                if value not in values:
+                    return False
+            elif value != values:
+                return False
+        return True
+
+
+class PagedEntities(list):
+    @property
+    def items_count(self):
+        return sum(len(page) for page in self)
+
+
+class BaseServiceRunner:
+    pass
+
+
+class Progress:
+    def update(self, progress=None, message=None, **kwargs):
+        pass
+
+
+class Context:
+    def __init__(self, execution_id=None):
+        self.execution_id = execution_id or _new_id()
+
+
+############
+# entities #
+############
+class _Annotations:
+    def __init__(self, item):
+        self.item = item
+        self.uploaded = list()
+
+    def upload(self, annotations):
+        _api_call()
+        with _lock:
+            _stats['uploads'] += 1
+        self.uploaded.extend(annotations)
+        self.item.updated_at = _now()
+        return annotations
+
+    def list(self):
+        return list(self.uploaded)
+
+
+class Item:
+    def __init__(self, dataset, filename, mimetype='image/jpeg', metadata=None):
+        self.id = _new_id()
+        self.dataset = dataset
+        self.filename = filename
+        self.name = os.path.basename(filename)
+        self.mimetype = mimetype
+        self.metadata = metadata if metadata is not None else {'system': dict()}
+        self.created_at = self.updated_at = _now()
+        self.annotations = _Annotations(item=self)
+
+    def field(self, path):
+        if path == 'id':
+            return self.id
+        value = {'metadata': self.metadata, 'filename': self.filename}
+        for key in path.split('.'):
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    def download(self, save_locally=True, local_path=None, to_array=False, **kwargs):
+        with _lock:
+            _stats['downloads'] += 1
+        time.sleep(config.io_delay)
+        data = _image(config.image_size)
+        if to_array:
+            with Image.open(io.BytesIO(data)) as image:
+                return np.asarray(image.convert('RGB'))
+        if not save_locally:
+            return io.BytesIO(data)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, 'wb') as f:
+            f.write(data)
+        return local_path
+
+    def clone(self, dst_dataset_id, remote_filepath=None, with_annotations=True, with_metadata=True, **kwargs):
+        _api_call()
+        dst = datasets.get(dataset_id=dst_dataset_id)
+        metadata = {'system': dict(self.metadata.get('system', dict()))} if with_metadata else None
+        item = Item(dataset=dst, filename=remote_filepath or self.filename, mimetype=self.mimetype, metadata=metadata)
+        dst._items[item.id] = item
+        return item
+
+
+class _Items:
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def list(self, filters=None, page_size=100):
+        _api_call()
+        items = [item for item in self.dataset._items.values() if filters is None or filters.match(item)]
+        items.sort(key=lambda item: item.id)
+        return PagedEntities(items[i:i + page_size] for i in range(0, len(items), page_size))
+
+    def get(self, item_id):
+        _api_call()
+        return self.dataset._items[item_id]
+
+    def delete(self, filters):
+        _api_call()
+        for item in [item for item in self.dataset._items.values() if filters.match(item)]:
+            self.dataset._items.pop(item.id)
+
+
+class Dataset:
+    def __init__(self, project, name):
+        self.id = _new_id()
+        self.name = name
+        self.project = project
+        self.metadata = dict()
+        self._items = dict()
+        self.items = _Items(dataset=self)
+
+    def add_items(self, n_items, mimetype='image/jpeg'):
+        for i_item in range(n_items):
+            filename = '/img_{:06d}.jpg'.format(i_item)
+            md5 = hashlib.md5('{}{}'.format(self.id, filename).encode()).hexdigest()
+            item = Item(dataset=self, filename=filename, mimetype=mimetype, metadata={'system': {'md5': md5}})
+            self._items[item.id] = item
+        return self
+
+    def clone(self, clone_name, filters=None, **kwargs):
+        _api_call()
+        cloned = Dataset(project=self.project, name=clone_name)
+        _datasets[cloned.id] = cloned
+        for item in self._items.values():
+            if filters is None or filters.match(item):
+                new_item = Item(dataset=cloned, filename=item.filename, mimetype=item.mimetype,
+                                metadata={'system': dict(item.metadata.get('system', dict()))})
+                cloned._items[new_item.id] = new_item
+        return cloned
+
+    def set_partition(self, partition, filters=None):
+        _api_call()
+        for item in self._items.values():
+            if filters is None or filters.match(item):
+                # stored as the enum's value, like the platform
+                item.metadata.setdefault('system', dict())['snapshotPartition'] = getattr(partition, 'value', partition)
+
+    def update(self, system_metadata=False):
+        _api_call()
+        return self
+
+
+class Bucket:
+    def __init__(self):
+        self.id = _new_id()
+        self.files = dict()
+
+
+class Snapshot:
+    def __init__(self, model, name, dataset_id=None, configuration=None, bucket=None, project_id=None):
+        self.id = _new_id()
+        self.name = name
+        self.model_id = model.id
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.configuration = configuration if configuration is not None else dict()
+        self.bucket = bucket if bucket is not None else Bucket()
+        self.bucket.files.setdefault('weights.bin', b'\0' * config.weights_bytes)
+        self.metadata = {'system': dict()}
+        self.status = 'created'
+        self.created_at = self.updated_at = _now()
+
+    @property
+    def model(self):
+        _api_call()
+        return _models[self.model_id]
+
+    @property
+    def dataset(self):
+        return datasets.get(dataset_id=self.dataset_id)
+
+    def update(self):
+        _api_call()
+        self.updated_at = _now()
+        return self
+
+    def print(self, to_return=False):
+        return '{} ({})'.format(self.name, self.id)
+
+    def clone(self, snapshot_name, configuration=None, bucket=None, project_id=None, dataset_id=None):
+        _api_call()
+        merged = dict(self.configuration)
+        merged.update(configuration or dict())
+        if bucket is not None:
+            bucket.files.update(self.bucket.files)
+        cloned = Snapshot(model=_models[self.model_id], name=snapshot_name, dataset_id=dataset_id or self.dataset_id,
+                          configuration=merged, bucket=bucket, project_id=project_id)
+        # like the platform, the clone is created from the source's json, metadata included
+        cloned.metadata = copy.deepcopy(self.metadata)
+        _snapshots[cloned.id] = cloned
+        return cloned
+
+
+class _Snapshots:
+    def __init__(self, model=None):
+        self.model = model
+
+    def get(self, snapshot_id=None, snapshot_name=None):
+        _api_call()
+        for snapshot in _snapshots.values():
+            if snapshot.id == snapshot_id or (snapshot_id is None and snapshot.name == snapshot_name):
+                return snapshot
+        raise exceptions.NotFound('snapshot not found')
+
+    def create(self, snapshot_name, dataset_id=None, configuration=None, **kwargs):
+        snapshot = Snapshot(model=self.model, name=snapshot_name, dataset_id=dataset_id, configuration=configuration)
+        _snapshots[snapshot.id] = snapshot
+        return snapshot
+
+
+class Model:
+    def __init__(self, name, input_type='image'):
+        self.id = _new_id()
+        self.name = name
+        self.input_type = input_type
+        self.snapshots = _Snapshots(model=self)
+
+    def to_json(self):
+        return {'id': self.id, 'name': self.name, 'inputType': self.input_type, 'codebase': None}
+
+    @classmethod
+    def from_json(cls, _json, client_api=None, project=None):
+        model = cls(name=_json['name'], input_type=_json['inputType'])
+        model.id = _json['id']
+        return model
+
+    def build(self, local_path=None, from_local=None):
+        if not from_local:
+            # codebase fetch
+            _api_call()
+            time.sleep(config.build_delay)
+            if local_path is not None:
+                os.makedirs(local_path, exist_ok=True)
+        return SyntheticAdapter(model_entity=self)
+
+
+class _Models:
+    def __init__(self, project=None):
+        self.project = project
+
+    def get(self, model_name=None, model_id=None):
+        _api_call()
+        for model in _models.values():
+            if model.id == model_id or (model_id is None and model.name == model_name):
+                return model
+        raise exceptions.NotFound('model not found')
+
+    def create(self, model_name, input_type='image', **kwargs):
+        model = Model(name=model_name, input_type=input_type)
+        _models[model.id] = model
+        return model
+
+
+class _Buckets:
+    def create(self, **kwargs):
+        _api_call()
+        return Bucket()
+
+
+class Project:
+    def __init__(self, name):
+        self.id = _new_id()
+        self.name = name
+        self.org = {'id': _new_id()}
+        self.models = _Models(project=self)
+        self.buckets = _Buckets()
+        self.datasets = _Datasets(project=self)
+        self.snapshots = _Snapshots()
+
+
+class _Projects:
+    def get(self, project_name=None, project_id=None):
+        _api_call()
+        for project in _projects.values():
+            if project.id == project_id or (project_id is None and project.name == project_name):
+                return project
+        raise exceptions.NotFound('project not found')
+
+    def create(self, project_name):
+        project = Project(name=project_name)
+        _projects[project.id] = project
+        return project
+
+
+class _Datasets:
+    def __init__(self, project=None):
+        self.project = project
+
+    def get(self, dataset_id=None, dataset_name=None):
+        _api_call()
+        for dataset in _datasets.values():
+            if dataset.id == dataset_id or (dataset_id is None and dataset.name == dataset_name):
+                return dataset
+        raise exceptions.NotFound('dataset not found')
+
+    def create(self, dataset_name):
+        dataset = Dataset(project=self.project, name=dataset_name)
+        _datasets[dataset.id] = dataset
+        return dataset
+
+
+class _ItemsRepo:
+    def get(self, item_id):
+        _api_call()
+        for dataset in _datasets.values():
+            if item_id in dataset._items:
+                return dataset._items[item_id]
+        raise exceptions.NotFound('item not found')
+
+
+#####################
+# synthetic adapter #
+#####################
+class SyntheticAdapter:
+    """
+    Adapter with configurable compute and I/O delays. The forward pass cost is
+    `compute_per_call + compute_per_item * batch size`, so batching pays off like on a real model.
+    Forward passes of an adapter run one at a time, like on a single device
+    """
+
+    def __init__(self, model_entity):
+        self.model_entity = model_entity
+        self.model_name = model_entity.name
+        self.snapshot = None
+        self.weights = None
+        self._device = threading.Lock()
+
+    @property
+    def configuration(self):
+        return self.snapshot.configuration if self.snapshot is not None else dict()
+
+    def load(self, local_path, **kwargs):
+        time.sleep(config.load_delay)
+        with open(os.path.join(local_path, 'weights.bin'), 'rb') as f:
+            self.weights = f.read()
+
+    def get_weights_arrays(self):
+        return {'weights': np.frombuffer(self.weights, dtype=np.uint8)}
+
+    def load_from_arrays(self, arrays, local_path=None, **kwargs):
+        # the mapped weights are used in place, not read into the process
+        self.weights = arrays['weights']
+
+    def load_from_snapshot(self, snapshot, local_path=None, **kwargs):
+        self.snapshot = snapshot
+        if local_path is None:
+            local_path = os.path.join('tmp', 'snapshots', snapshot.id)
+        os.makedirs(local_path, exist_ok=True)
+        for filename, data in snapshot.bucket.files.items():
+            time.sleep(config.io_delay)
+            with open(os.path.join(local_path, filename), 'wb') as f:
+                f.write(data)
+        self.load(local_path=local_path)
+
+    def save_to_snapshot(self, local_path, replace=True, **kwargs):
+        time.sleep(config.save_delay)
+        for dirpath, _, filenames in os.walk(local_path):
+            for filename in filenames:
+                with open(os.path.join(dirpath, filename), 'rb') as f:
+                    self.snapshot.bucket.files[os.path.relpath(os.path.join(dirpath, filename), local_path)] = f.read()
+        self.snapshot.update()
+
+    def predict(self, batch, **kwargs):
+        with self._device:
+            time.sleep(config.compute_per_call + config.compute_per_item * len(batch))
+        return [[{'type': 'box', 'label': 'synthetic', 'coordinates': [0, 0, 10, 10]}] for _ in batch]
+
+    def predict_items(self, items, with_upload=True, **kwargs):
+        batch = [item.download(save_locally=False, to_array=True) for item in items]
+        predictions = self.predict(batch)
+        if with_upload:
+            for item, prediction in zip(items, predictions):
+                item.annotations.upload(prediction)
+        return predictions
+
+    def prepare_training(self, root_path, data_path=None, output_path=None, **kwargs):
+        if data_path is None:
+            data_path = os.path.join(root_path, 'data')
+        if output_path is None:
+            output_path = os.path.join(root_path, 'output')
+        os.makedirs(output_path, exist_ok=True)
+        dataset = self.snapshot.dataset
+        for item in dataset._items.values():
+            partition = item.metadata.get('system', dict()).get('snapshotPartition')
+            if partition is None:
+                continue
+            local_path = os.path.join(data_path, partition, 'items', item.filename.lstrip('/'))
+            # like the platform's download, existing files are skipped
+            if not os.path.isfile(local_path):
+                item.download(local_path=local_path)
+            json_path = os.path.join(data_path, partition, 'json',
+                                     '{}.json'.format(os.path.splitext(item.filename.lstrip('/'))[0]))
+            if not os.path.isfile(json_path):
+                _api_call()
+                os.makedirs(os.path.dirname(json_path), exist_ok=True)
+                with open(json_path, 'w') as f:
+                    json.dump({'filename': item.filename, 'annotations': len(item.annotations.list())}, f)
+        return root_path, data_path, output_path
+
+    def train(self, data_path, output_path, on_epoch_end=None, on_epoch_end_callback=None, **kwargs):
+        n_epoch = int(self.configuration.get('num_epochs', 3))
+        for i_epoch in range(int(self.configuration.get('start_epoch', 0)), n_epoch):
+            time.sleep(config.epoch_delay)
+            with open(os.path.join(output_path, 'weights.bin'), 'wb') as f:
+                f.write(self.weights or b'')
+            if on_epoch_end is not None:
+                on_epoch_end(i_epoch + 1, n_epoch)
+            if on_epoch_end_callback is not None:
+                on_epoch_end_callback(i_epoch, n_epoch, metrics=self.epoch_metrics(i_epoch))
+
+    def epoch_metrics(self, i_epoch):
+        """
+            Synthetic validation loss: decreases with the epochs, lowest for a learning rate of 1e-3
+        """
+        learning_rate = float(self.configuration.get('learning_rate', 1e-3))
+        return {'val_loss': abs(math.log10(learning_rate) + 3) + 1 / (i_epoch + 1)}
+
+
+##########
+# stores #
+##########
+_projects = dict()
+_models = dict()
+_snapshots = dict()
+_datasets = dict()
+
+projects = _Projects()
+models = _Models()
+snapshots = _Snapshots()
+datasets = _Datasets()
+items = _ItemsRepo()
+client_api = None
+
+
+def prepare_dataset(dataset, partitions=None, filters=None, **kwargs):
+    cloned = dataset.clone(clone_name='{}-{}'.format(dataset.name, _new_id()[:6]), filters=filters)
+    if partitions is None:
+        partitions = {SnapshotPartitionType.TRAIN: 0.8, SnapshotPartitionType.VALIDATION: 0.2}
+    cloned_items = list(cloned._items.values())
+    np.random.shuffle(cloned_items)
+    start = 0
+    for partition, ratio in partitions.items():
+        end = start + int(round(ratio * len(cloned_items)))
+        for item in cloned_items[start:end]:
+            item.metadata.setdefault('system', dict())['snapshotPartition'] = getattr(partition, 'value', partition)
+        start = end
+    return cloned
+
+
+def setenv(env):
+    pass
+
+
+def reset():
+    for store in [_projects, _models, _snapshots, _datasets]:
+        store.clear()
+    reset_stats()
+    shutil.rmtree('tmp', ignore_errors=True)
+
+
+def install():
+    """
+        Register this module as `dtlpy` (with dtlpy.ml.train_utils) in sys.modules
+    """
+    module = sys.modules[__name__]
+    ml = types.ModuleType('dtlpy.ml')
+    train_utils = types.ModuleType('dtlpy.ml.train_utils')
+    train_utils.prepare_dataset = prepare_dataset
+    ml.train_utils = train_utils
+    module.ml = ml
+    sys.modules['dtlpy'] = module
+    sys.modules['dtlpy.ml'] = ml
+    sys.modules['dtlpy.ml.train_utils'] = train_utils
+    return module
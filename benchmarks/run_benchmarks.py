@@ -0,0 +1,264 @@
+"""
+Offline benchmarks of the predict and train handlers, run against the local dtlpy stand-in.
+
+    python -m benchmarks.run_benchmarks --output bench.json
+    python -m benchmarks.run_benchmarks --output new.json --baseline bench.json
+
+Reports cold start time, p50/p95/p99 latency, items/sec and peak RSS for single, batched and concurrent
+predictions and for clone-and-train. Exits with 1 if a throughput regressed more than `--tolerance`
+compared to the baseline.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks import local_dtlpy
+
+dl = local_dtlpy.install()
+
+WORK_DIR = tempfile.mkdtemp(prefix='model-mgmt-bench-')
+# the caches roots are read on import
+os.environ['MODEL_MGMT_CACHE_ROOT'] = os.path.join(WORK_DIR, 'artifacts')
+os.environ['MODEL_MGMT_DATA_CACHE_ROOT'] = os.path.join(WORK_DIR, 'training_data')
+
+from handlers.adapter_cache import adapter_cache, cache_key  # noqa: E402
+from handlers.entities import entities  # noqa: E402
+from handlers import model_mgmt_utils_predict, model_mgmt_utils_train  # noqa: E402
+
+
+def peak_rss_mb():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def latency_stats(latencies, elapsed):
+    latencies = np.asarray(latencies)
+    return {'count': int(latencies.size),
+            'p50_ms': float(np.percentile(latencies, 50) * 1000),
+            'p95_ms': float(np.percentile(latencies, 95) * 1000),
+            'p99_ms': float(np.percentile(latencies, 99) * 1000),
+            'items_per_second': float(latencies.size / elapsed) if elapsed > 0 else None,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+class World:
+    """
+    Local project with a model, a pretrained snapshot and a dataset of synthetic items
+    """
+
+    def __init__(self, n_items):
+        local_dtlpy.reset()
+        self.project = dl.projects.create(project_name='bench-project')
+        self.model = self.project.models.create(model_name='bench-model')
+        self.dataset = self.project.datasets.create(dataset_name='bench-dataset').add_items(n_items)
+        self.snapshot = self.model.snapshots.create(snapshot_name='bench-pretrained',
+                                                    dataset_id=self.dataset.id,
+                                                    configuration={'num_epochs': 3})
+        self.items = [item for page in self.dataset.items.list() for item in page]
+
+    def runner(self, **kwargs):
+        return model_mgmt_utils_predict.ServiceRunner(project_id=self.project.id,
+                                                      model_id=self.model.id,
+                                                      snapshot_id=self.snapshot.id,
+                                                      **kwargs)
+
+    def forget_adapter(self, disk=False):
+        # like a new process
+        entities.invalidate()
+        adapter_cache.pop(model_id=self.model.id, snapshot=self.snapshot)
+        if disk:
+            adapter_cache.disk_cache.remove(cache_key(model_id=self.model.id, snapshot=self.snapshot))
+
+
+def bench_cold_start(world, repeats=3):
+    results = dict()
+    for name, disk in [('cold', True), ('warm_disk', False)]:
+        timings = list()
+        for _ in range(repeats):
+            world.forget_adapter(disk=disk)
+            tic = time.perf_counter()
+            world.runner()
+            timings.append(time.perf_counter() - tic)
+        results[name] = latency_stats(timings, elapsed=sum(timings))
+    timings = list()
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        world.runner()
+        timings.append(time.perf_counter() - tic)
+    results['warm_memory'] = latency_stats(timings, elapsed=sum(timings))
+    # the first mmap load exports the layout
+    world.forget_adapter()
+    world.runner(load_mode='mmap')
+    timings = list()
+    for _ in range(repeats):
+        world.forget_adapter()
+        tic = time.perf_counter()
+        world.runner(load_mode='mmap')
+        timings.append(time.perf_counter() - tic)
+    results['warm_disk_mmap'] = latency_stats(timings, elapsed=sum(timings))
+    return results
+
+
+def bench_single(world, n_items, **runner_kwargs):
+    runner = world.runner(**runner_kwargs)
+    latencies = list()
+    start = time.perf_counter()
+    for item in world.items[:n_items]:
+        tic = time.perf_counter()
+        runner.predict_item(item=item, with_upload=True)
+        latencies.append(time.perf_counter() - tic)
+    return latency_stats(latencies, elapsed=time.perf_counter() - start)
+
+
+def bench_batched(world, batch_sizes, **runner_kwargs):
+    runner = world.runner(**runner_kwargs)
+    results = dict()
+    for batch_size in batch_sizes:
+        tic = time.perf_counter()
+        report = runner.predict_dataset(dataset=world.dataset, batch_size=batch_size, with_upload=True)
+        elapsed = time.perf_counter() - tic
+        results['batch_{}'.format(batch_size)] = {'items': report['success'],
+                                                  'failed': report['failed'],
+                                                  'elapsed_s': elapsed,
+                                                  'items_per_second': report['success'] / elapsed,
+                                                  'peak_rss_mb': peak_rss_mb()}
+    return results
+
+
+def bench_concurrent(world, n_items, concurrency, **runner_kwargs):
+    runner = world.runner(**runner_kwargs)
+
+    def predict(item):
+        tic = time.perf_counter()
+        runner.predict_item(item=item, with_upload=True)
+        return time.perf_counter() - tic
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(predict, world.items[:n_items]))
+    return latency_stats(latencies, elapsed=time.perf_counter() - start)
+
+
+def bench_clone_and_train(world, repeats=2):
+    runner = model_mgmt_utils_train.ServiceRunner()
+    results = dict()
+    for i_run in range(repeats):
+        local_dtlpy.reset_stats()
+        tic = time.perf_counter()
+        runner.train_from_dataset(from_snapshot=world.snapshot,
+                                  dataset=world.dataset,
+                                  snapshot_name='bench-train-{}'.format(i_run))
+        results['run_{}'.format(i_run)] = {'elapsed_s': time.perf_counter() - tic,
+                                           'downloads': local_dtlpy.stats()['downloads'],
+                                           'api_calls': local_dtlpy.stats()['api_calls'],
+                                           'peak_rss_mb': peak_rss_mb()}
+    return results
+
+
+def bench_sweep(world, max_workers=4):
+    runner = model_mgmt_utils_train.ServiceRunner()
+    local_dtlpy.reset_stats()
+    tic = time.perf_counter()
+    ranked = runner.train_sweep(from_snapshot=world.snapshot,
+                                dataset=world.dataset,
+                                search_space={'learning_rate': [1e-4, 1e-3, 1e-2, 1e-1],
+                                              'num_epochs': [4]},
+                                max_workers=max_workers,
+                                snapshot_name='bench-sweep')
+    return {'elapsed_s': time.perf_counter() - tic,
+            'trials': len(ranked),
+            'pruned': sum(trial['status'] == 'pruned' for trial in ranked),
+            'best': ranked[0]['configuration'],
+            'downloads': local_dtlpy.stats()['downloads'],
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def run(args):
+    world = World(n_items=args.items)
+    results = {'config': dict(vars(local_dtlpy.config), items=args.items, concurrency=args.concurrency),
+               'cold_start': bench_cold_start(world)}
+    results['single'] = bench_single(world, n_items=min(args.items, 50))
+    results['single_prefetch'] = bench_single(world, n_items=min(args.items, 50), prefetch_depth=1)
+    results['batched'] = bench_batched(world, batch_sizes=args.batch_sizes)
+    results['batched_prefetch'] = bench_batched(world, batch_sizes=args.batch_sizes,
+                                                prefetch_depth=32, download_workers=8)
+    results['concurrent'] = bench_concurrent(world, n_items=args.items, concurrency=args.concurrency)
+    results['concurrent_micro_batching'] = bench_concurrent(world, n_items=args.items,
+                                                            concurrency=args.concurrency,
+                                                            max_batch_size=args.concurrency,
+                                                            max_wait_ms=5)
+    results['clone_and_train'] = bench_clone_and_train(world)
+    results['sweep'] = bench_sweep(world)
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def throughputs(results, prefix=''):
+    """
+        flat {path: items_per_second} of all the scenarios
+    """
+    flat = dict()
+    for key, value in results.items():
+        if isinstance(value, dict):
+            if value.get('items_per_second') is not None:
+                flat[prefix + key] = value['items_per_second']
+            flat.update(throughputs(value, prefix='{}{}.'.format(prefix, key)))
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    regressions = list()
+    current = throughputs(results)
+    for key, value in throughputs(baseline).items():
+        if key in current and current[key] < value * (1 - tolerance):
+            regressions.append({'scenario': key, 'baseline': value, 'current': current[key]})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the model management handlers')
+    parser.add_argument('--output', default='bench_output.json', help='results json path')
+    parser.add_argument('--baseline', default=None, help='previous results json to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed throughput drop (fraction)')
+    parser.add_argument('--items', type=int, default=200, help='number of items in the dataset')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent predict_item calls')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--io-delay', type=float, default=local_dtlpy.config.io_delay)
+    parser.add_argument('--compute-per-item', type=float, default=local_dtlpy.config.compute_per_item)
+    parser.add_argument('--compute-per-call', type=float, default=local_dtlpy.config.compute_per_call)
+    args = parser.parse_args()
+    local_dtlpy.config.io_delay = args.io_delay
+    local_dtlpy.config.compute_per_item = args.compute_per_item
+    local_dtlpy.config.compute_per_call = args.compute_per_call
+
+    output = os.path.abspath(args.output)
+    cwd = os.getcwd()
+    os.chdir(WORK_DIR)
+    try:
+        results = run(args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    exit_code = 0
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            results['regressions'] = compare(results=results, baseline=json.load(f), tolerance=args.tolerance)
+        if results['regressions']:
+            exit_code = 1
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,23 @@
 import os
+import json
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 import dtlpy as dl
 
+from handlers.metrics import Metrics
+
 project_name = 'Model Management App'
-dl.setenv('rc')
-project = dl.projects.get(project_name=project_name)
 package_name = 'model-mgmt-app'
+# last pushed manifest and deployed services, per package
+DEFAULT_STATE_FILE = '.package_state.json'
+# not part of the package's code
+MANIFEST_EXCLUDED_DIRS = {'.git', '__pycache__', '.pytest_cache', '.mypy_cache', '.ruff_cache', '.tox', '.nox',
+                          '.venv', 'venv'}
+MANIFEST_EXCLUDED_SUFFIXES = ('.pyc', '.pyo')
+MANIFEST_EXCLUDED_FILES = {DEFAULT_STATE_FILE, 'requests.jsonl', 'bench_output.json'}
 
 ###########
 # Modules #
@@ -23,9 +35,44 @@ module_train = dl.PackageModule(
             inputs=[
                 dl.FunctionIO(type=dl.PackageInputType.SNAPSHOT, name='snapshot'),
                 dl.FunctionIO(type=dl.PackageInputType.JSON, name='cleanup'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='use_data_cache'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='checkpoint_every_epochs'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='checkpoint_every_minutes'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='chunked_upload'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='metrics'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='metrics_path'),
             ],
             outputs=[dl.FunctionIO(type=dl.PackageInputType.SNAPSHOT, name='snapshot')]
         ),
+        dl.PackageFunction(
+            name='export_onnx',
+            display_name='export-onnx-{}'.format(package_name),
+            description="export the snapshot to an onnx artifact for the predict service's onnx load mode",
+            inputs=[
+                dl.FunctionIO(type=dl.PackageInputType.SNAPSHOT, name='snapshot'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='quantize'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='batch_size'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='intra_op_threads'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='tolerance'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='quantized_tolerance'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='force'),
+            ],
+            outputs=[dl.FunctionIO(type=dl.PackageInputType.JSON, name='report')]
+        ),
+        dl.PackageFunction(
+            name='evaluate_snapshot',
+            display_name='evaluate-snapshot-{}'.format(package_name),
+            description="score the snapshot on a partition of its dataset, the summary is stored in its metadata",
+            inputs=[
+                dl.FunctionIO(type=dl.PackageInputType.SNAPSHOT, name='snapshot'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='partition'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='batch_size'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='iou_thresholds'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='score_threshold'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='download_workers'),
+            ],
+            outputs=[dl.FunctionIO(type=dl.PackageInputType.JSON, name='summary')]
+        ),
         dl.PackageFunction(
             name='train_from_dataset',
             display_name='train-on-dataset-{}'.format(package_name),
@@ -36,8 +83,33 @@ module_train = dl.PackageModule(
                 dl.FunctionIO(type=dl.PackageInputType.SNAPSHOT, name='from_snapshot'),
                 dl.FunctionIO(type=dl.PackageInputType.JSON, name='snapshot_name'),
                 dl.FunctionIO(type=dl.PackageInputType.JSON, name='configuration'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='partitions'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='incremental'),
             ], outputs=[dl.FunctionIO(type=dl.PackageInputType.JSON, name='snapshot_id')]
         ),
+        dl.PackageFunction(
+            name='train_sweep',
+            display_name='train-sweep-{}'.format(package_name),
+            description="hyperparameter sweep: train a snapshot per configuration on a raw dataset",
+            inputs=[
+                dl.FunctionIO(type=dl.PackageInputType.DATASET, name='dataset'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='filters'),
+                dl.FunctionIO(type=dl.PackageInputType.SNAPSHOT, name='from_snapshot'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='search_space'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='search'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='n_trials'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='max_workers'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='metric'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='mode'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='early_stopping'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='grace_epochs'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='snapshot_name'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='configuration'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='partitions'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='incremental'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='seed'),
+            ], outputs=[dl.FunctionIO(type=dl.PackageInputType.JSON, name='trials')]
+        ),
         dl.PackageFunction(
             name='clone_snapshot_from_dataset',
             display_name='clone-from-dataset-{}'.format(package_name),
@@ -48,6 +120,8 @@ module_train = dl.PackageModule(
                 dl.FunctionIO(type=dl.PackageInputType.SNAPSHOT, name='from_snapshot'),
                 dl.FunctionIO(type=dl.PackageInputType.JSON, name='snapshot_name'),
                 dl.FunctionIO(type=dl.PackageInputType.JSON, name='configuration'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='partitions'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='incremental'),
             ], outputs=[dl.FunctionIO(type=dl.PackageInputType.JSON, name='snapshot_id')]
         )
     ])
@@ -63,6 +137,24 @@ module_predict = dl.PackageModule(
         dl.FunctionIO(type="Json", name='model_id'),
         dl.FunctionIO(type="Json", name='snapshot_name'),
         dl.FunctionIO(type="Json", name='snapshot_id'),
+        dl.FunctionIO(type="Json", name='max_batch_size'),
+        dl.FunctionIO(type="Json", name='max_wait_ms'),
+        dl.FunctionIO(type="Json", name='max_resident_adapters'),
+        dl.FunctionIO(type="Json", name='max_resident_memory_mb'),
+        dl.FunctionIO(type="Json", name='prefetch_depth'),
+        dl.FunctionIO(type="Json", name='download_workers'),
+        dl.FunctionIO(type="Json", name='upload_workers'),
+        dl.FunctionIO(type="Json", name='metrics'),
+        dl.FunctionIO(type="Json", name='metrics_path'),
+        dl.FunctionIO(type="Json", name='warmup'),
+        dl.FunctionIO(type="Json", name='warmup_iterations'),
+        dl.FunctionIO(type="Json", name='prediction_cache'),
+        dl.FunctionIO(type="Json", name='prediction_cache_max_size_mb'),
+        dl.FunctionIO(type="Json", name='load_mode'),
+        dl.FunctionIO(type="Json", name='onnx_intra_op_threads'),
+        dl.FunctionIO(type="Json", name='worker_processes'),
+        dl.FunctionIO(type="Json", name='worker_dispatch'),
+        dl.FunctionIO(type="Json", name='postprocess'),
     ],
     functions=[
         dl.PackageFunction(
@@ -73,9 +165,91 @@ module_predict = dl.PackageModule(
                 dl.FunctionIO(type=dl.PackageInputType.ITEM, name='item'),
                 dl.FunctionIO(type=dl.PackageInputType.JSON, name='with_upload'),
                 dl.FunctionIO(type=dl.PackageInputType.JSON, name='with_return'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='snapshot_id'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='wait_for_upload'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='output_format'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='video_options'),
             ],
             outputs=[dl.FunctionIO(type=dl.PackageInputType.ITEM, name='item')],
-        )
+        ),
+        dl.PackageFunction(
+            name='predict_video_item',
+            display_name='predict-video-item-{}'.format(package_name),
+            description='predict the frames of a video item with an image model, streaming the video',
+            inputs=[
+                dl.FunctionIO(type=dl.PackageInputType.ITEM, name='item'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='stride'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='fps'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='batch_size'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='skip_duplicates'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='duplicate_threshold'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='with_upload'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='snapshot_id'),
+            ],
+            outputs=[dl.FunctionIO(type=dl.PackageInputType.JSON, name='report')],
+        ),
+        dl.PackageFunction(
+            name='predict_items',
+            display_name='predict-items-{}'.format(package_name),
+            description='predict a list of items in batches with the object adapter',
+            inputs=[
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='items'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='batch_size'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='with_upload'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='with_return'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='snapshot_id'),
+            ],
+            outputs=[dl.FunctionIO(type=dl.PackageInputType.JSON, name='report')],
+        ),
+        dl.PackageFunction(
+            name='predict_dataset',
+            display_name='predict-dataset-{}'.format(package_name),
+            description='predict all the (filtered) items of a dataset in batches with the object adapter',
+            inputs=[
+                dl.FunctionIO(type=dl.PackageInputType.DATASET, name='dataset'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='filters'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='batch_size'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='with_upload'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='snapshot_id'),
+            ],
+            outputs=[dl.FunctionIO(type=dl.PackageInputType.JSON, name='report')],
+        ),
+        dl.PackageFunction(
+            name='predict_dataset_sharded',
+            display_name='predict-dataset-sharded-{}'.format(package_name),
+            description='predict a dataset query as shards fanned out to the service replicas, resumable by run id',
+            inputs=[
+                dl.FunctionIO(type=dl.PackageInputType.DATASET, name='dataset'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='num_shards'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='shard_by'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='filters'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='batch_size'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='with_upload'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='snapshot_id'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='run_id'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='max_parallel'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='max_attempts'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='shard_timeout_s'),
+            ],
+            outputs=[dl.FunctionIO(type=dl.PackageInputType.JSON, name='report')],
+        ),
+        dl.PackageFunction(
+            name='predict_shard',
+            display_name='predict-shard-{}'.format(package_name),
+            description='predict one shard of a dataset query, run by predict_dataset_sharded',
+            inputs=[
+                dl.FunctionIO(type=dl.PackageInputType.DATASET, name='dataset'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='shard'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='num_shards'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='shard_by'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='filters'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='page_size'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='batch_size'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='with_upload'),
+                dl.FunctionIO(type=dl.PackageInputType.JSON, name='snapshot_id'),
+            ],
+            outputs=[dl.FunctionIO(type=dl.PackageInputType.JSON, name='report')],
+        ),
     ])
 
 #########
@@ -108,50 +282,272 @@ slots = [
     ),
 ]
 
+
+############
+# Services #
+############
+def service_definitions(predict_init_input=None):
+    """
+        service name -> deploy arguments. The replicas are rolled on update: the old ones keep serving until
+        the new ones are ready (initialized and warmed up), and at least one replica is always up
+    """
+    return {
+        package_name + '-train': dict(
+            module_name=package_name + '-train',
+            init_input={},
+            runtime=dl.KubernetesRuntime(
+                pod_type=dl.InstanceCatalog.REGULAR_S,
+                runner_image='gcr.io/viewo-g/piper/agent/cpu/roberto_utils:2',
+                concurrency=1,
+                autoscaler=dl.KubernetesRabbitmqAutoscaler(min_replicas=1)
+            ),
+        ),
+        package_name + '-predict': dict(
+            module_name=package_name + '-predict',
+            init_input=predict_init_input,
+            runtime=dl.KubernetesRuntime(
+                pod_type=dl.InstanceCatalog.REGULAR_S,
+                concurrency=1,
+                # predict_dataset_sharded holds one execution while its shards run in the others
+                autoscaler=dl.KubernetesRabbitmqAutoscaler(min_replicas=1, max_replicas=2)
+            ),
+        ),
+    }
+
+
+############
+# Manifest #
+############
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _file_sha256(filepath, chunk_size=2 ** 20):
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def source_files(src_path):
+    """
+        relative path -> sha256 of the package's source files
+    """
+    files = dict()
+    for root, dirs, filenames in os.walk(src_path):
+        dirs[:] = sorted(d for d in dirs if d not in MANIFEST_EXCLUDED_DIRS)
+        for filename in filenames:
+            if filename.endswith(MANIFEST_EXCLUDED_SUFFIXES) or filename in MANIFEST_EXCLUDED_FILES:
+                continue
+            filepath = os.path.join(root, filename)
+            files[os.path.relpath(filepath, src_path).replace(os.sep, '/')] = _file_sha256(filepath)
+    return files
+
+
+def git_commit(git_url, git_tag):
+    """
+        The commit the branch / tag of a remote repository points to, as the platform will check it out
+    """
+    if len(git_tag) == 40 and all(c in '0123456789abcdef' for c in git_tag.lower()):
+        return git_tag.lower()
+    # an annotated tag is listed twice, its peeled ref ('^{}') is the commit
+    output = subprocess.run(['git', 'ls-remote', git_url, git_tag, '{}^{{}}'.format(git_tag)],
+                            capture_output=True, text=True, check=True, timeout=60).stdout
+    refs = dict(reversed(line.split('\t', 1)) for line in output.splitlines() if '\t' in line)
+    peeled = [sha for ref, sha in refs.items() if ref.endswith('^{}')]
+    if peeled:
+        return peeled[0]
+    for prefix in ['refs/heads/', 'refs/tags/', '']:
+        if prefix + git_tag in refs:
+            return refs[prefix + git_tag]
+    raise ValueError('{!r} not found in {}'.format(git_tag, git_url))
+
+
+def build_manifest(src_path, modules, slots, codebase=None):
+    """
+        Content manifest of the package: its code and its modules / functions / slots definitions,
+        with a hash of each part and of the whole.
+        The code of a git codebase is the commit its tag resolves to, else the hashes of the source files
+    """
+    git_url = getattr(codebase, 'git_url', None)
+    manifest = {
+        'files': source_files(src_path) if git_url is None else None,
+        'commit': git_commit(git_url=git_url, git_tag=codebase.git_tag) if git_url is not None else None,
+        'definitions': {'modules': [module.to_json() for module in modules],
+                        'slots': [slot.to_json() for slot in slots]},
+        'codebase': codebase.to_json() if codebase is not None else None,
+    }
+    manifest['codeHash'] = _digest([manifest['files'], manifest['commit'], manifest['codebase']])
+    manifest['definitionsHash'] = _digest(manifest['definitions'])
+    manifest['hash'] = _digest([manifest['codeHash'], manifest['definitionsHash']])
+    return manifest
+
+
+def load_state(state_path):
+    if state_path is None or not os.path.isfile(state_path):
+        return dict()
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+
+def save_state(state_path, state):
+    tmp_path = '{}.tmp'.format(state_path)
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
 ################
 # push package #
 ################
-codebase = dl.GitCodebase(git_url='https://github.com/dataloop-ai/model-mgmt-app.git',
-                          git_tag='main')
-package = project.packages.push(package_name=package_name,
-                                modules=[module_train, module_predict],
-                                slots=slots,
-                                src_path=os.getcwd(),
-                                codebase=codebase,
-                                is_global=True
-                                )
-
-package = project.packages.get(package_name=package_name)
+def get_package(project):
+    try:
+        return project.packages.get(package_name=package_name)
+    except dl.exceptions.NotFound:
+        return None
+
+
+def push_package(project, manifest, state, src_path, codebase=None, force=False):
+    """
+        Push the package only if its manifest changed since the last push recorded in `state`.
+        When only the definitions changed, they are updated in place and the code is not packed nor uploaded.
+        Any code change is a full `packages.push`: a local codebase is packed and uploaded whole (the platform
+        has no delta upload of a codebase), a git codebase is fetched again by the platform
+
+    Returns:
+        (status 'unchanged' / 'definitions' / 'pushed', package)
+    """
+    package = get_package(project)
+    # pushed by someone else since
+    known = package is not None and state.get('packageId') == package.id and state.get('version') == package.version
+    if known and not force and state.get('manifestHash') == manifest['hash']:
+        return 'unchanged', package
+    if known and not force and state.get('codeHash') == manifest['codeHash']:
+        package.modules = [module_train, module_predict]
+        package.slots = slots
+        return 'definitions', project.packages.update(package=package, revision_increment='patch')
+    package = project.packages.push(package_name=package_name,
+                                    modules=[module_train, module_predict],
+                                    slots=slots,
+                                    src_path=src_path,
+                                    codebase=codebase,
+                                    is_global=True)
+    return 'pushed', package
+
 
 ##################
 # create service #
 ##################
-#
-# service = package.services.deploy(service_name=package_name + '-train',
-#                                   module_name=package_name + '-train',
-#                                   bot=bot_name,
-#                                   init_input={},
-#                                   runtime=dl.KubernetesRuntime(
-#                                       pod_type=dl.InstanceCatalog.REGULAR_S,
-#                                       runner_image='gcr.io/viewo-g/piper/agent/cpu/roberto_utils:2',
-#                                       concurrency=1,
-#                                       autoscaler=dl.KubernetesRabbitmqAutoscaler(min_replicas=1)
-#                                       # FIXME - Always up
-#                                   ),
-#                                   )
-#     service = package.services.deploy(service_name=package_name+'-predict',
-#                                     module_name=package_name+'-predict',
-#                                     bot=bot_name,
-#                                     init_input={'project_name': project_name,
-#                                                 'model_name': args.model_name,
-#                                                 'snapshot_id': snapshot_id},
-#                                     runtime=dl.KubernetesRuntime(
-#                                         pod_type=dl.InstanceCatalog.REGULAR_S,
-#                                         concurrency=1,
-#                                         autoscaler=dl.KubernetesRabbitmqAutoscaler(min_replicas=1)  # FIXME - Always up
-#                                     ),
-#                                     )
+def deploy_services(package, definitions, state, metrics, force=False):
+    """
+        Deploy or update the services in parallel, on the package's revision. A service whose revision and
+        definition did not change since its last deploy recorded in `state` is left as is
+
+    Returns:
+        dict: service name -> 'unchanged' / 'deployed' / 'failed: <error>'
+    """
+    services_state = state.setdefault('services', dict())
+
+    def deploy(service_name, definition):
+        service_hash = _digest({'revision': package.version,
+                                'moduleName': definition['module_name'],
+                                'initInput': definition['init_input'],
+                                'runtime': definition['runtime'].to_json()})
+        if not force and services_state.get(service_name, dict()).get('hash') == service_hash:
+            return 'unchanged'
+        with metrics.timer('deploy_{}'.format(service_name)):
+            service = package.services.deploy(service_name=service_name,
+                                              revision=package.version,
+                                              # rolled, not terminated: the warm replicas serve during the update
+                                              force=False,
+                                              **definition)
+        services_state[service_name] = {'serviceId': service.id, 'hash': service_hash}
+        return 'deployed'
+
+    results = dict()
+    if not definitions:
+        return results
+    with ThreadPoolExecutor(max_workers=len(definitions)) as pool:
+        futures = {name: pool.submit(deploy, name, definition) for name, definition in definitions.items()}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as err:
+                results[name] = 'failed: {}'.format(err)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Push the {} package and deploy its services'.format(package_name))
+    parser.add_argument('--env', default='rc')
+    parser.add_argument('--project-name', default=project_name)
+    parser.add_argument('--src-path', default=os.getcwd(),
+                        help='source of a local codebase, packed and uploaded whole on any code change')
+    parser.add_argument('--codebase', choices=['git', 'local'], default='git',
+                        help="'git' - the repository's main branch, 'local' - the source files packed from --src-path")
+    parser.add_argument('--services', nargs='*', choices=['train', 'predict'], default=list(),
+                        help='services to deploy or update')
+    parser.add_argument('--predict-init-input', help='json init input of the predict service')
+    parser.add_argument('--state', default=DEFAULT_STATE_FILE, help='last pushed manifest and deployed services')
+    parser.add_argument('--force', action='store_true', help='push and deploy even if nothing changed')
+    parser.add_argument('--metrics-path', help='json file of the stages timings')
+    args = parser.parse_args()
+
+    metrics = Metrics(enabled=True, name='create-package')
+    codebase = None
+    if args.codebase == 'git':
+        codebase = dl.GitCodebase(git_url='https://github.com/dataloop-ai/model-mgmt-app.git',
+                                  git_tag='main')
+    with metrics.timer('manifest'):
+        manifest = build_manifest(src_path=args.src_path,
+                                  modules=[module_train, module_predict],
+                                  slots=slots,
+                                  codebase=codebase)
+    state = load_state(args.state)
+    package_state = state.setdefault(package_name, dict())
+
+    with metrics.timer('connect'):
+        dl.setenv(args.env)
+        project = dl.projects.get(project_name=args.project_name)
+    with metrics.timer('push'):
+        status, package = push_package(project=project,
+                                       manifest=manifest,
+                                       state=package_state,
+                                       src_path=args.src_path,
+                                       codebase=codebase,
+                                       force=args.force)
+    package_state.update(packageId=package.id,
+                         version=package.version,
+                         manifestHash=manifest['hash'],
+                         codeHash=manifest['codeHash'],
+                         definitionsHash=manifest['definitionsHash'])
+    save_state(args.state, state)
+    print('package {} ({}): {}'.format(package.name, package.version, status))
+
+    definitions = service_definitions(
+        predict_init_input=json.loads(args.predict_init_input) if args.predict_init_input else None)
+    definitions = {name: definition for name, definition in definitions.items()
+                   if name[len(package_name) + 1:] in args.services}
+    try:
+        with metrics.timer('services'):
+            results = deploy_services(package=package,
+                                      definitions=definitions,
+                                      state=package_state,
+                                      metrics=metrics,
+                                      force=args.force)
+    finally:
+        save_state(args.state, state)
+    for name, result in sorted(results.items()):
+        print('service {}: {}'.format(name, result))
+    print('timings - {}'.format(metrics.stages_message()))
+    metrics.report(metrics_path=args.metrics_path)
+    if any(result.startswith('failed') for result in results.values()):
+        raise SystemExit(1)
+
 
+if __name__ == '__main__':
+    main()
 
 
 ##############
@@ -0,0 +1,397 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+import collections
+
+from handlers.mmap_weights import load_mapped
+from handlers.onnx_runtime import MODEL_FILENAME, OnnxAdapter, artifact_info, fetch_artifact, supports_onnx
+from handlers.snapshot_transfer import STATE_FILENAME, load_from_snapshot
+
+logger = logging.getLogger(name=__name__)
+
+DEFAULT_CACHE_ROOT = os.environ.get('MODEL_MGMT_CACHE_ROOT',
+                                    os.path.join(os.path.expanduser('~'), '.dataloop', 'model_mgmt', 'artifacts'))
+DEFAULT_MAX_SIZE_GB = float(os.environ.get('MODEL_MGMT_CACHE_MAX_SIZE_GB', 20))
+MANIFEST_FILENAME = '.cache_manifest.json'
+BUILD_FILENAME = '.adapter_build.json'
+CODEBASES_DIRNAME = '.codebases'
+LOAD_MODES = ('default', 'mmap', 'onnx')
+
+
+def snapshot_version(snapshot):
+    """
+        The part of the cache key that changes whenever the snapshot's artifacts may have changed
+    """
+    return getattr(snapshot, 'updated_at', None) or getattr(snapshot, 'created_at', None) or ''
+
+
+def cache_key(model_id, snapshot):
+    if snapshot is None:
+        return '{}_no-snapshot'.format(model_id)
+    version = hashlib.sha1(str(snapshot_version(snapshot)).encode()).hexdigest()[:12]
+    return '{}_{}_{}'.format(model_id, snapshot.id, version)
+
+
+def file_checksum(filepath, chunk_size=2 ** 20):
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class DiskCache:
+    """
+    Local disk tier of snapshot artifacts.
+    Every entry is a directory with a manifest of its files checksums, evicted by LRU over the total size
+    """
+
+    def __init__(self, root=None, max_size_gb=None, verify_checksums=True):
+        self.root = root if root is not None else DEFAULT_CACHE_ROOT
+        self.max_size = int((max_size_gb if max_size_gb is not None else DEFAULT_MAX_SIZE_GB) * 1024 ** 3)
+        self.verify_checksums = verify_checksums
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def _manifest_path(self, key):
+        return os.path.join(self.path(key), MANIFEST_FILENAME)
+
+    def _read_manifest(self, key):
+        try:
+            with open(self._manifest_path(key), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_valid(self, key):
+        """
+            True if the entry was fully committed and its files are unchanged
+        """
+        manifest = self._read_manifest(key)
+        if manifest is None:
+            return False
+        root = self.path(key)
+        for rel_path, entry in manifest['files'].items():
+            filepath = os.path.join(root, rel_path)
+            if not os.path.isfile(filepath) or os.path.getsize(filepath) != entry['size']:
+                logger.warning("Cache entry {k!r} is missing or has a truncated file {f!r}".format(k=key, f=rel_path))
+                return False
+            if self.verify_checksums and file_checksum(filepath) != entry['sha256']:
+                logger.warning("Cache entry {k!r} has a corrupted file {f!r}".format(k=key, f=rel_path))
+                return False
+        return True
+
+    def touch(self, key):
+        manifest_path = self._manifest_path(key)
+        if os.path.isfile(manifest_path):
+            os.utime(manifest_path)
+
+    def commit(self, key):
+        """
+            Write the manifest of a fully downloaded entry and evict old entries if over the size limit
+        """
+        root = self.path(key)
+        files = dict()
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if filename in (MANIFEST_FILENAME, STATE_FILENAME, BUILD_FILENAME):
+                    continue
+                filepath = os.path.join(dirpath, filename)
+                files[os.path.relpath(filepath, root)] = {'size': os.path.getsize(filepath),
+                                                          'sha256': file_checksum(filepath)}
+        with open(self._manifest_path(key), 'w') as f:
+            json.dump({'key': key, 'createdAt': time.time(), 'files': files}, f)
+        self.evict(keep=key)
+
+    def remove(self, key):
+        shutil.rmtree(self.path(key), ignore_errors=True)
+
+    def write_build(self, key, record):
+        """
+            Store how the adapter of a committed entry was built, so it can be rebuilt without the platform
+        """
+        with open(os.path.join(self.path(key), BUILD_FILENAME), 'w') as f:
+            json.dump(record, f)
+
+    def read_build(self, key):
+        try:
+            with open(os.path.join(self.path(key), BUILD_FILENAME), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def entries(self):
+        """
+            list of (key, size in bytes, last used timestamp) of all committed entries. The size is of the whole
+            entry directory, including what was written next to the committed files after the commit
+        """
+        entries = list()
+        for key in os.listdir(self.root):
+            if self._read_manifest(key) is None:
+                continue
+            size = 0
+            for dirpath, _, filenames in os.walk(self.path(key)):
+                size += sum(os.path.getsize(os.path.join(dirpath, filename)) for filename in filenames)
+            entries.append((key, size, os.path.getmtime(self._manifest_path(key))))
+        return entries
+
+    def evict(self, keep=None):
+        with self._lock:
+            entries = sorted(self.entries(), key=lambda e: e[2])
+            total = sum(size for _, size, _ in entries)
+            for key, size, _ in entries:
+                if total <= self.max_size:
+                    break
+                if key == keep:
+                    continue
+                logger.info("Evicting cached artifacts {k!r} ({s:.1f}MB)".format(k=key, s=size / 1024 ** 2))
+                self.remove(key)
+                total -= size
+
+
+class AdapterCache:
+    """
+    Process-wide LRU of loaded adapters, backed by a disk cache of the snapshots artifacts.
+    Keyed by model id + snapshot id + snapshot update time, so an updated snapshot is never served stale.
+    The resident adapters are bounded by count and by an estimated memory budget (the artifacts size)
+    """
+
+    def __init__(self, disk_cache=None, max_adapters=None, max_memory_mb=None, load_mode='default'):
+        self._disk_cache = disk_cache
+        self.max_adapters = max_adapters
+        self.max_memory_mb = max_memory_mb
+        self.load_mode = load_mode
+        self.intra_op_threads = None
+        self._adapters = collections.OrderedDict()
+        self._sizes = dict()
+        self._pinned = set()
+        self._lock = threading.Lock()
+        self._key_locks = dict()
+
+    @property
+    def disk_cache(self):
+        if self._disk_cache is None:
+            self._disk_cache = DiskCache()
+        return self._disk_cache
+
+    def configure(self, max_adapters=None, max_memory_mb=None, load_mode='default', intra_op_threads=None):
+        """
+            Set the resident adapters budget (None means unbounded) and how the adapters weights are loaded:
+            'default' - the adapter's `load`, 'mmap' - mapped read only from the disk tier (see mmap_weights.py),
+            'onnx' - the snapshot's exported onnx artifact run by onnxruntime with `intra_op_threads` threads
+            (see onnx_runtime.py)
+        """
+        if load_mode not in LOAD_MODES:
+            raise ValueError('Unknown load mode {!r}, expected one of {}'.format(load_mode, LOAD_MODES))
+        with self._lock:
+            self.max_adapters = max_adapters
+            self.max_memory_mb = max_memory_mb
+            self.load_mode = load_mode
+            self.intra_op_threads = intra_op_threads
+            self._evict()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get(self, model_id, snapshot):
+        """
+            Adapter from the in-process tier or None. Makes no network calls
+        """
+        key = cache_key(model_id=model_id, snapshot=snapshot)
+        with self._lock:
+            adapter = self._adapters.get(key)
+            if adapter is not None:
+                self._adapters.move_to_end(key)
+            return adapter
+
+    def pop(self, model_id, snapshot):
+        key = cache_key(model_id=model_id, snapshot=snapshot)
+        with self._lock:
+            self._sizes.pop(key, None)
+            self._pinned.discard(key)
+            return self._adapters.pop(key, None)
+
+    def pin(self, model_id, snapshot):
+        """
+            Never evict this adapter from memory (e.g. the default adapter of a service)
+        """
+        with self._lock:
+            self._pinned.add(cache_key(model_id=model_id, snapshot=snapshot))
+
+    def resident(self):
+        """
+            list of (key, estimated size in MB) of the resident adapters, least recently used first
+        """
+        with self._lock:
+            return [(key, self._sizes.get(key, 0) / 1024 ** 2) for key in self._adapters]
+
+    def load(self, model, snapshot=None):
+        """
+            Get a loaded adapter from the in-process tier, the disk tier or the platform, in that order.
+            Concurrent loads of the same key are made only once
+
+        Args:
+            model (dl.Model): model entity to build
+            snapshot (dl.Snapshot, optional): snapshot to load the adapter with. Defaults to None.
+
+        Returns:
+            loaded adapter
+        """
+        key = cache_key(model_id=model.id, snapshot=snapshot)
+        with self._key_lock(key):
+            adapter = self.get(model_id=model.id, snapshot=snapshot)
+            if adapter is not None:
+                logger.info("Using in-process cached adapter {k!r}".format(k=key))
+                return adapter
+
+            logger.info("Building Model {n} ({i!r})".format(n=model.name, i=model.id))
+            codebase_path = self._codebase_path(model=model)
+            adapter = model.build(local_path=codebase_path)
+            adapter = self._load(adapter=adapter, snapshot=snapshot, key=key)
+            if snapshot is not None and self.disk_cache.is_valid(key):
+                self.disk_cache.write_build(key=key, record={'model': model.to_json(), 'codebasePath': codebase_path})
+            return adapter
+
+    def restore(self, snapshot):
+        """
+            Rebuild the snapshot's adapter from the disk tier alone: the model entity and its codebase were stored
+            with the artifacts on the first load, so a restarted process only needs the snapshot (the freshness of
+            the entry is its update time, part of the key). None if the snapshot was never loaded on this disk
+
+        Args:
+            snapshot (dl.Snapshot): snapshot to load the adapter with
+
+        Returns:
+            loaded adapter or None
+        """
+        key = cache_key(model_id=snapshot.model_id, snapshot=snapshot)
+        with self._key_lock(key):
+            adapter = self.get(model_id=snapshot.model_id, snapshot=snapshot)
+            if adapter is not None:
+                return adapter
+            record = self.disk_cache.read_build(key)
+            if record is None or not os.path.isdir(record['codebasePath']) or not self.disk_cache.is_valid(key):
+                return None
+
+            import dtlpy as dl
+            logger.info("Restoring the adapter of snapshot {n} ({i!r}) from local cache".
+                        format(n=snapshot.name, i=snapshot.id))
+            model = dl.Model.from_json(_json=record['model'], client_api=dl.client_api, project=None)
+            adapter = model.build(local_path=record['codebasePath'], from_local=True)
+            return self._load(adapter=adapter, snapshot=snapshot, key=key)
+
+    def _codebase_path(self, model):
+        """
+            Local directory of the model's codebase in the disk tier, one per codebase version
+        """
+        codebase = json.dumps(model.to_json().get('codebase'), sort_keys=True, default=str)
+        return os.path.join(self.disk_cache.root, CODEBASES_DIRNAME,
+                            '{}_{}'.format(model.id, hashlib.sha1(codebase.encode()).hexdigest()[:12]))
+
+    def _load(self, adapter, snapshot, key):
+        """
+            Load the built adapter with the snapshot and add it to the in-process tier. Called with the key lock held
+        """
+        size = 0
+        onnx_adapter = None
+        if self.load_mode == 'onnx' and snapshot is not None:
+            onnx_adapter = self._load_onnx(adapter=adapter, snapshot=snapshot, key=key)
+        if onnx_adapter is not None:
+            adapter = onnx_adapter
+            size = os.path.getsize(adapter.model_path)
+        elif snapshot is not None:
+            self._load_snapshot(adapter=adapter, snapshot=snapshot, key=key)
+            size = sum(s for k, s, _ in self.disk_cache.entries() if k == key)
+        with self._lock:
+            self._adapters[key] = adapter
+            self._sizes[key] = size
+            self._evict()
+        return adapter
+
+    def _evict(self):
+        """
+            Drop least recently used adapters until within budget. Called with the lock held
+        """
+        def over_budget():
+            if self.max_adapters is not None and len(self._adapters) > self.max_adapters:
+                return True
+            if self.max_memory_mb is not None and sum(self._sizes.values()) / 1024 ** 2 > self.max_memory_mb:
+                return True
+            return False
+
+        for key in list(self._adapters.keys()):
+            if not over_budget():
+                break
+            # the most recent adapter is kept even if it is over the budget alone
+            if key in self._pinned or key == next(reversed(self._adapters)):
+                continue
+            logger.info("Evicting resident adapter {k!r}".format(k=key))
+            self._adapters.pop(key)
+            self._sizes.pop(key, None)
+
+    def _load_onnx(self, adapter, snapshot, key):
+        """
+            The adapter running the snapshot's onnx artifact, cached in the disk tier. The eager weights are not
+            downloaded. None (with a warning) if the snapshot has no artifact or the adapter does not support it
+        """
+        if artifact_info(snapshot) is None or not supports_onnx(adapter):
+            logger.warning("No onnx artifact for snapshot {i!r} or adapter {a!r} does not support it, "
+                           "loading regularly".format(i=snapshot.id, a=type(adapter).__name__))
+            return None
+        onnx_key = '{}_onnx'.format(key)
+        local_path = self.disk_cache.path(onnx_key)
+        if not self.disk_cache.is_valid(onnx_key):
+            logger.info("Downloading the onnx artifact of snapshot {n} ({i!r})".format(n=snapshot.name,
+                                                                                       i=snapshot.id))
+            self.disk_cache.remove(onnx_key)
+            fetch_artifact(snapshot=snapshot, local_path=local_path)
+            self.disk_cache.commit(onnx_key)
+        else:
+            self.disk_cache.touch(onnx_key)
+        adapter.snapshot = snapshot
+        return OnnxAdapter(adapter=adapter,
+                           model_path=os.path.join(local_path, MODEL_FILENAME),
+                           intra_op_threads=self.intra_op_threads)
+
+    def _load_snapshot(self, adapter, snapshot, key):
+        local_path = self.disk_cache.path(key)
+        logger.debug("Snapshot\n{}\n{}".format('=' * 8, snapshot.print(to_return=True)))
+        if self.disk_cache.is_valid(key):
+            logger.info("Loading Adapter with: {n} ({i!r}) from local cache {p!r}".
+                        format(n=snapshot.name, i=snapshot.id, p=local_path))
+            adapter.snapshot = snapshot
+            if not (self.load_mode == 'mmap' and load_mapped(adapter=adapter, local_path=local_path)):
+                adapter.load(local_path=local_path)
+            self.disk_cache.touch(key)
+        else:
+            logger.info("Loading Adapter with: {n} ({i!r})".format(n=snapshot.name, i=snapshot.id))
+            self.disk_cache.remove(key)
+            os.makedirs(local_path, exist_ok=True)
+            # other cached snapshots of the model (e.g. the previous version, or the snapshot it was fine-tuned
+            # from) share most of the chunks of the artifacts
+            model_prefix = key.split('_')[0] + '_'
+            reuse_paths = [self.disk_cache.path(cached_key)
+                           for cached_key, _, _ in self.disk_cache.entries() if cached_key.startswith(model_prefix)]
+            load_from_snapshot(adapter=adapter,
+                               snapshot=snapshot,
+                               local_path=local_path,
+                               staging_path=os.path.join(self.disk_cache.root, '.partial', key),
+                               reuse_paths=reuse_paths)
+            self.disk_cache.commit(key)
+            if self.load_mode == 'mmap':
+                load_mapped(adapter=adapter, local_path=local_path, loaded=True)
+        if self.load_mode == 'mmap':
+            # an exported layout adds to the entry's size
+            self.disk_cache.evict(keep=key)
+
+
+# shared by all the runners in the process
+adapter_cache = AdapterCache()
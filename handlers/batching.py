@@ -0,0 +1,99 @@
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(name=__name__)
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent single item predictions into batched adapter calls
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=10):
+        """
+        Args:
+            predict_fn (callable): called as predict_fn(items, **kwargs), returns one prediction per item
+            max_batch_size (int, optional): max number of items in a single call. Defaults to 8.
+            max_wait_ms (float, optional): max time to hold the first request of a batch. Defaults to 10.
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.max_wait = max(float(max_wait_ms), 0) / 1000
+        self._queue = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, item, **kwargs) -> Future:
+        """
+            Queue an item for prediction.
+            Only requests with the same kwargs are batched together
+
+        Returns:
+            Future: resolved with the item's prediction
+        """
+        if self._closed:
+            raise RuntimeError('MicroBatcher is closed')
+        future = Future()
+        self._queue.put((item, tuple(sorted(kwargs.items())), future))
+        return future
+
+    def predict(self, item, **kwargs):
+        return self.submit(item, **kwargs).result()
+
+    def close(self):
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        requests = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # let the loop exit after serving what was collected
+                self._queue.put(None)
+                break
+            requests.append(request)
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            if requests is None:
+                return
+            groups = dict()
+            for item, key, future in requests:
+                groups.setdefault(key, list()).append((item, future))
+            for key, group in groups.items():
+                self._run_group(key=key, group=group)
+
+    def _run_group(self, key, group):
+        items = [item for item, _ in group]
+        try:
+            predictions = self.predict_fn(items, **dict(key))
+            if len(predictions) != len(items):
+                raise ValueError('Expected {} predictions, got {}'.format(len(items), len(predictions)))
+        except Exception as err:
+            if len(group) > 1:
+                logger.exception("Batch of {} items failed, retrying item by item".format(len(group)))
+                for request in group:
+                    self._run_group(key=key, group=[request])
+            else:
+                group[0][1].set_exception(err)
+            return
+        for (_, future), prediction in zip(group, predictions):
+            future.set_result(prediction)
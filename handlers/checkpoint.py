@@ -0,0 +1,106 @@
+import time
+import logging
+import datetime
+
+from handlers.entities import entities
+from handlers.snapshot_transfer import save_to_snapshot
+
+logger = logging.getLogger(name=__name__)
+
+# key of the checkpoint record in the snapshot's system metadata
+CHECKPOINT_METADATA_KEY = 'trainCheckpoint'
+
+
+def bucket_id(snapshot):
+    """
+        Identity of the snapshot's bucket: its directory item for item buckets
+    """
+    bucket = getattr(snapshot, 'bucket', None)
+    directory_item = getattr(bucket, 'directory_item', None)
+    if directory_item is not None:
+        return directory_item.id
+    return getattr(bucket, 'id', None)
+
+
+def get_checkpoint(snapshot):
+    """
+        The record of the latest checkpoint saved to the snapshot's own bucket, or None.
+        A record saved to another bucket (e.g. copied from the snapshot it was cloned from) does not describe
+        the weights in this one and is ignored
+    """
+    record = snapshot.metadata.get('system', dict()).get(CHECKPOINT_METADATA_KEY)
+    if record is None:
+        return None
+    if record.get('bucketId') is None or record['bucketId'] != bucket_id(snapshot):
+        logger.warning("Ignoring checkpoint record of snapshot {s!r}: it was not saved to its bucket".format(
+            s=snapshot.id))
+        return None
+    return record
+
+
+class SnapshotCheckpointer:
+    """
+    Periodically save the training output to the snapshot's bucket from the epoch end callback,
+    and record the epoch in the snapshot metadata so a restarted execution can resume from it
+    """
+
+    def __init__(self, adapter, snapshot, output_path, every_epochs=None, every_minutes=None, execution_id=None,
+                 chunked_upload=False):
+        """
+        Args:
+            adapter: the training adapter
+            snapshot (dl.Snapshot): snapshot being trained
+            output_path (str): local training output directory
+            every_epochs (int, optional): save every N epochs. Defaults to None.
+            every_minutes (float, optional): save when N minutes passed since the last save. Defaults to None.
+            execution_id (str, optional): recorded with the checkpoint. Defaults to None.
+            chunked_upload (bool, optional): upload only the changed chunks of the output. Defaults to False.
+        """
+        self.adapter = adapter
+        self.snapshot = snapshot
+        self.output_path = output_path
+        self.every_epochs = every_epochs
+        self.every_seconds = every_minutes * 60 if every_minutes is not None else None
+        self.execution_id = execution_id
+        self.chunked_upload = chunked_upload
+        self._last_save = time.monotonic()
+
+    @property
+    def enabled(self):
+        return self.every_epochs is not None or self.every_seconds is not None
+
+    def is_due(self, i_epoch):
+        if self.every_epochs is not None and (i_epoch + 1) % int(self.every_epochs) == 0:
+            return True
+        if self.every_seconds is not None and time.monotonic() - self._last_save >= self.every_seconds:
+            return True
+        return False
+
+    def on_epoch_end(self, i_epoch, n_epoch):
+        if not self.enabled or i_epoch + 1 >= n_epoch or not self.is_due(i_epoch):
+            # the last epoch is saved by the end of the training anyway
+            return
+        try:
+            self.save(i_epoch=i_epoch, n_epoch=n_epoch)
+        except Exception:
+            # a failed checkpoint must not fail the training
+            logger.exception("Failed saving checkpoint of epoch {}".format(i_epoch))
+
+    def save(self, i_epoch, n_epoch):
+        tic = time.monotonic()
+        save_to_snapshot(adapter=self.adapter, local_path=self.output_path, chunked=self.chunked_upload)
+        self.snapshot.metadata.setdefault('system', dict())[CHECKPOINT_METADATA_KEY] = {
+            'epoch': i_epoch,
+            'numEpochs': n_epoch,
+            'executionId': self.execution_id,
+            'bucketId': bucket_id(self.snapshot),
+            'savedAt': datetime.datetime.utcnow().isoformat(),
+        }
+        entities.update(self.snapshot)
+        self._last_save = time.monotonic()
+        logger.info("Saved checkpoint of epoch {e}/{n} in {t:.1f}s".format(e=i_epoch, n=n_epoch,
+                                                                           t=time.monotonic() - tic))
+
+    def clear(self):
+        if self.snapshot.metadata.get('system', dict()).pop(CHECKPOINT_METADATA_KEY, None) is not None:
+            entities.update(self.snapshot)
@@ -0,0 +1,171 @@
+import logging
+
+import numpy as np
+
+from handlers.evaluation import annotation_fields
+
+logger = logging.getLogger(name=__name__)
+
+COLUMNAR_FORMAT = 'columnar'
+OUTPUT_FORMATS = ('annotations', COLUMNAR_FORMAT)
+
+
+class ColumnarPredictions:
+    """
+    Box predictions of an item as columns: (N, 4) [left, top, right, bottom] boxes, (N,) scores and (N,) label ids
+    into a label map. Filtering and NMS are vectorized and the upload payload is built from the columns,
+    without an annotation object per box.
+
+    Adapters may return it (or a dict of 'boxes', 'scores', 'label_ids' and 'label_map' arrays) from `predict`
+    """
+
+    def __init__(self, boxes, scores, label_ids, label_map, model_name=None):
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+        self.label_ids = np.asarray(label_ids, dtype=np.int64).reshape(-1)
+        self.label_map = list(label_map)
+        self.model_name = model_name
+        if not len(self.boxes) == len(self.scores) == len(self.label_ids):
+            raise ValueError('Columns lengths differ: {} boxes, {} scores, {} labels'.
+                             format(len(self.boxes), len(self.scores), len(self.label_ids)))
+
+    def __len__(self):
+        return len(self.scores)
+
+    @classmethod
+    def from_annotations(cls, annotations, model_name=None):
+        """
+            From box annotations (platform annotations or prediction dicts). None if any annotation is not a box
+        """
+        fields = [annotation_fields(annotation) for annotation in annotations]
+        if any(box is None for _, _, box, _ in fields):
+            return None
+        label_map = sorted({label for _, label, _, _ in fields})
+        label_index = {label: i for i, label in enumerate(label_map)}
+        return cls(boxes=[box for _, _, box, _ in fields],
+                   scores=[score for _, _, _, score in fields],
+                   label_ids=[label_index[label] for _, label, _, _ in fields],
+                   label_map=label_map,
+                   model_name=model_name)
+
+    @classmethod
+    def from_json(cls, _json):
+        return cls(boxes=_json['boxes'],
+                   scores=_json['scores'],
+                   label_ids=_json['labelIds'],
+                   label_map=_json['labelMap'],
+                   model_name=_json.get('modelName'))
+
+    def to_json(self):
+        return {'format': COLUMNAR_FORMAT,
+                'boxes': self.boxes.tolist(),
+                'scores': self.scores.tolist(),
+                'labelIds': self.label_ids.tolist(),
+                'labelMap': self.label_map,
+                'modelName': self.model_name}
+
+    def take(self, indices):
+        return ColumnarPredictions(boxes=self.boxes[indices],
+                                   scores=self.scores[indices],
+                                   label_ids=self.label_ids[indices],
+                                   label_map=self.label_map,
+                                   model_name=self.model_name)
+
+    def filter(self, score_threshold=None, labels=None):
+        keep = np.ones(len(self), dtype=bool)
+        if score_threshold is not None:
+            keep &= self.scores >= score_threshold
+        if labels is not None:
+            labels = set(labels)
+            wanted = np.array([i for i, label in enumerate(self.label_map) if label in labels], dtype=np.int64)
+            keep &= np.isin(self.label_ids, wanted)
+        return self.take(np.flatnonzero(keep))
+
+    def top_k(self, k):
+        if len(self) <= k:
+            return self
+        indices = np.argpartition(-self.scores, k - 1)[:k]
+        return self.take(indices[np.argsort(-self.scores[indices], kind='stable')])
+
+    def nms(self, iou_threshold=0.5, class_agnostic=False, max_detections=None):
+        """
+            Greedy non maximum suppression, per label unless `class_agnostic`. The kept boxes are in descending
+            score order, so it stops after `max_detections` boxes
+        """
+        if len(self) < 2:
+            return self
+        boxes = self.boxes.astype(np.float64)
+        if not class_agnostic:
+            # boxes of different labels never overlap once shifted apart by their label
+            offset = boxes.max() - boxes.min() + 1
+            boxes = boxes + (self.label_ids * offset)[:, None]
+        order = np.argsort(-self.scores, kind='stable')
+        left, top, right, bottom = boxes[order].T
+        areas = (right - left) * (bottom - top)
+        # positions in `order` of the remaining boxes
+        remaining = np.arange(len(order))
+        keep = list()
+        while len(remaining) > 0 and (max_detections is None or len(keep) < max_detections):
+            best, rest = remaining[0], remaining[1:]
+            keep.append(order[best])
+            width = np.minimum(right[best], right[rest]) - np.maximum(left[best], left[rest])
+            height = np.minimum(bottom[best], bottom[rest]) - np.maximum(top[best], top[rest])
+            intersection = np.clip(width, 0, None) * np.clip(height, 0, None)
+            union = areas[best] + areas[rest] - intersection
+            ious = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+            remaining = rest[ious <= iou_threshold]
+        return self.take(np.array(keep, dtype=np.int64))
+
+    def postprocess(self, score_threshold=None, labels=None, nms_iou_threshold=None, class_agnostic_nms=False,
+                    top_k=None):
+        """
+            Score threshold and label filter, then NMS, then the top k scores
+        """
+        predictions = self
+        if top_k is not None:
+            top_k = int(top_k)
+        if score_threshold is not None or labels is not None:
+            predictions = predictions.filter(score_threshold=score_threshold, labels=labels)
+        if nms_iou_threshold is not None:
+            predictions = predictions.nms(iou_threshold=nms_iou_threshold, class_agnostic=class_agnostic_nms,
+                                          max_detections=top_k)
+        if top_k is not None:
+            predictions = predictions.top_k(top_k)
+        return predictions
+
+    def to_upload_payload(self):
+        """
+            The annotations upload json, built from the columns
+        """
+        labels = np.asarray(self.label_map, dtype=object)[self.label_ids].tolist() if len(self) else list()
+        model = {'name': self.model_name} if self.model_name is not None else dict()
+        return [{'type': 'box',
+                 'label': label,
+                 'coordinates': [{'x': left, 'y': top, 'z': 0}, {'x': right, 'y': bottom, 'z': 0}],
+                 'metadata': {'user': {'model': dict(model, confidence=score)}}}
+                for (left, top, right, bottom), score, label in zip(self.boxes.tolist(), self.scores.tolist(), labels)]
+
+
+def to_columnar(prediction, model_name=None):
+    """
+        The prediction as ColumnarPredictions, None if it has other than box annotations
+    """
+    if isinstance(prediction, ColumnarPredictions):
+        return prediction
+    if isinstance(prediction, dict) and 'boxes' in prediction:
+        return ColumnarPredictions(boxes=prediction['boxes'],
+                                   scores=prediction['scores'],
+                                   label_ids=prediction['label_ids'],
+                                   label_map=prediction['label_map'],
+                                   model_name=model_name)
+    annotations = getattr(prediction, 'annotations', prediction)
+    return ColumnarPredictions.from_annotations(annotations=annotations, model_name=model_name)
+
+
+def upload_payload(prediction):
+    """
+        What to pass to `item.annotations.upload`
+    """
+    if isinstance(prediction, ColumnarPredictions):
+        return prediction.to_upload_payload()
+    return prediction
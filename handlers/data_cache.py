@@ -0,0 +1,178 @@
+import os
+import shutil
+import hashlib
+import logging
+import threading
+
+import dtlpy as dl
+
+from handlers.entities import entities
+from handlers.dataset_sync import partition_value
+
+logger = logging.getLogger(name=__name__)
+
+DEFAULT_CACHE_ROOT = os.environ.get('MODEL_MGMT_DATA_CACHE_ROOT',
+                                    os.path.join(os.path.expanduser('~'), '.dataloop', 'model_mgmt', 'training_data'))
+DEFAULT_MAX_SIZE_GB = float(os.environ.get('MODEL_MGMT_DATA_CACHE_MAX_SIZE_GB', 50))
+
+
+def item_key(item):
+    """
+        Content key of an item's binary.
+        The binary's md5, when the platform provides it, is shared by an item and all its clones.
+        Otherwise the item id + update time - changes whenever the item is updated
+    """
+    md5 = item.metadata.get('system', dict()).get('md5')
+    if md5:
+        return hashlib.sha1('md5:{}'.format(md5).encode()).hexdigest()
+    return hashlib.sha1('{}:{}'.format(item.id, item.updated_at).encode()).hexdigest()
+
+
+def annotations_key(item):
+    """
+        Key of an item's annotations json: the item id + the annotations update time (the item's update time when
+        the platform does not provide it) - changes whenever the annotations are edited
+    """
+    updated_at = item.metadata.get('system', dict()).get('annotationsUpdatedAt') or item.updated_at
+    return hashlib.sha1('annotations:{}:{}'.format(item.id, updated_at).encode()).hexdigest()
+
+
+def link_file(src, dst):
+    """
+        Hardlink, or symlink across devices, or copy as the last resort
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        try:
+            os.symlink(os.path.abspath(src), dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+
+class TrainingDataCache:
+    """
+    Content addressed local cache of items binaries and annotations json shared by all the training runs on the
+    machine. A snapshot's data directory is made of links into the cache, so a retrain on a mostly unchanged
+    dataset downloads (and copies) only the new and updated items, and the annotations edited since.
+    Cached files are read only - they are shared by every data directory linking to them
+    """
+
+    def __init__(self, root=None, max_size_gb=None):
+        self.root = root if root is not None else DEFAULT_CACHE_ROOT
+        self.max_size = int((max_size_gb if max_size_gb is not None else DEFAULT_MAX_SIZE_GB) * 1024 ** 3)
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def blob_path(self, item):
+        key = item_key(item)
+        return os.path.join(self.root, key[:2], key)
+
+    def annotations_blob_path(self, item):
+        key = annotations_key(item)
+        return os.path.join(self.root, key[:2], '{}.json'.format(key))
+
+    @staticmethod
+    def item_path(data_path, partition, item):
+        return os.path.join(data_path, partition_value(partition), 'items', item.filename.lstrip('/'))
+
+    @staticmethod
+    def annotations_path(data_path, partition, item):
+        return os.path.join(data_path, partition_value(partition), 'json',
+                            '{}.json'.format(os.path.splitext(item.filename.lstrip('/'))[0]))
+
+    def _files(self, data_path, partition, item):
+        """
+            (cached file, file in the data directory) of the item's binary and of its annotations
+        """
+        return [(self.blob_path(item), self.item_path(data_path=data_path, partition=partition, item=item)),
+                (self.annotations_blob_path(item),
+                 self.annotations_path(data_path=data_path, partition=partition, item=item))]
+
+    @staticmethod
+    def list_partitions(snapshot, partitions=None):
+        """
+            partition -> list of items of the snapshot's dataset
+        """
+        if partitions is None:
+            partitions = [dl.SnapshotPartitionType.TRAIN, dl.SnapshotPartitionType.VALIDATION]
+        dataset = entities.snapshot_dataset(snapshot)
+        items_by_partition = dict()
+        for partition in partitions:
+            filters = dl.Filters()
+            filters.add(field='metadata.system.snapshotPartition', values=partition_value(partition))
+            items_by_partition[partition] = [item for page in dataset.items.list(filters=filters) for item in page]
+        return items_by_partition
+
+    def materialize(self, items_by_partition, data_path):
+        """
+            Link the cached binaries and annotations into the data directory
+
+        Returns:
+            dict: number of linked (hits) and missing items binaries, and of linked and missing annotations
+        """
+        hits = {'items': 0, 'annotations': 0}
+        misses = {'items': 0, 'annotations': 0}
+        for partition, items in items_by_partition.items():
+            for item in items:
+                files = self._files(data_path=data_path, partition=partition, item=item)
+                for kind, (blob, local_path) in zip(['items', 'annotations'], files):
+                    if os.path.isfile(blob):
+                        link_file(blob, local_path)
+                        os.utime(blob)
+                        hits[kind] += 1
+                    else:
+                        misses[kind] += 1
+        logger.info("Training data cache: {h} items and {ah} annotations linked, {m} items and {am} annotations "
+                    "to download".format(h=hits['items'], m=misses['items'],
+                                         ah=hits['annotations'], am=misses['annotations']))
+        return {'hits': hits['items'], 'misses': misses['items'],
+                'annotationsHits': hits['annotations'], 'annotationsMisses': misses['annotations']}
+
+    def ingest(self, items_by_partition, data_path):
+        """
+            Move the newly downloaded binaries and annotations into the cache and link them back into the data
+            directory
+        """
+        ingested = 0
+        for partition, items in items_by_partition.items():
+            for item in items:
+                for blob, local_path in self._files(data_path=data_path, partition=partition, item=item):
+                    if os.path.isfile(blob) or not os.path.isfile(local_path) or os.path.islink(local_path):
+                        continue
+                    os.makedirs(os.path.dirname(blob), exist_ok=True)
+                    tmp_blob = '{}.{}.tmp'.format(blob, os.getpid())
+                    try:
+                        os.link(local_path, tmp_blob)
+                    except OSError:
+                        shutil.copy2(local_path, tmp_blob)
+                    os.chmod(tmp_blob, 0o444)
+                    os.replace(tmp_blob, blob)
+                    link_file(blob, local_path)
+                    ingested += 1
+        self.evict()
+        return ingested
+
+    def evict(self):
+        """
+            Remove the least recently used files until the cache is within its quota.
+            Files being ingested (.tmp) are left alone
+        """
+        with self._lock:
+            blobs = list()
+            for dirpath, _, filenames in os.walk(self.root):
+                for filename in filenames:
+                    if filename.endswith('.tmp'):
+                        continue
+                    filepath = os.path.join(dirpath, filename)
+                    stat = os.stat(filepath)
+                    blobs.append((stat.st_mtime, stat.st_size, filepath))
+            total = sum(size for _, size, _ in blobs)
+            for _, size, filepath in sorted(blobs):
+                if total <= self.max_size:
+                    break
+                os.remove(filepath)
+                total -= size
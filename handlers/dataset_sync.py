@@ -0,0 +1,184 @@
+import hashlib
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import dtlpy as dl
+
+logger = logging.getLogger(name=__name__)
+
+# key of the sync record in the cloned dataset's system metadata
+SYNC_METADATA_KEY = 'modelMgmtSync'
+# max number of ids in a single `$in` query
+IDS_CHUNK_SIZE = 500
+
+
+def partition_value(partition):
+    """
+        The name of a partition as stored in the items' metadata: 'train', not 'SnapshotPartitionType.TRAIN'
+    """
+    return getattr(partition, 'value', partition)
+
+
+def assign_partition(key, partitions):
+    """
+        Deterministic partition of an item - the same key always falls in the same partition
+
+    Args:
+        key (str): stable identifier of the item (its remote filepath)
+        partitions (dict): partition -> ratio
+
+    Returns:
+        the partition of the item
+    """
+    total = sum(partitions.values())
+    position = int(hashlib.md5(key.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF * total
+    cumulative = 0
+    partition = None
+    for partition, ratio in partitions.items():
+        cumulative += ratio
+        if position < cumulative:
+            return partition
+    return partition
+
+
+def _ids_filters(ids):
+    filters = dl.Filters()
+    filters.add(field='id', values=list(ids), operator=dl.FiltersOperations.IN)
+    return filters
+
+
+def _chunks(values, size=IDS_CHUNK_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def list_items(dataset, filters=None):
+    """
+        filename -> item of all the items in the (filtered) dataset
+    """
+    if filters is None:
+        filters = dl.Filters()
+    return {item.filename: item for page in dataset.items.list(filters=filters) for item in page}
+
+
+def set_partitions(dataset, items, partitions):
+    """
+        Set the hash based partition of the items in their dataset
+    """
+    by_partition = dict()
+    for item in items:
+        by_partition.setdefault(assign_partition(item.filename, partitions), list()).append(item.id)
+    for partition, ids in by_partition.items():
+        for chunk in _chunks(ids):
+            dataset.set_partition(partition=partition, filters=_ids_filters(chunk))
+
+
+def get_sync_record(dataset):
+    return dataset.metadata.get('system', dict()).get(SYNC_METADATA_KEY)
+
+
+def partition_ratios(partitions):
+    """
+        partition name -> ratio, as recorded in the sync record
+    """
+    return {partition_value(partition): ratio for partition, ratio in partitions.items()}
+
+
+def _save_sync_record(dataset, source_dataset, watermark, partitions):
+    dataset.metadata.setdefault('system', dict())[SYNC_METADATA_KEY] = {
+        'sourceDatasetId': source_dataset.id,
+        'watermark': watermark,
+        'partitions': partition_ratios(partitions),
+        'syncedAt': datetime.datetime.utcnow().isoformat(),
+    }
+    dataset.update(system_metadata=True)
+
+
+def _watermark(items, previous=''):
+    """
+        Latest update time of the source items. Compared with the source timestamps only, so no clock skew
+    """
+    return max([previous or ''] + [item.updated_at or '' for item in items])
+
+
+def clone_dataset(dataset, clone_name, partitions, filters=None):
+    """
+        Full clone of the (filtered) dataset with hash based partitions, ready for incremental syncs
+    """
+    cloned_dataset = dataset.clone(clone_name=clone_name, filters=filters)
+    source_items = list_items(dataset=dataset, filters=filters)
+    cloned_items = list_items(dataset=cloned_dataset)
+    set_partitions(dataset=cloned_dataset, items=cloned_items.values(), partitions=partitions)
+    _save_sync_record(dataset=cloned_dataset,
+                      source_dataset=dataset,
+                      watermark=_watermark(source_items.values()),
+                      partitions=partitions)
+    return cloned_dataset
+
+
+def sync_cloned_dataset(dataset, cloned_dataset, partitions, filters=None, num_workers=8, progress=None,
+                        record=None):
+    """
+        Bring a previously cloned dataset up to date with its source, cloning only the delta.
+        Items are matched by their remote filepath: added items are cloned, removed items are deleted and
+        items updated since the last sync are replaced. Existing items keep their partition, unless the
+        partitions ratios changed since the last sync: then all the items are partitioned again
+
+    Args:
+        dataset (dl.Dataset): source dataset
+        cloned_dataset (dl.Dataset): the clone to sync
+        partitions (dict): partition -> ratio
+        filters (dl.Filters, optional): items of the source dataset to sync. Defaults to None.
+        num_workers (int, optional): items cloned in parallel. Defaults to 8.
+        progress (dl.Progress, optional): execution progress. Defaults to None.
+        record (dict, optional): sync record of the clone's items, when they were copied from another clone.
+                                 Defaults to None ==> that of `cloned_dataset`.
+
+    Returns:
+        dict: number of added, removed and modified items, and whether the items were partitioned again
+    """
+    if record is None:
+        record = get_sync_record(cloned_dataset)
+    watermark = record['watermark'] if record is not None else ''
+    repartition = record is None or record.get('partitions') != partition_ratios(partitions)
+    source_items = list_items(dataset=dataset, filters=filters)
+    cloned_items = list_items(dataset=cloned_dataset)
+
+    added = [name for name in source_items if name not in cloned_items]
+    removed = [name for name in cloned_items if name not in source_items]
+    modified = [name for name in source_items
+                if name in cloned_items and (source_items[name].updated_at or '') > watermark]
+    logger.info("Syncing dataset {c!r} from {s!r}: {a} added, {r} removed, {m} modified".
+                format(c=cloned_dataset.id, s=dataset.id, a=len(added), r=len(removed), m=len(modified)))
+
+    for chunk in _chunks([cloned_items[name].id for name in removed + modified]):
+        cloned_dataset.items.delete(filters=_ids_filters(chunk))
+
+    def clone_item(name):
+        return source_items[name].clone(dst_dataset_id=cloned_dataset.id,
+                                        remote_filepath=name,
+                                        with_annotations=True,
+                                        with_metadata=True,
+                                        allow_many=False,
+                                        wait=True)
+
+    to_clone = added + modified
+    new_items = list()
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        for i_item, item in enumerate(pool.map(clone_item, to_clone)):
+            new_items.append(item)
+            if progress is not None and (i_item + 1) % 100 == 0:
+                progress.update(message='cloned items: {}/{}'.format(i_item + 1, len(to_clone)))
+    if repartition:
+        logger.info("Partitions of dataset {c!r} changed to {p}, partitioning all its items again".
+                    format(c=cloned_dataset.id, p=partition_ratios(partitions)))
+        kept = set(removed + modified)
+        new_items += [item for name, item in cloned_items.items() if name not in kept]
+    set_partitions(dataset=cloned_dataset, items=new_items, partitions=partitions)
+    _save_sync_record(dataset=cloned_dataset,
+                      source_dataset=dataset,
+                      watermark=_watermark(source_items.values(), previous=watermark),
+                      partitions=partitions)
+    return {'added': len(added), 'removed': len(removed), 'modified': len(modified), 'repartitioned': repartition}
@@ -0,0 +1,240 @@
+import os
+import time
+import logging
+import threading
+
+import dtlpy as dl
+
+logger = logging.getLogger(name=__name__)
+
+# how long a fetched project / model / snapshot / dataset is trusted before it is fetched again
+DEFAULT_TTL_SECONDS = float(os.environ.get('MODEL_MGMT_ENTITY_TTL_SECONDS', 60))
+# max number of ids in a single bulk items query
+DEFAULT_ITEMS_QUERY_SIZE = 1000
+# connections kept alive to the platform, shared by the threads of the process
+DEFAULT_POOL_SIZE = int(os.environ.get('MODEL_MGMT_HTTP_POOL_SIZE', 32))
+
+
+class EntityResolver:
+    """
+    Process wide, thread safe cache of the project, model, snapshot and dataset entities the handlers resolve
+    on every execution. Entries expire after `ttl_seconds`, and are replaced when the handlers update the entity
+    (`updated`). Concurrent lookups of the same entity make a single API call.
+    Items are not cached, but fetched in bulk by ids
+    """
+
+    def __init__(self, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        # (kind, key) -> (entity, fetched_at)
+        self._entities = dict()
+        self._lock = threading.Lock()
+        self._key_locks = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, ttl_seconds=None, pool_size=None):
+        """
+            Set the entities TTL and size the platform client's keep-alive connections pool
+        """
+        if ttl_seconds is not None:
+            self.ttl_seconds = float(ttl_seconds)
+        if pool_size is not None:
+            configure_session(pool_size=pool_size)
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _cached(self, key):
+        with self._lock:
+            entity, fetched_at = self._entities.get(key, (None, 0))
+            if entity is not None and time.monotonic() - fetched_at <= self.ttl_seconds:
+                self.hits += 1
+                return entity
+        return None
+
+    def _resolve(self, kind, key, fetch):
+        key = (kind,) + key
+        entity = self._cached(key)
+        if entity is not None:
+            return entity
+        with self._key_lock(key):
+            # fetched by a concurrent lookup while waiting
+            entity = self._cached(key)
+            if entity is not None:
+                return entity
+            with self._lock:
+                self.misses += 1
+            entity = fetch()
+            self.put(kind=kind, entity=entity, extra_keys=[key])
+            return entity
+
+    def put(self, kind, entity, extra_keys=None):
+        """
+            Cache a fetched (or just updated) entity under its id, and the lookup keys that resolved it
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._entities[(kind, 'id', entity.id)] = (entity, now)
+            for key in extra_keys or list():
+                self._entities[key] = (entity, now)
+
+    def update(self, entity):
+        """
+            `entity.update()`, caching the updated entity
+        """
+        updated = entity.update()
+        self.updated(updated if updated is not None and hasattr(updated, 'id') else entity)
+        return updated
+
+    def updated(self, entity):
+        """
+            Replace the cached copies of an entity the handlers just updated
+        """
+        with self._lock:
+            keys = [key for key, (cached, _) in self._entities.items() if cached.id == entity.id]
+            now = time.monotonic()
+            for key in keys:
+                self._entities[key] = (entity, now)
+
+    def invalidate(self, entity_id=None):
+        """
+            Drop an entity (all of them if `entity_id` is None), it is fetched again on next use
+        """
+        with self._lock:
+            if entity_id is None:
+                self._entities.clear()
+                return
+            for key in [key for key, (cached, _) in self._entities.items() if cached.id == entity_id]:
+                self._entities.pop(key)
+
+    def project(self, project_id=None, project_name=None):
+        if project_id is not None:
+            return self._resolve('project', ('id', project_id),
+                                 lambda: dl.projects.get(project_id=project_id))
+        return self._resolve('project', ('name', project_name),
+                             lambda: dl.projects.get(project_name=project_name))
+
+    def model(self, model_id=None, model_name=None, project_id=None, project_name=None):
+        """
+            A model by id, or by name in the project then in all the accessible projects
+        """
+        if model_id is not None:
+            # ids are global, no need for the project
+            return self._resolve('model', ('id', model_id), lambda: dl.models.get(model_id=model_id))
+
+        def fetch():
+            if project_id is not None or project_name is not None:
+                try:
+                    return self.project(project_id=project_id, project_name=project_name).models.get(
+                        model_name=model_name)
+                except dl.exceptions.NotFound:
+                    logger.debug("Model not found in project")
+            return dl.models.get(model_name=model_name)
+
+        return self._resolve('model', ('name', project_id or project_name, model_name), fetch)
+
+    def snapshot(self, snapshot_id=None, snapshot_name=None, model=None):
+        if snapshot_id is not None:
+            return self._resolve('snapshot', ('id', snapshot_id), lambda: dl.snapshots.get(snapshot_id=snapshot_id))
+        return self._resolve('snapshot', ('name', model.id, snapshot_name),
+                             lambda: model.snapshots.get(snapshot_name=snapshot_name))
+
+    def snapshot_model(self, snapshot):
+        """
+            `snapshot.model`, without a round trip when the model was already resolved
+        """
+        return self.model(model_id=snapshot.model_id)
+
+    def dataset(self, dataset_id):
+        return self._resolve('dataset', ('id', dataset_id), lambda: dl.datasets.get(dataset_id=dataset_id))
+
+    def snapshot_dataset(self, snapshot):
+        """
+            `snapshot.dataset`, without a round trip when the dataset was already resolved
+        """
+        return self.dataset(dataset_id=snapshot.dataset_id)
+
+    @staticmethod
+    def items(item_ids, dataset=None, query_size=DEFAULT_ITEMS_QUERY_SIZE):
+        """
+            Fetch items by ids with one query per `query_size` ids of a dataset, instead of a call per item.
+            The dataset of the ids is that of the first item when not given, the ids of other datasets are
+            fetched the same way. Ids not found (unknown or deleted items) are None in the result
+
+        Args:
+            item_ids (list): items ids, or items (kept as is)
+            dataset (dl.Dataset, optional): dataset of the items. Defaults to None.
+            query_size (int, optional): max number of ids per query. Defaults to 1000.
+
+        Returns:
+            list: dl.Item or None, in the order of `item_ids`
+        """
+        found = {item.id: item for item in item_ids if not isinstance(item, str)}
+        pending = list(dict.fromkeys(item_id for item_id in item_ids if isinstance(item_id, str)))
+        while pending:
+            if dataset is None:
+                try:
+                    first = dl.items.get(item_id=pending[0])
+                except dl.exceptions.NotFound:
+                    logger.warning("Item {!r} not found".format(pending[0]))
+                    pending = pending[1:]
+                    continue
+                found[first.id] = first
+                dataset = first.dataset
+                pending = pending[1:]
+                continue
+            for start in range(0, len(pending), query_size):
+                filters = dl.Filters()
+                filters.add(field='id', values=pending[start:start + query_size], operator=dl.FiltersOperations.IN)
+                for page in dataset.items.list(filters=filters, page_size=query_size):
+                    for item in page:
+                        found[item.id] = item
+            # not in the dataset
+            pending = [item_id for item_id in pending if item_id not in found]
+            dataset = None
+        return [found.get(item) if isinstance(item, str) else item for item in item_ids]
+
+    def stats(self):
+        with self._lock:
+            return {'entities': len({id(entity) for entity, _ in self._entities.values()}),
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+def configure_session(pool_size=DEFAULT_POOL_SIZE):
+    """
+        Make the platform client's session keep `pool_size` connections alive. The client sizes its pool by its
+        own thread pools, the handlers' download / upload threads beyond that open a new connection per call
+    """
+    client_api = getattr(dl, 'client_api', None)
+    if client_api is None or not hasattr(client_api, 'session'):
+        return False
+    try:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        if client_api.session is None:
+            client_api.session = requests.Session()
+            # the client mounts its retrying adapter only on the session it creates itself
+            max_retries = Retry(total=5, read=5, connect=5, backoff_factor=1, allowed_methods=False,
+                                status_forcelist=(501, 502, 503, 504, 505, 506, 507, 508, 510, 511),
+                                raise_on_status=False)
+        else:
+            current = client_api.session.get_adapter('https://')
+            if getattr(current, '_pool_maxsize', 0) >= pool_size:
+                return True
+            max_retries = current.max_retries
+        adapter = HTTPAdapter(max_retries=max_retries,
+                              pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        client_api.session.mount('http://', adapter)
+        client_api.session.mount('https://', adapter)
+    except Exception:
+        logger.exception("Failed configuring the platform client's connections pool")
+        return False
+    logger.info("Platform client keeps up to {} connections alive".format(pool_size))
+    return True
+
+
+entities = EntityResolver()
@@ -0,0 +1,227 @@
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(name=__name__)
+
+DEFAULT_IOU_THRESHOLDS = (0.5,)
+# detection scores are binned, so the precision / recall curves take constant memory whatever the number of items
+DEFAULT_SCORE_BINS = 1000
+BACKGROUND = '__background__'
+
+
+def annotation_fields(annotation):
+    """
+        (type, label, box as [left, top, right, bottom] or None, score) of a platform annotation, of its upload
+        json or of a prediction dict {'type': , 'label': , 'coordinates': , 'confidence': }
+    """
+    if isinstance(annotation, dict):
+        annotation_type = annotation.get('type')
+        label = annotation.get('label')
+        coordinates = annotation.get('coordinates')
+        box = None
+        if annotation_type == 'box' and coordinates:
+            if isinstance(coordinates[0], dict):
+                # upload json: [{'x': left, 'y': top}, {'x': right, 'y': bottom}]
+                box = [coordinates[0]['x'], coordinates[0]['y'], coordinates[1]['x'], coordinates[1]['y']]
+            else:
+                box = list(coordinates)[:4]
+        model = (annotation.get('metadata') or dict()).get('user', dict()).get('model', dict())
+        score = annotation.get('confidence', annotation.get('score', model.get('confidence', 1.0)))
+        return annotation_type, label, box, score
+    annotation_type = getattr(annotation, 'type', None)
+    box = None
+    if annotation_type == 'box':
+        box = [annotation.left, annotation.top, annotation.right, annotation.bottom]
+    metadata = getattr(annotation, 'metadata', None) or dict()
+    score = metadata.get('user', dict()).get('model', dict()).get('confidence', 1.0)
+    return annotation_type, annotation.label, box, score
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """
+        IoU of every pair of [left, top, right, bottom] boxes, shape (len(a), len(b))
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    left = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    top = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    right = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    bottom = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def greedy_match(ious, scores, iou_threshold):
+    """
+        Match predictions to ground truths in descending score order, each ground truth at most once
+
+    Returns:
+        np.ndarray: matched ground truth index per prediction, -1 if unmatched
+    """
+    matches = np.full(ious.shape[0], -1, dtype=np.int64)
+    if ious.shape[1] == 0:
+        return matches
+    available = np.ones(ious.shape[1], dtype=bool)
+    for i_pred in np.argsort(-np.asarray(scores), kind='stable'):
+        candidates = np.where(available, ious[i_pred], -1)
+        i_gt = int(np.argmax(candidates))
+        if candidates[i_gt] >= iou_threshold:
+            matches[i_pred] = i_gt
+            available[i_gt] = False
+    return matches
+
+
+class EvaluationAccumulator:
+    """
+    Streaming detection / classification metrics. Memory is bounded by the number of labels, not of items:
+    per label and IoU threshold, true and false positives are counted in score histograms, from which the
+    precision / recall curves and the APs are computed
+    """
+
+    def __init__(self, iou_thresholds=DEFAULT_IOU_THRESHOLDS, score_threshold=0.5, score_bins=DEFAULT_SCORE_BINS):
+        self.iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+        self.score_threshold = score_threshold
+        self.score_bins = score_bins
+        self.labels = dict()
+        # [label, iou threshold, score bin]
+        self.true_positives = np.zeros((0, len(self.iou_thresholds), score_bins), dtype=np.int64)
+        self.false_positives = np.zeros((0, len(self.iou_thresholds), score_bins), dtype=np.int64)
+        self.ground_truths = np.zeros(0, dtype=np.int64)
+        # [ground truth label, predicted label], the last row / column is the background
+        self.confusion = np.zeros((1, 1), dtype=np.int64)
+        self.items = 0
+        self.correct_items = 0
+        self.classification_items = 0
+
+    def _label_index(self, label):
+        if label not in self.labels:
+            self.labels[label] = len(self.labels)
+            self.true_positives = np.concatenate([self.true_positives, np.zeros((1,) + self.true_positives.shape[1:],
+                                                                                dtype=np.int64)])
+            self.false_positives = np.concatenate([self.false_positives,
+                                                   np.zeros((1,) + self.false_positives.shape[1:], dtype=np.int64)])
+            self.ground_truths = np.append(self.ground_truths, 0)
+            n = len(self.labels)
+            confusion = np.zeros((n + 1, n + 1), dtype=np.int64)
+            # keep the background last
+            confusion[:n - 1, :n - 1] = self.confusion[:-1, :-1]
+            confusion[:n - 1, -1] = self.confusion[:-1, -1]
+            confusion[-1, :n - 1] = self.confusion[-1, :-1]
+            confusion[-1, -1] = self.confusion[-1, -1]
+            self.confusion = confusion
+        return self.labels[label]
+
+    def _score_bins(self, scores):
+        return np.clip((np.asarray(scores, dtype=np.float64) * self.score_bins).astype(np.int64),
+                       0, self.score_bins - 1)
+
+    def add(self, ground_truth, prediction):
+        """
+            Accumulate an item's ground truth and prediction annotations
+        """
+        self.items += 1
+        if hasattr(prediction, 'to_upload_payload'):
+            # columnar predictions
+            prediction = prediction.to_upload_payload()
+        gt_fields = [annotation_fields(annotation) for annotation in ground_truth or list()]
+        pred_fields = [annotation_fields(annotation) for annotation in prediction or list()]
+        gt_classes = [label for annotation_type, label, _, _ in gt_fields if annotation_type == 'class']
+        if gt_classes:
+            self._add_classification(gt_label=gt_classes[0],
+                                     pred_fields=[f for f in pred_fields if f[0] == 'class'])
+        gt_boxes = [f for f in gt_fields if f[2] is not None]
+        pred_boxes = [f for f in pred_fields if f[2] is not None]
+        if gt_boxes or pred_boxes:
+            self._add_detection(gt_boxes=gt_boxes, pred_boxes=pred_boxes)
+
+    def _add_classification(self, gt_label, pred_fields):
+        self.classification_items += 1
+        gt_index = self._label_index(gt_label)
+        if not pred_fields:
+            self.confusion[gt_index, -1] += 1
+            return
+        _, pred_label, _, _ = max(pred_fields, key=lambda f: f[3])
+        pred_index = self._label_index(pred_label)
+        self.confusion[gt_index, pred_index] += 1
+        self.correct_items += int(pred_index == gt_index)
+
+    def _add_detection(self, gt_boxes, pred_boxes):
+        gt_labels = np.array([self._label_index(f[1]) for f in gt_boxes], dtype=np.int64)
+        pred_labels = np.array([self._label_index(f[1]) for f in pred_boxes], dtype=np.int64)
+        scores = np.array([f[3] for f in pred_boxes], dtype=np.float64)
+        ious = iou_matrix([f[2] for f in pred_boxes], [f[2] for f in gt_boxes])
+        np.add.at(self.ground_truths, gt_labels, 1)
+
+        bins = self._score_bins(scores)
+        same_label = pred_labels[:, None] == gt_labels[None, :]
+        for i_threshold, iou_threshold in enumerate(self.iou_thresholds):
+            matches = greedy_match(np.where(same_label, ious, 0), scores=scores, iou_threshold=iou_threshold)
+            matched = matches >= 0
+            np.add.at(self.true_positives[:, i_threshold], (pred_labels[matched], bins[matched]), 1)
+            np.add.at(self.false_positives[:, i_threshold], (pred_labels[~matched], bins[~matched]), 1)
+
+        # class agnostic matching at the first threshold, for the confusion between labels
+        confident = scores >= self.score_threshold
+        matches = greedy_match(ious[confident], scores=scores[confident], iou_threshold=self.iou_thresholds[0])
+        confident_labels = pred_labels[confident]
+        matched = matches >= 0
+        np.add.at(self.confusion, (gt_labels[matches[matched]], confident_labels[matched]), 1)
+        np.add.at(self.confusion, (np.full((~matched).sum(), -1), confident_labels[~matched]), 1)
+        unmatched_gt = np.ones(len(gt_labels), dtype=bool)
+        unmatched_gt[matches[matched]] = False
+        np.add.at(self.confusion, (gt_labels[unmatched_gt], np.full(unmatched_gt.sum(), -1)), 1)
+
+    def average_precisions(self):
+        """
+            [label, iou threshold] 101 points interpolated AP, NaN for labels without ground truth
+        """
+        # descending score order
+        tp = np.cumsum(self.true_positives[:, :, ::-1], axis=-1)
+        fp = np.cumsum(self.false_positives[:, :, ::-1], axis=-1)
+        ground_truths = self.ground_truths[:, None, None]
+        recall = np.divide(tp, ground_truths, out=np.zeros(tp.shape), where=ground_truths > 0)
+        precision = np.divide(tp, tp + fp, out=np.zeros(tp.shape), where=(tp + fp) > 0)
+        # precision envelope: the max precision at any recall >= r
+        precision = np.maximum.accumulate(precision[:, :, ::-1], axis=-1)[:, :, ::-1]
+        recall_points = np.linspace(0, 1, 101)
+        aps = np.full(tp.shape[:2], np.nan)
+        for i_label in range(tp.shape[0]):
+            if self.ground_truths[i_label] == 0:
+                continue
+            for i_threshold in range(tp.shape[1]):
+                indices = np.searchsorted(recall[i_label, i_threshold], recall_points, side='left')
+                valid = indices < recall.shape[-1]
+                values = np.zeros(len(recall_points))
+                values[valid] = precision[i_label, i_threshold, indices[valid]]
+                aps[i_label, i_threshold] = values.mean()
+        return aps
+
+    def summary(self, max_confusion_labels=100):
+        labels = sorted(self.labels, key=self.labels.get)
+        summary = {'items': self.items, 'labels': len(labels)}
+        if self.ground_truths.sum() > 0 or self.false_positives.sum() > 0:
+            aps = self.average_precisions()
+            threshold_bin = int(self.score_threshold * self.score_bins)
+            tp = self.true_positives[:, 0, threshold_bin:].sum()
+            fp = self.false_positives[:, 0, threshold_bin:].sum()
+            summary['detection'] = {
+                'iouThresholds': self.iou_thresholds.tolist(),
+                'scoreThreshold': self.score_threshold,
+                'mAP': float(np.nanmean(aps)) if np.isfinite(aps).any() else None,
+                'mAPPerThreshold': [float(np.nanmean(aps[:, i])) if np.isfinite(aps[:, i]).any() else None
+                                    for i in range(aps.shape[1])],
+                'precision': float(tp / (tp + fp)) if tp + fp > 0 else None,
+                'recall': float(tp / self.ground_truths.sum()) if self.ground_truths.sum() > 0 else None,
+                'apPerLabel': {label: None if np.isnan(aps[i, 0]) else float(aps[i, 0])
+                               for i, label in enumerate(labels)},
+            }
+        if self.classification_items > 0:
+            summary['classification'] = {'items': self.classification_items,
+                                         'accuracy': self.correct_items / self.classification_items}
+        if len(labels) <= max_confusion_labels:
+            summary['confusion'] = {'labels': labels + [BACKGROUND], 'matrix': self.confusion.tolist()}
+        return summary
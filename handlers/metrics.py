@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+import contextlib
+
+logger = logging.getLogger(name=__name__)
+
+# histogram buckets upper bounds, in seconds for timers
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class Histogram:
+    """
+    Fixed buckets histogram with count / sum / min / max
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """
+            Upper bound of the bucket holding the q quantile (max for the overflow bucket)
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i_bucket, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(self.buckets[i_bucket], self.max) if i_bucket < len(self.buckets) else self.max
+        return self.max
+
+    def to_json(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99)}
+
+
+class Metrics:
+    """
+    Timers, counters and histograms of a runner / execution.
+    When disabled every call returns immediately, so instrumented code pays (almost) nothing
+    """
+
+    def __init__(self, enabled=True, name=None):
+        self.enabled = enabled
+        self.name = name
+        self.created_at = time.time()
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._histograms = dict()
+
+    def timer(self, stage):
+        """
+            Context manager recording the block's duration in the `stage` histogram
+        """
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._timer(stage)
+
+    @contextlib.contextmanager
+    def _timer(self, stage):
+        tic = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - tic)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def to_json(self):
+        with self._lock:
+            return {'name': self.name,
+                    'createdAt': self.created_at,
+                    'elapsed': time.time() - self.created_at,
+                    'counters': dict(self._counters),
+                    'histograms': {name: histogram.to_json() for name, histogram in self._histograms.items()}}
+
+    def stages_message(self):
+        """
+            One line summary of the total time of every stage
+        """
+        with self._lock:
+            return ', '.join('{}: {:.2f}s'.format(name, histogram.sum) for name, histogram in self._histograms.items())
+
+    def report(self, progress=None, metrics_path=None):
+        """
+            Push the stages timings to the execution progress, a structured log line and optionally a json file
+        """
+        if not self.enabled:
+            return
+        summary = self.to_json()
+        logger.info("metrics {}".format(json.dumps(summary)))
+        if progress is not None:
+            progress.update(message='timings - {}'.format(self.stages_message()))
+        if metrics_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(metrics_path)), exist_ok=True)
+            with open(metrics_path, 'w') as f:
+                json.dump(summary, f, indent=2)
+        return summary
@@ -0,0 +1,112 @@
+import os
+import json
+import shutil
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(name=__name__)
+
+# directory of the mmap layout inside a cached snapshot's artifacts directory
+LAYOUT_DIRNAME = '.mmap'
+INDEX_FILENAME = 'index.json'
+DATA_FILENAME = 'weights.bin'
+ALIGNMENT = 64
+
+
+def supports_mmap(adapter):
+    """
+        An adapter supports the mmap load mode if it implements both:
+            get_weights_arrays() -> dict of name -> numpy array, the loaded weights
+            load_from_arrays(arrays, local_path) -> load the model using the given (read only) arrays as its
+                                                    weights, without copying them
+        Other adapters fall back to the regular `load`
+    """
+    return callable(getattr(adapter, 'get_weights_arrays', None)) and \
+        callable(getattr(adapter, 'load_from_arrays', None))
+
+
+def layout_path(local_path):
+    return os.path.join(local_path, LAYOUT_DIRNAME)
+
+
+def has_layout(local_path):
+    return os.path.isfile(os.path.join(layout_path(local_path), INDEX_FILENAME))
+
+
+def export_arrays(arrays, local_path):
+    """
+        Write the arrays to a single file, each one contiguous and aligned, with an index of their offsets.
+        Written to a temporary directory and renamed, so concurrent processes never map a partial layout
+    """
+    path = layout_path(local_path)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    index = dict()
+    offset = 0
+    with open(os.path.join(tmp_path, DATA_FILENAME), 'wb') as f:
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            padding = -offset % ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+            index[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            f.write(array.tobytes())
+            offset += array.nbytes
+    with open(os.path.join(tmp_path, INDEX_FILENAME), 'w') as f:
+        json.dump({'size': offset, 'arrays': index}, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process exported it first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return path
+
+
+def map_arrays(local_path):
+    """
+        Read only views of the exported arrays, backed by the shared page cache.
+        Nothing is read until an array is touched
+    """
+    path = layout_path(local_path)
+    with open(os.path.join(path, INDEX_FILENAME), 'r') as f:
+        index = json.load(f)
+    data_path = os.path.join(path, DATA_FILENAME)
+    if os.path.getsize(data_path) != index['size']:
+        raise ValueError('Truncated mmap layout {!r}'.format(path))
+    if index['size'] == 0:
+        return {name: np.empty(entry['shape'], dtype=entry['dtype']) for name, entry in index['arrays'].items()}
+    mapped = np.memmap(data_path, dtype=np.uint8, mode='r')
+    return {name: np.ndarray(shape=tuple(entry['shape']),
+                             dtype=np.dtype(entry['dtype']),
+                             buffer=mapped,
+                             offset=entry['offset'])
+            for name, entry in index['arrays'].items()}
+
+
+def load_mapped(adapter, local_path, loaded=False):
+    """
+        Load the adapter from the mmap layout of the artifacts directory, exporting it first if missing.
+        The first process loads the weights regularly and exports them, then reloads from the mapped file,
+        so every process on the host shares the same page cache pages
+
+    Args:
+        adapter: adapter to load
+        local_path (str): snapshot's artifacts directory
+        loaded (bool, optional): the adapter was already loaded regularly from the directory. Defaults to False.
+
+    Returns:
+        bool: False if the adapter does not support the mmap load mode (and nothing was loaded)
+    """
+    if not supports_mmap(adapter):
+        logger.warning("Adapter {!r} does not support the mmap load mode (get_weights_arrays / load_from_arrays), "
+                       "loading regularly".format(type(adapter).__name__))
+        return False
+    if not has_layout(local_path):
+        if not loaded:
+            adapter.load(local_path=local_path)
+        export_arrays(arrays=adapter.get_weights_arrays(), local_path=local_path)
+        logger.info("Exported the weights to the mmap layout {!r}".format(layout_path(local_path)))
+    adapter.load_from_arrays(arrays=map_arrays(local_path), local_path=local_path)
+    return True
@@ -1,6 +1,36 @@
+import os
+import json
+import time
+import hashlib
 import logging
+import numpy as np
 import dtlpy as dl
 
+from handlers.metrics import Metrics
+from handlers.batching import MicroBatcher
+from handlers.adapter_cache import adapter_cache
+from handlers.entities import DEFAULT_POOL_SIZE, entities
+from handlers.prefetch import PrefetchPipeline, download_item, decode_image
+from handlers.upload import AnnotationUploader
+from handlers.worker_pool import PredictWorkerPool
+from handlers.columnar import COLUMNAR_FORMAT, OUTPUT_FORMATS, to_columnar, upload_payload
+from handlers.evaluation import annotation_fields
+from handlers.video import DEFAULT_LOOKAHEAD, FrameStream, dhash, hamming, item_video_info
+from handlers.sharding import (DEFAULT_SHARD_PAGE_SIZE, MIN_COORDINATED_CAPACITY, LocalShardExecutor,
+                               ServiceShardExecutor, ShardedPrediction, service_capacity, shard_items)
+from handlers.prediction_cache import PredictionCache, content_hash, serialize, deserialize
+
+# number of items fetched per page when listing a dataset for batched prediction
+DEFAULT_PAGE_SIZE = 100
+# input size of the synthetic warm-up images when the configuration has no `input_size`
+DEFAULT_WARMUP_INPUT_SIZE = (640, 640)
+# frame annotations uploaded per request when predicting a video
+DEFAULT_VIDEO_UPLOAD_CHUNK = 1000
+# failed items ids listed in a shard's report
+MAX_REPORTED_FAILED_ITEMS = 100
+# arguments of ColumnarPredictions.postprocess accepted in the `postprocess` init input
+POSTPROCESS_KEYS = ('score_threshold', 'labels', 'nms_iou_threshold', 'class_agnostic_nms', 'top_k')
+
 logger = logging.getLogger(name=__name__)
 
 
@@ -12,46 +42,914 @@ class ServiceRunner(dl.BaseServiceRunner):
     def __init__(self,
                  project_id=None, project_name=None,
                  model_id=None, model_name=None,
-                 snapshot_name=None, snapshot_id=None):
+                 snapshot_name=None, snapshot_id=None,
+                 max_batch_size=1, max_wait_ms=10,
+                 max_resident_adapters=None, max_resident_memory_mb=None,
+                 prefetch_depth=0, download_workers=4,
+                 upload_workers=0,
+                 metrics=False, metrics_path=None,
+                 warmup=True, warmup_iterations=2,
+                 prediction_cache=False, prediction_cache_max_size_mb=512,
+                 load_mode='default', onnx_intra_op_threads=None,
+                 worker_processes=0, worker_dispatch='least_loaded',
+                 postprocess=None):
+        """
+        Args:
+            max_batch_size (int, optional): max number of concurrent predict_item calls merged into a single
+                                            adapter call. 1 disables the merging. Defaults to 1.
+            max_wait_ms (float, optional): max time a predict_item call waits for others to join its batch.
+                                           Defaults to 10. Merged image items are downloaded and decoded by
+                                           their own calls, only the forward pass is batched.
+            max_resident_adapters (int, optional): max number of snapshots adapters kept loaded for predictions
+                                                   with a `snapshot_id`. Defaults to None (unbounded).
+            max_resident_memory_mb (float, optional): memory budget of the loaded adapters, estimated by their
+                                                      artifacts size. Defaults to None (unbounded).
+            prefetch_depth (int, optional): number of items downloaded and decoded ahead of the model in batch
+                                            predictions. 0 lets the adapter download the items. Defaults to 0.
+            download_workers (int, optional): number of concurrent downloads when prefetching. Defaults to 4.
+            upload_workers (int, optional): number of background annotation upload threads. 0 uploads in the
+                                            predicting call. Defaults to 0.
+            metrics (bool, optional): record stages timings and counters. Defaults to False.
+            metrics_path (str, optional): directory for a json metrics file per batch execution. Defaults to None.
+            warmup (bool, optional): run synthetic inputs through the adapter before the runner is ready, so the
+                                     first requests do not pay the lazy initializations. Defaults to True.
+            warmup_iterations (int, optional): number of warm-up forward passes. Defaults to 2.
+            prediction_cache (bool, optional): reuse the predictions of items whose binary did not change, keyed by
+                                               snapshot, snapshot version and item content. Defaults to False.
+            prediction_cache_max_size_mb (float, optional): prediction cache size limit. Defaults to 512.
+            load_mode (str, optional): 'default' - the adapter's `load`, 'mmap' - the weights are mapped read only
+                                       from the local artifacts cache, shared by the replicas on the host and paged
+                                       in on first touch. Needs adapter support, others load regularly (see
+                                       handlers/mmap_weights.py). 'onnx' - the snapshot's onnx artifact exported by
+                                       the train service's `export_onnx`, run by onnxruntime (snapshots without one
+                                       load regularly). Defaults to 'default'.
+            onnx_intra_op_threads (int, optional): onnxruntime intra op threads of the 'onnx' load mode, per worker
+                                                   process. Defaults to None (onnxruntime's default, all cores).
+            worker_processes (int, optional): number of worker processes, each with its own adapter, running the
+                                              forward passes of image items of the service's snapshot. The items are
+                                              decoded in the runner and passed through shared memory. The runner
+                                              keeps its own adapter: K + 1 copies of the weights in memory, unless
+                                              mapped with `load_mode='mmap'`.
+                                              0 predicts in the runner's process. Defaults to 0.
+            worker_dispatch (str, optional): 'least_loaded' or 'round_robin'. Defaults to 'least_loaded'.
+            postprocess (dict, optional): vectorized filtering of the box predictions before they are uploaded or
+                                          returned, with any of: score_threshold, labels, nms_iou_threshold,
+                                          class_agnostic_nms, top_k. Defaults to None.
+        """
+        self.ready = False
+        self.warmup_duration = None
+        self.metrics = Metrics(enabled=bool(metrics), name='predict-runner')
+        self.metrics_path = metrics_path
+        self._project_kwargs = dict(project_name=project_name, project_id=project_id)
+        self.prefetch_depth = int(prefetch_depth or 0)
+        self.download_workers = download_workers
+        # a keep-alive connection for each of the threads calling the platform
+        entities.configure(pool_size=max(DEFAULT_POOL_SIZE, int(download_workers) + int(upload_workers or 0)))
+        if postprocess is not None:
+            unknown = set(postprocess) - set(POSTPROCESS_KEYS)
+            if unknown:
+                raise ValueError('Unknown postprocess arguments {}, expected any of {}'.format(sorted(unknown),
+                                                                                               POSTPROCESS_KEYS))
+        self.postprocess = postprocess or None
+        adapter_cache.configure(max_adapters=max_resident_adapters,
+                                max_memory_mb=max_resident_memory_mb,
+                                load_mode=load_mode,
+                                intra_op_threads=onnx_intra_op_threads)
+
+        with self.metrics.timer('init'):
+            self._load_default_adapter(model_id=model_id, model_name=model_name,
+                                       snapshot_id=snapshot_id, snapshot_name=snapshot_name)
+        self.metrics.report()
+
+        self.worker_pool = None
+        if worker_processes is not None and int(worker_processes) > 0:
+            logger.info("Starting {n} predict worker processes".format(n=worker_processes))
+            with self.metrics.timer('workers_start'):
+                self.worker_pool = PredictWorkerPool(
+                    workers=int(worker_processes),
+                    loader_kwargs={'model_id': self.adapter.model_entity.id,
+                                   'snapshot_id': self.snapshot_id,
+                                   'load_mode': load_mode,
+                                   'intra_op_threads': onnx_intra_op_threads},
+                    dispatch=worker_dispatch,
+                    warmup_input=self.synthetic_input(adapter=self.adapter) if warmup else None)
+
+        self.batcher = None
+        if max_batch_size is not None and int(max_batch_size) > 1:
+            logger.info("Merging concurrent predictions: max batch {b}, max wait {w}ms".
+                        format(b=max_batch_size, w=max_wait_ms))
+            self.batcher = MicroBatcher(predict_fn=self._predict_batch,
+                                        max_batch_size=max_batch_size,
+                                        max_wait_ms=max_wait_ms)
+
+        self.uploader = None
+        if upload_workers is not None and int(upload_workers) > 0:
+            self.uploader = AnnotationUploader(workers=upload_workers)
+
+        self.prediction_cache = None
+        if prediction_cache:
+            self.prediction_cache = PredictionCache(max_size_mb=prediction_cache_max_size_mb)
+            if getattr(self.adapter, 'snapshot', None) is not None:
+                self.prediction_cache.invalidate_snapshot(snapshot=self.adapter.snapshot)
+
+        # an adapter from the in-process cache is already warm, the workers warm up their own
+        if warmup and not self._adapter_was_resident and self.worker_pool is None:
+            self.warmup(iterations=warmup_iterations,
+                        batch_size=self.batcher.max_batch_size if self.batcher is not None else 1)
+        self.ready = True
+        logger.info("Predict runner is ready")
+
+    def _load_default_adapter(self, model_id=None, model_name=None, snapshot_id=None, snapshot_name=None):
+        adapter = None
+        snapshot = None
+        if snapshot_id is not None:
+            # the only round trip needed when the adapter was already loaded in this process
+            snapshot = entities.snapshot(snapshot_id=snapshot_id)
+            adapter = adapter_cache.get(model_id=snapshot.model_id, snapshot=snapshot)
+
+        was_resident = adapter is not None
+        if adapter is None and snapshot is not None:
+            # after a restart, the model and its codebase come from the disk tier as well
+            adapter = adapter_cache.restore(snapshot=snapshot)
+        if adapter is None:
+            if model_id is None and model_name is None and snapshot is not None:
+                model = entities.snapshot_model(snapshot)
+            else:
+                model = entities.model(model_id=model_id, model_name=model_name, **self._project_kwargs)
+
+            if snapshot is None and snapshot_name is not None:
+                snapshot = entities.snapshot(snapshot_name=snapshot_name, model=model)
+
+            adapter = adapter_cache.load(model=model, snapshot=snapshot)
+        elif was_resident:
+            logger.info("Using cached adapter of snapshot {n} ({i!r})".format(n=snapshot.name, i=snapshot.id))
+        self._adapter_was_resident = was_resident
+        self.adapter = adapter
+        self.snapshot_id = snapshot.id if snapshot is not None else None
+        adapter_cache.pin(model_id=adapter.model_entity.id, snapshot=snapshot)
+
+    @staticmethod
+    def synthetic_input(adapter):
+        """
+            A synthetic input matching the model's input type, or None if the type is not supported
         """
+        input_type = adapter.model_entity.input_type
+        if input_type == 'image':
+            configuration = getattr(adapter, 'configuration', None) or dict()
+            height, width = configuration.get('input_size', DEFAULT_WARMUP_INPUT_SIZE)[:2]
+            return np.random.randint(0, 255, size=(height, width, 3), dtype=np.uint8)
+        if input_type == 'text':
+            return 'warm up'
+        return None
 
+    def warmup(self, iterations=2, batch_size=1, adapter=None):
         """
-        # get elements
-        self.project = dl.projects.get(project_name=project_name, project_id=project_id)
+            Run synthetic forward passes (graph compilation, allocator growth, threads spin up)
 
+        Returns:
+            float: warm-up duration in seconds, None if skipped
+        """
+        if adapter is None:
+            adapter = self.adapter
+        sample = self.synthetic_input(adapter=adapter)
+        if sample is None:
+            logger.info("No synthetic input for input type {!r}, skipping warm-up".
+                        format(adapter.model_entity.input_type))
+            return None
+        tic = time.perf_counter()
         try:
-            model = self.project.models.get(model_name=model_name, model_id=model_id)
-        except dl.exceptions.NotFound:
-            logger.debug("Model not found in project")
-            model = dl.models.get(model_name=model_name, model_id=model_id)
+            with self.metrics.timer('warmup'):
+                for _ in range(max(int(iterations), 1)):
+                    adapter.predict([sample] * max(int(batch_size), 1))
+        except Exception:
+            # a model that cannot digest synthetic inputs still serves real ones
+            logger.exception("Warm-up failed, serving without it")
+            return None
+        self.warmup_duration = time.perf_counter() - tic
+        logger.info("Warm-up of {n} iterations (batch {b}) took {t:.2f}s".
+                    format(n=iterations, b=batch_size, t=self.warmup_duration))
+        return self.warmup_duration
 
-        if snapshot_id is not None or snapshot_name is not None:
-            snapshot = model.snapshots.get(snapshot_id=snapshot_id, snapshot_name=snapshot_name)
-        else:
-            snapshot = None
+    @property
+    def project(self):
+        return entities.project(**self._project_kwargs)
 
-        logger.info("Building Model {n} ({i!r})".format(n=model.name, i=model.id))
-        adapter = model.build()
+    @staticmethod
+    def _get_snapshot(snapshot_id):
+        return entities.snapshot(snapshot_id=snapshot_id)
 
-        if snapshot is not None:
-            logger.info("Loading Adapter with: {n} ({i!r})".format(n=snapshot.name, i=snapshot.id))
-            logger.debug("Snapshot\n{}\n{}".format('=' * 8, snapshot.print(to_return=True)))
-            adapter.load_from_snapshot(snapshot)
-        self.adapter = adapter
+    def get_adapter(self, snapshot_id=None):
+        """
+            The adapter of the requested snapshot, built and loaded on first use.
+            Defaults to the service's snapshot
+        """
+        if snapshot_id is None or snapshot_id == self.snapshot_id:
+            return self.adapter
+        snapshot = self._get_snapshot(snapshot_id=snapshot_id)
+        adapter = adapter_cache.get(model_id=snapshot.model_id, snapshot=snapshot)
+        if adapter is None:
+            adapter = adapter_cache.load(model=entities.snapshot_model(snapshot), snapshot=snapshot)
+        return adapter
+
+    def _predict_batch(self, entries, with_upload=True, snapshot_id=None):
+        return self._predict_entries(adapter=self.get_adapter(snapshot_id=snapshot_id),
+                                     entries=entries,
+                                     with_upload=with_upload)
+
+    def predict_item(self, item: dl.Item, with_upload=True, with_return=False, snapshot_id=None,
+                     wait_for_upload=False, output_format='annotations', video_options=None,
+                     progress: dl.Progress = None, context: dl.Context = None):
+        """
+            Predict a single item.
+            With metrics enabled, the download, decode, forward pass and upload timings of the call are reported to
+            the progress, the log and the metrics directory
 
-    def predict_item(self, item: dl.Item, with_upload=True, with_return=False):
+        Args:
+            item (dl.Item): item to predict
+            with_upload (bool, optional): upload the predictions as annotations. Defaults to True.
+            with_return (bool, optional): return the predictions. Defaults to False.
+            snapshot_id (str, optional): snapshot to predict with. Defaults to None (the service's snapshot).
+            wait_for_upload (bool, optional): with background uploads, return only after the annotations are
+                                              uploaded. Defaults to False (fire and forget).
+            output_format (str, optional): 'annotations' - the adapter's predictions, 'columnar' - the box
+                                           predictions as ColumnarPredictions arrays. Defaults to 'annotations'.
+            video_options (dict, optional): arguments of `predict_video_item`, for video items of image models.
+                                            Defaults to None.
+            progress (dl.Progress, optional): execution progress. Defaults to None.
+        """
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('Unknown output format {!r}, expected one of {}'.format(output_format, OUTPUT_FORMATS))
         item_mime_type = item.mimetype.split('/')[0]
-        model = self.adapter.model_entity
+        adapter = self.get_adapter(snapshot_id=snapshot_id)
+        model = adapter.model_entity
+
+        if item_mime_type == 'video' and model.input_type == 'image':
+            # the image model runs on the video's frames
+            return self.predict_video_item(item=item,
+                                           with_upload=with_upload,
+                                           with_return=with_return,
+                                           snapshot_id=snapshot_id,
+                                           **(video_options or dict()))
 
         if item_mime_type != model.input_type:
             raise ValueError("Trying to predict item of type {item_t} While the model works on {model_t}".
                              format(item_t=item_mime_type, model_t=model.input_type))
 
-        predictions = self.adapter.predict_items(items=[item],
-                                                 with_upload=with_upload)
+        metrics = Metrics(enabled=self.metrics.enabled, name='predict-item')
+        tic = time.perf_counter()
+        buffer = None
+        array = None
+        cache_key = self._prediction_cache_key(adapter=adapter, item=item)
+        prediction = self._cached_prediction(cache_key=cache_key, item=item)
+        if prediction is None and model.input_type == 'image':
+            # download in the calling thread: timed apart from the forward pass, and concurrent calls download
+            # while the model runs
+            with metrics.timer('download'):
+                buffer = download_item(item)
+            if cache_key is None:
+                # the content hash is known only after the download
+                cache_key = self._prediction_cache_key(adapter=adapter, item=item, buffer=buffer)
+                prediction = self._cached_prediction(cache_key=cache_key, item=item)
+        upload_in_adapter = with_upload and self.uploader is None and cache_key is None
+        if prediction is None:
+            if buffer is not None:
+                with metrics.timer('decode'):
+                    array = decode_image(buffer)
+            if self.batcher is not None:
+                # the batch stages are timed in the runner's metrics
+                with metrics.timer('batch'):
+                    prediction = self.batcher.predict((item, array), with_upload=upload_in_adapter,
+                                                      snapshot_id=snapshot_id)
+            else:
+                prediction = self._predict_entries(adapter=adapter,
+                                                   entries=[(item, array)],
+                                                   with_upload=upload_in_adapter,
+                                                   metrics=metrics)[0]
+            if cache_key is not None:
+                self.prediction_cache.put(key=cache_key, snapshot=adapter.snapshot, payload=serialize(prediction))
+        if output_format == COLUMNAR_FORMAT:
+            columnar = to_columnar(prediction, model_name=model.name)
+            if columnar is None:
+                raise ValueError('Columnar output supports box predictions only, item {!r} has others'.
+                                 format(item.id))
+            prediction = columnar
+        predictions = [prediction]
+        if with_upload and not upload_in_adapter:
+            future = self._upload_prediction(item=item, prediction=prediction, cache_key=cache_key, metrics=metrics)
+            if future is not None and wait_for_upload:
+                with metrics.timer('upload_wait'):
+                    future.result()
+        elapsed = time.perf_counter() - tic
+        metrics.observe('execution', elapsed)
+        metrics.report(progress=progress, metrics_path=self._metrics_filepath(context=context, prefix='predict-item'))
+        self.metrics.observe('predict_item', elapsed)
+        self.metrics.count('items')
         if with_return:
             return predictions
 
+    def predict_video_item(self, item: dl.Item, stride=1, fps=None, batch_size=8, skip_duplicates=False,
+                           duplicate_threshold=4, lookahead=DEFAULT_LOOKAHEAD, with_upload=True, with_return=False,
+                           snapshot_id=None, progress: dl.Progress = None, context: dl.Context = None):
+        """
+            Predict the frames of a video item with an image model. The frames are decoded from the item's stream
+            (no download of the file) with a bounded lookahead, and the frame annotations are uploaded in chunks,
+            so the memory does not grow with the video length
+
+        Args:
+            item (dl.Item): video item
+            stride (int, optional): predict one frame out of `stride`. Defaults to 1.
+            fps (float, optional): predict frames sampled at this rate, instead of a stride. Defaults to None.
+            batch_size (int, optional): number of frames in each adapter call. Defaults to 8.
+            skip_duplicates (bool, optional): do not predict frames nearly identical to the last predicted one
+                                              (by difference hash), its annotations are extended over them instead.
+                                              Defaults to False.
+            duplicate_threshold (int, optional): max number of different bits (of 64) of the hash of a duplicate
+                                                 frame. Defaults to 4.
+            lookahead (int, optional): max number of decoded frames waiting for the model. Defaults to 32.
+            with_upload (bool, optional): upload the frame annotations. Defaults to True.
+            with_return (bool, optional): add the frames predictions to the returned report. Defaults to False.
+            snapshot_id (str, optional): snapshot to predict with. Defaults to None (the service's snapshot).
+            progress (dl.Progress, optional): execution progress. Defaults to None.
+
+        Returns:
+            dict: report with the numbers of sampled, predicted and skipped frames and of annotations
+        """
+        tic = time.perf_counter()
+        adapter = self.get_adapter(snapshot_id=snapshot_id)
+        model = adapter.model_entity
+        if model.input_type != 'image':
+            raise ValueError("Frame prediction needs an image model, {!r} works on {}".format(model.name,
+                                                                                              model.input_type))
+        source = getattr(item, 'resolved_stream', None) or item.stream
+        # the token goes to the platform only, not to the url of a linked item
+        headers = {'Authorization': 'Bearer {}'.format(dl.token())} if source == item.stream else None
+        info = item_video_info(item=item, source=source, headers=headers)
+        stream = FrameStream(source=source,
+                             width=info['width'],
+                             height=info['height'],
+                             stride=stride,
+                             fps=fps,
+                             source_fps=info['fps'],
+                             lookahead=lookahead,
+                             headers=headers)
+        logger.info("Predicting video {i!r} ({w}x{h}, {f} frames at {r} fps), stride {s}, fps {p}".
+                    format(i=item.id, w=info['width'], h=info['height'], f=info['frames'], r=info['fps'],
+                           s=stride, p=fps))
+        report = {'sampledFrames': 0, 'predictedFrames': 0, 'skippedFrames': 0, 'annotations': 0,
+                  'skippedAnnotations': 0}
+        frames_predictions = list() if with_return else None
+        uploads = list()
+        builder = item.annotations.builder()
+
+        def upload(force=False):
+            nonlocal builder
+            if len(builder) == 0 or (not force and len(builder) < DEFAULT_VIDEO_UPLOAD_CHUNK):
+                return
+            if with_upload:
+                if self.uploader is not None:
+                    uploads.append(self.uploader.submit(item=item, annotations=builder))
+                else:
+                    with self.metrics.timer('upload'):
+                        item.annotations.upload(builder)
+            builder = item.annotations.builder()
+
+        def write(record):
+            # record: [first frame, last frame, array, prediction]
+            first_frame, last_frame, _, prediction = record
+            annotations = upload_payload(prediction)
+            for annotation_type, label, box, score in (annotation_fields(annotation) for annotation in
+                                                       getattr(annotations, 'annotations', annotations)):
+                if annotation_type == 'box' and box is not None:
+                    definition = dl.Box(left=box[0], top=box[1], right=box[2], bottom=box[3], label=label)
+                elif annotation_type == 'class':
+                    definition = dl.Classification(label=label)
+                else:
+                    report['skippedAnnotations'] += 1
+                    continue
+                builder.add(annotation_definition=definition,
+                            frame_num=first_frame,
+                            end_frame_num=last_frame,
+                            metadata={'user': {'model': {'name': model.name, 'confidence': score}}})
+                report['annotations'] += 1
+            if frames_predictions is not None:
+                frames_predictions.append({'frame': first_frame,
+                                           'endFrame': last_frame,
+                                           'prediction': prediction.to_json() if hasattr(prediction, 'to_json')
+                                           else prediction})
+            upload()
+
+        def run_batch(batch):
+            predictions = self._predict_entries(adapter=adapter,
+                                                entries=[(item, record[2]) for record in batch],
+                                                with_upload=False)
+            for record, prediction in zip(batch, predictions):
+                record[2] = None
+                record[3] = prediction
+            report['predictedFrames'] += len(batch)
+            if progress is not None and info['frames']:
+                progress.update(progress=int(100 * min(batch[-1][1] / info['frames'], 1)),
+                                message='predicted frames: {}/{}'.format(batch[-1][1], info['frames']))
+
+        batch = list()
+        # predicted, not written until its last (duplicate) frame is known
+        pending = None
+        last_hash = None
+        for frame_index, frame in stream:
+            report['sampledFrames'] += 1
+            if skip_duplicates:
+                frame_hash = dhash(frame)
+                if last_hash is not None and hamming(frame_hash, last_hash) <= duplicate_threshold:
+                    (batch[-1] if batch else pending)[1] = frame_index
+                    report['skippedFrames'] += 1
+                    continue
+                last_hash = frame_hash
+            if pending is not None:
+                write(pending)
+                pending = None
+            batch.append([frame_index, frame_index, frame, None])
+            if len(batch) == max(int(batch_size), 1):
+                run_batch(batch)
+                for record in batch[:-1]:
+                    write(record)
+                pending = batch[-1]
+                batch = list()
+        if batch:
+            run_batch(batch)
+            for record in batch:
+                write(record)
+        if pending is not None:
+            write(pending)
+        upload(force=True)
+        for future in uploads:
+            with self.metrics.timer('upload_wait'):
+                future.result()
+
+        report['elapsed_s'] = time.perf_counter() - tic
+        report['framesPerSecond'] = report['sampledFrames'] / report['elapsed_s'] if report['elapsed_s'] > 0 else None
+        logger.info("Predicted video {i!r}: {r}".format(i=item.id, r=report))
+        self.metrics.count('video_frames', report['sampledFrames'])
+        if frames_predictions is not None:
+            report['frames'] = frames_predictions
+        return report
+
+    def predict_items(self, items: list, batch_size=16, with_upload=True, with_return=False, snapshot_id=None,
+                      progress: dl.Progress = None, context: dl.Context = None):
+        """
+            Predict a list of items in micro batches
+
+        Args:
+            items (list): list of dl.Item or item ids
+            batch_size (int, optional): number of items in each adapter call. Defaults to 16.
+            with_upload (bool, optional): upload the predictions as annotations. Defaults to True.
+            with_return (bool, optional): add the predictions to the returned report. Defaults to False.
+            snapshot_id (str, optional): snapshot to predict with. Defaults to None (the service's snapshot).
+            progress (dl.Progress, optional): execution progress. Defaults to None.
+
+        Returns:
+            dict: report with the success / failure status of each item id, unknown ids failed as not found
+        """
+        # one query for all the ids instead of a call per item
+        resolved = entities.items(item_ids=items)
+        missing = [item_id for item_id, item in zip(items, resolved) if item is None]
+        resolved = [item for item in resolved if item is not None]
+        report = self._predict_in_batches(adapter=self.get_adapter(snapshot_id=snapshot_id),
+                                          pages=[resolved],
+                                          total=len(resolved),
+                                          batch_size=batch_size,
+                                          with_upload=with_upload,
+                                          with_return=with_return,
+                                          progress=progress,
+                                          context=context)
+        for item_id in dict.fromkeys(missing):
+            report['failed'] += 1
+            report['items'][item_id] = {'status': 'failed', 'error': 'item not found'}
+        return report
+
+    def predict_dataset(self, dataset: dl.Dataset, filters=None, batch_size=16, with_upload=True,
+                        with_return=False, snapshot_id=None,
+                        progress: dl.Progress = None, context: dl.Context = None):
+        """
+            Predict all items of a dataset (or a filtered query of it) in micro batches
+
+        Args:
+            dataset (dl.Dataset): dataset to predict
+            filters (dl.Filters, optional): items query. dict is used as a custom filter. Defaults to None.
+            batch_size (int, optional): number of items in each adapter call. Defaults to 16.
+            with_upload (bool, optional): upload the predictions as annotations. Defaults to True.
+            with_return (bool, optional): add the predictions to the returned report. Defaults to False.
+            snapshot_id (str, optional): snapshot to predict with. Defaults to None (the service's snapshot).
+            progress (dl.Progress, optional): execution progress. Defaults to None.
+
+        Returns:
+            dict: report with the success / failure status of each item id
+        """
+        if isinstance(filters, dict):
+            t_filters = filters
+            filters = dl.Filters()
+            filters.custom_filter = t_filters
+        if filters is None:
+            filters = dl.Filters()
+        pages = dataset.items.list(filters=filters, page_size=DEFAULT_PAGE_SIZE)
+        logger.info("Received dataset {d!r} with {n} items to predict".format(d=dataset.id, n=pages.items_count))
+        return self._predict_in_batches(adapter=self.get_adapter(snapshot_id=snapshot_id),
+                                        pages=pages,
+                                        total=pages.items_count,
+                                        batch_size=batch_size,
+                                        with_upload=with_upload,
+                                        with_return=with_return,
+                                        progress=progress,
+                                        context=context)
+
+    def predict_shard(self, dataset: dl.Dataset, shard, num_shards, shard_by='page_range', filters=None,
+                      page_size=DEFAULT_SHARD_PAGE_SIZE, batch_size=16, with_upload=True, snapshot_id=None,
+                      progress: dl.Progress = None, context: dl.Context = None):
+        """
+            Predict one of the deterministic shards of a dataset query, as fanned out by predict_dataset_sharded
+
+        Args:
+            dataset (dl.Dataset): dataset to predict
+            shard (int): index of the shard
+            num_shards (int): number of shards
+            shard_by (str, optional): 'page_range' - contiguous pages of the query sorted by id, 'id_hash' - the items
+                                      whose id hashes to the shard. Defaults to 'page_range'.
+            filters (dict, optional): items query, used as a custom filter. Defaults to None.
+            page_size (int, optional): items per page. Defaults to 100.
+            batch_size (int, optional): number of items in each adapter call. Defaults to 16.
+            with_upload (bool, optional): upload the predictions as annotations. Defaults to True.
+            snapshot_id (str, optional): snapshot to predict with. Defaults to None (the service's snapshot).
+            progress (dl.Progress, optional): execution progress. Defaults to None.
+
+        Returns:
+            dict: number of items, successes and failures of the shard, with its duration and throughput
+        """
+        tic = time.perf_counter()
+        pages, total = shard_items(dataset=dataset, shard=int(shard), num_shards=int(num_shards), shard_by=shard_by,
+                                   filters=filters, page_size=int(page_size))
+        logger.info("Predicting shard {s}/{n} of dataset {d!r}: {t} items".format(
+            s=shard, n=num_shards, d=dataset.id, t=total if total is not None else 'unknown number of'))
+        report = self._predict_in_batches(adapter=self.get_adapter(snapshot_id=snapshot_id),
+                                          pages=pages,
+                                          total=total,
+                                          batch_size=batch_size,
+                                          with_upload=with_upload,
+                                          with_return=False,
+                                          progress=progress,
+                                          context=context)
+        elapsed = time.perf_counter() - tic
+        n_items = report['success'] + report['failed']
+        # the items statuses of a shard would not fit an execution output
+        return {'shard': int(shard),
+                'items': n_items,
+                'success': report['success'],
+                'failed': report['failed'],
+                'failedItems': [item_id for item_id, status in report['items'].items()
+                                if status['status'] == 'failed'][:MAX_REPORTED_FAILED_ITEMS],
+                'elapsedSeconds': elapsed,
+                'itemsPerSecond': n_items / elapsed if elapsed > 0 else None}
+
+    def predict_dataset_sharded(self, dataset: dl.Dataset, num_shards=8, shard_by='page_range', filters=None,
+                                batch_size=16, with_upload=True, snapshot_id=None, run_id=None,
+                                max_parallel=None, max_attempts=3, poll_interval_s=5, shard_timeout_s=None,
+                                local_workers=0, service_id=None,
+                                progress: dl.Progress = None, context: dl.Context = None):
+        """
+            Predict a large dataset query as deterministic shards run by the predict service's replicas (one
+            predict_shard execution each), tracked in a run record in the dataset's metadata.
+            Resuming a run (same `run_id`) runs again only the shards that did not succeed
+
+            this execution waits for the shards: when they run in its own service, the service must run at least
+            2 executions at once (concurrency x max replicas), else the shards never start
+
+        Args:
+            dataset (dl.Dataset): dataset to predict
+            num_shards (int, optional): number of shards. Defaults to 8.
+            shard_by (str, optional): 'page_range' or 'id_hash' (see predict_shard). Defaults to 'page_range'.
+            filters (dict, optional): items query, used as a custom filter. Defaults to None.
+            batch_size (int, optional): number of items in each adapter call. Defaults to 16.
+            with_upload (bool, optional): upload the predictions as annotations. Defaults to True.
+            snapshot_id (str, optional): snapshot to predict with. Defaults to None (the service's snapshot).
+            run_id (str, optional): run to resume. Defaults to None (a new run).
+            max_parallel (int, optional): max number of shards running at once. Defaults to None (all).
+            max_attempts (int, optional): runs of a failing shard before it is given up. Defaults to 3.
+            poll_interval_s (float, optional): seconds between polls of the shards executions. Defaults to 5.
+            shard_timeout_s (float, optional): a shard running longer is terminated and retried. Defaults to None.
+            local_workers (int, optional): run the shards in this many local processes instead of the service's
+                                           executions, for testing. Defaults to 0.
+            service_id (str, optional): service running the shards. Defaults to None (the context's service).
+            progress (dl.Progress, optional): execution progress. Defaults to None.
+
+        Returns:
+            dict: the run's id, status, failed shards, aggregate throughput and stragglers
+        """
+        if local_workers is not None and int(local_workers) > 0:
+            executor = LocalShardExecutor(runner_kwargs={'model_id': self.adapter.model_entity.id,
+                                                         'snapshot_id': self.snapshot_id,
+                                                         'prefetch_depth': self.prefetch_depth,
+                                                         'download_workers': self.download_workers,
+                                                         'postprocess': self.postprocess,
+                                                         'warmup': False},
+                                          workers=int(local_workers))
+        else:
+            own_service = context.service if context is not None else None
+            service = dl.services.get(service_id=service_id) if service_id is not None else own_service
+            if service is None:
+                raise ValueError('No service to run the shards: pass service_id, '
+                                 'or local_workers to run them locally')
+            if own_service is not None and service.id == own_service.id and \
+                    service_capacity(service) < MIN_COORDINATED_CAPACITY:
+                raise ValueError('Service {!r} runs {} execution(s) at once, held by this coordinator: the shards '
+                                 'would never run. Deploy it with concurrency x max replicas >= {}, or run the '
+                                 'shards in another service (service_id)'.format(service.name,
+                                                                                 service_capacity(service),
+                                                                                 MIN_COORDINATED_CAPACITY))
+            executor = ServiceShardExecutor(service=service)
+        coordinator = ShardedPrediction(executor=executor,
+                                        dataset=dataset,
+                                        num_shards=num_shards,
+                                        shard_by=shard_by,
+                                        filters=filters,
+                                        shard_kwargs={'batch_size': batch_size,
+                                                      'with_upload': with_upload,
+                                                      'snapshot_id': snapshot_id},
+                                        run_id=run_id,
+                                        max_parallel=max_parallel,
+                                        max_attempts=max_attempts,
+                                        poll_interval_s=poll_interval_s,
+                                        shard_timeout_s=shard_timeout_s)
+        try:
+            return coordinator.run(progress=progress)
+        finally:
+            executor.close()
+
+    def _predict_in_batches(self, adapter, pages, total, batch_size, with_upload, with_return,
+                            progress=None, context=None):
+        """
+            Feed the items of the pages to the adapter in batches of `batch_size`.
+            A failing batch is retried item by item so a single bad item fails alone
+        """
+        metrics = Metrics(enabled=self.metrics.enabled, name='predict-batch')
+        tic = time.perf_counter()
+        batch_size = max(int(batch_size), 1)
+        model = adapter.model_entity
+        # with background uploads or a prediction cache the uploads are made here, not in the adapter
+        upload_in_adapter = with_upload and self.uploader is None and self.prediction_cache is None
+        uploads = dict()
+        content_hashes = dict()
+        cache_keys = dict()
+        report = {'success': 0, 'failed': 0, 'items': dict()}
+
+        def mark(item, error=None, prediction=None):
+            status = {'status': 'failed' if error is not None else 'success'}
+            if error is not None:
+                status['error'] = str(error)
+                report['failed'] += 1
+            else:
+                report['success'] += 1
+            if with_return and prediction is not None:
+                status['prediction'] = prediction.to_json() if hasattr(prediction, 'to_json') else prediction
+            report['items'][item.id] = status
+
+        def done(item, prediction, cache_key=None, from_cache=False):
+            if cache_key is not None and not from_cache:
+                self.prediction_cache.put(key=cache_key, snapshot=adapter.snapshot, payload=serialize(prediction))
+            if with_upload and not upload_in_adapter:
+                try:
+                    future = self._upload_prediction(item=item, prediction=prediction, cache_key=cache_key)
+                except Exception as err:
+                    mark(item, error='upload failed: {}'.format(err))
+                    return
+                if future is not None:
+                    uploads[item.id] = future
+            mark(item, prediction=prediction)
+
+        def item_cache_key(item):
+            return self._prediction_cache_key(adapter=adapter, item=item, content=content_hashes.pop(item.id, None))
+
+        def run_batch(batch):
+            try:
+                predictions = self._predict_entries(adapter=adapter, entries=batch, with_upload=upload_in_adapter,
+                                                    metrics=metrics)
+            except Exception:
+                logger.exception("Batch of {} items failed, retrying item by item".format(len(batch)))
+                for entry in batch:
+                    try:
+                        prediction = self._predict_entries(adapter=adapter, entries=[entry],
+                                                           with_upload=upload_in_adapter, metrics=metrics)
+                    except Exception as err:
+                        mark(entry[0], error=err)
+                    else:
+                        done(entry[0], prediction=prediction[0], cache_key=entry[2])
+                return
+            for (single, _, cache_key), prediction in zip(batch, predictions):
+                done(single, prediction=prediction, cache_key=cache_key)
+
+        def matching_items():
+            for page in pages:
+                for item in page:
+                    item_mime_type = item.mimetype.split('/')[0]
+                    if item_mime_type != model.input_type:
+                        mark(item, error=ValueError("Item of type {item_t} while the model works on {model_t}".
+                                                    format(item_t=item_mime_type, model_t=model.input_type)))
+                        continue
+                    # items with a known content hash are looked up before they are downloaded
+                    cache_key = self._prediction_cache_key(adapter=adapter, item=item)
+                    cached = self._cached_prediction(cache_key=cache_key, item=item)
+                    if cached is not None:
+                        done(item, prediction=cached, cache_key=cache_key, from_cache=True)
+                        continue
+                    if cache_key is not None:
+                        cache_keys[item.id] = cache_key
+                    yield item
+
+        def download(item):
+            buffer = download_item(item)
+            if self.prediction_cache is not None:
+                content_hashes[item.id] = content_hash(item=item, buffer=buffer)
+            return buffer
+
+        pipeline = None
+        if (self.prefetch_depth > 0 or self.worker_pool is not None) and model.input_type == 'image':
+            # the workers predict decoded arrays only
+            pipeline = PrefetchPipeline(download_fn=self._timed(metrics, 'download', download),
+                                        decode_fn=self._timed(metrics, 'decode', decode_image),
+                                        download_workers=self.download_workers,
+                                        queue_depth=max(self.prefetch_depth, batch_size))
+            entries = pipeline.iterate(matching_items())
+        else:
+            entries = ((item, None, None) for item in matching_items())
+
+        batch = list()
+        for item, array, error in entries:
+            if error is not None:
+                mark(item, error=error)
+                continue
+            if item.id in cache_keys:
+                cache_key = cache_keys.pop(item.id)
+                content_hashes.pop(item.id, None)
+            else:
+                # the content hash is known only after the download
+                cache_key = item_cache_key(item)
+                cached = self._cached_prediction(cache_key=cache_key, item=item)
+                if cached is not None:
+                    done(item, prediction=cached, cache_key=cache_key, from_cache=True)
+                    continue
+            batch.append((item, array, cache_key))
+            if len(batch) == batch_size:
+                run_batch(batch)
+                batch = list()
+                self._report_progress(progress=progress, report=report, total=total)
+        if len(batch) > 0:
+            run_batch(batch)
+            self._report_progress(progress=progress, report=report, total=total)
+
+        # the report is returned only when the predictions are durable
+        for item_id, future in uploads.items():
+            with metrics.timer('upload_wait'):
+                error = future.exception()
+            if error is not None:
+                report['items'][item_id].update(status='failed', error='upload failed: {}'.format(error))
+                report['success'] -= 1
+                report['failed'] += 1
+
+        if self.prediction_cache is not None:
+            report['prediction_cache'] = self.prediction_cache.stats()
+        if self.worker_pool is not None:
+            report['workers'] = self.worker_pool.stats()
+        if pipeline is not None:
+            pipeline.close()
+            report['pipeline'] = pipeline.stats()
+            logger.info("Prefetch pipeline stats: {}".format(report['pipeline']))
+        logger.info("Finished predicting {n} items: {s} succeeded, {f} failed".
+                    format(n=total, s=report['success'], f=report['failed']))
+
+        elapsed = time.perf_counter() - tic
+        metrics.count('items_success', report['success'])
+        metrics.count('items_failed', report['failed'])
+        metrics.observe('execution', elapsed)
+        if elapsed > 0:
+            metrics.observe('items_per_second', (report['success'] + report['failed']) / elapsed)
+        summary = metrics.report(progress=progress, metrics_path=self._metrics_filepath(context=context))
+        if summary is not None:
+            report['metrics'] = summary
+        return report
+
+    def _metrics_filepath(self, context=None, prefix='predict'):
+        if self.metrics_path is None:
+            return None
+        name = context.execution_id if context is not None else '{}-{}'.format(prefix, int(time.time() * 1000))
+        return os.path.join(self.metrics_path, '{}.json'.format(name))
+
+    def _prediction_cache_key(self, adapter, item, buffer=None, content=None):
+        """
+            The prediction cache key of the item, None if the cache is disabled or the content hash is unknown
+        """
+        if self.prediction_cache is None or getattr(adapter, 'snapshot', None) is None:
+            return None
+        if content is None:
+            content = content_hash(item=item, buffer=buffer)
+        if content is None:
+            return None
+        return self.prediction_cache.make_key(snapshot=adapter.snapshot, content=content,
+                                              variant=self._postprocess_variant())
+
+    def _postprocess_variant(self):
+        if self.postprocess is None:
+            return None
+        return hashlib.md5(json.dumps(self.postprocess, sort_keys=True).encode()).hexdigest()[:12]
+
+    def _cached_prediction(self, cache_key, item):
+        if cache_key is None:
+            return None
+        payload = self.prediction_cache.get(cache_key)
+        if payload is None:
+            self.metrics.count('prediction_cache_misses')
+            return None
+        self.metrics.count('prediction_cache_hits')
+        return deserialize(payload, item=item)
+
+    def _upload_prediction(self, item, prediction, cache_key=None, metrics=None):
+        """
+            Upload the prediction now, or in the background (returns the upload future).
+            A cached prediction is never uploaded twice to the same item
+        """
+        if cache_key is not None and self.prediction_cache.was_uploaded(key=cache_key, item_id=item.id):
+            return None
+
+        def uploaded(future=None):
+            if cache_key is not None and (future is None or future.exception() is None):
+                self.prediction_cache.mark_uploaded(key=cache_key, item_id=item.id)
+
+        if self.uploader is None:
+            with (metrics if metrics is not None else self.metrics).timer('upload'):
+                item.annotations.upload(upload_payload(prediction))
+            uploaded()
+            return None
+        future = self.uploader.submit(item=item, annotations=upload_payload(prediction))
+        future.add_done_callback(uploaded)
+        return future
+
+    @staticmethod
+    def _timed(metrics, stage, fn):
+        def timed(*args):
+            with metrics.timer(stage):
+                return fn(*args)
+
+        return timed
+
+    def _predict_entries(self, adapter, entries, with_upload, metrics=None):
+        """
+            Predict (item, array) entries. Without the decoded arrays the adapter downloads the items itself
+        """
+        if metrics is None:
+            metrics = self.metrics
+        metrics.count('batches')
+        metrics.count('batched_items', len(entries))
+        items = [entry[0] for entry in entries]
+        arrays = [entry[1] for entry in entries]
+        if any(array is None for array in arrays):
+            # download, forward pass and upload all happen in the adapter, unless the predictions are post processed
+            with metrics.timer('adapter_predict_items'):
+                predictions = adapter.predict_items(items=items,
+                                                    with_upload=with_upload and self.postprocess is None)
+            if self.postprocess is None:
+                return predictions
+        else:
+            with metrics.timer('forward'):
+                if self.worker_pool is not None and adapter is self.adapter:
+                    predictions = [deserialize(payload, item=item)
+                                   for item, payload in zip(items, self.worker_pool.predict(arrays))]
+                else:
+                    predictions = adapter.predict(arrays)
+        with metrics.timer('postprocess'):
+            predictions = [self._postprocess_prediction(prediction, model_name=adapter.model_entity.name)
+                           for prediction in predictions]
+        if with_upload:
+            with metrics.timer('upload'):
+                for item, prediction in zip(items, predictions):
+                    item.annotations.upload(upload_payload(prediction))
+        return predictions
+
+    def _postprocess_prediction(self, prediction, model_name=None):
+        """
+            Columns of arrays returned by the adapter become ColumnarPredictions, and box predictions are filtered
+            with the `postprocess` arguments. Other predictions are kept as is
+        """
+        if isinstance(prediction, dict) and 'boxes' in prediction:
+            prediction = to_columnar(prediction, model_name=model_name)
+        if self.postprocess is None:
+            return prediction
+        columnar = to_columnar(prediction, model_name=model_name)
+        if columnar is None:
+            return prediction
+        return columnar.postprocess(**self.postprocess)
+
+    @staticmethod
+    def _report_progress(progress, report, total):
+        if progress is not None and total:
+            done = report['success'] + report['failed']
+            progress.update(progress=int(100 * done / total),
+                            message='predicted items: {}/{}'.format(done, total))
+
 
 def test_yolov5_predict(env='prod', item_id=None):
     dl.setenv(env)
@@ -1,13 +1,33 @@
 import os
+import time
 import logging
 import datetime
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import dtlpy as dl
 from dtlpy.ml.train_utils import prepare_dataset
 
+from handlers.metrics import Metrics
+from handlers.adapter_cache import adapter_cache
+from handlers.entities import entities
+from handlers.evaluation import DEFAULT_IOU_THRESHOLDS, EvaluationAccumulator
+from handlers.prefetch import PrefetchPipeline, download_item, decode_image
+from handlers.checkpoint import CHECKPOINT_METADATA_KEY, SnapshotCheckpointer, get_checkpoint
+from handlers.data_cache import TrainingDataCache
+from handlers.dataset_sync import clone_dataset, get_sync_record, partition_value, sync_cloned_dataset
+from handlers.snapshot_transfer import clone_artifacts, load_from_snapshot, save_to_snapshot
+from handlers.onnx_runtime import (DEFAULT_QUANTIZED_TOLERANCE, DEFAULT_TOLERANCE, clear_artifact,
+                                   export as export_onnx_artifact, save_artifact)
+from handlers.sweep import MedianStopper, TrialPruned, expand_search_space, format_table, rank_trials
+
 logger = logging.getLogger(name=__name__)
 
+DEFAULT_PARTITIONS = {dl.SnapshotPartitionType.TRAIN: 0.8,
+                      dl.SnapshotPartitionType.VALIDATION: 0.2}
+DEFAULT_EVALUATION_PAGE_SIZE = 500
+
 
 class ServiceRunner(dl.BaseServiceRunner):
     """
@@ -23,6 +43,12 @@ class ServiceRunner(dl.BaseServiceRunner):
     def train_on_snapshot(self,
                           snapshot: dl.Snapshot,
                           cleanup=False,
+                          use_data_cache=True,
+                          checkpoint_every_epochs=None,
+                          checkpoint_every_minutes=None,
+                          chunked_upload=False,
+                          metrics=False,
+                          metrics_path=None,
                           progress: dl.Progress = None,
                           context: dl.Context = None):
         # FROM PARENT
@@ -31,64 +57,367 @@ class ServiceRunner(dl.BaseServiceRunner):
             data will be taken from snapshot.datasetId
             configuration is as defined in snapshot.configuration
             upload the output the the snapshot's bucket (snapshot.bucket)
+            with `use_data_cache` the items binaries are linked from the machine's training data cache
+            and only the missing ones are downloaded
+
+            with a checkpoint interval, the training output is saved to the snapshot every N epochs / minutes.
+            A restarted execution on the same snapshot resumes from the epoch after the latest checkpoint,
+            passed to the adapter as `start_epoch` in its configuration
+
+            with `chunked_upload` the output is saved as content addressed chunks in a sidecar next to the
+            snapshot's bucket: only the changed chunks are uploaded, in parallel, and this package's runners
+            download only the changed chunks. The bucket itself is left empty, other consumers read the files with
+            `download_artifacts` (see handlers/snapshot_transfer.py)
+
+            with `metrics` the stages timings are reported to the progress and the logs, and written
+            to `metrics_path`/<execution id>.json if given
+        """
+        return self._train_on_snapshot(snapshot=snapshot,
+                                       cleanup=cleanup,
+                                       use_data_cache=use_data_cache,
+                                       checkpoint_every_epochs=checkpoint_every_epochs,
+                                       checkpoint_every_minutes=checkpoint_every_minutes,
+                                       chunked_upload=chunked_upload,
+                                       metrics=metrics,
+                                       metrics_path=metrics_path,
+                                       progress=progress,
+                                       context=context)
+
+    def _train_on_snapshot(self,
+                           snapshot,
+                           cleanup=False,
+                           use_data_cache=True,
+                           checkpoint_every_epochs=None,
+                           checkpoint_every_minutes=None,
+                           chunked_upload=False,
+                           metrics=False,
+                           metrics_path=None,
+                           progress=None,
+                           context=None,
+                           epoch_hook=None):
+        """
+            `epoch_hook(i_epoch, n_epoch, metrics)` is called after every epoch with the epoch metrics reported
+            by the adapter (None if it reports none). Raising `TrialPruned` from it stops the training
         """
+        execution_id = context.execution_id if context is not None else None
+        train_metrics = Metrics(enabled=bool(metrics), name='train-on-snapshot')
         try:
             if isinstance(snapshot, str):
-                snapshot = dl.snapshots.get(snapshot_id=snapshot)
+                snapshot = entities.snapshot(snapshot_id=snapshot)
             logger.info("Received {s} for training".format(s=snapshot.id))
             snapshot.status = 'training'
             if 'system' not in snapshot.metadata:
                 snapshot.metadata['system'] = dict()
-            snapshot.metadata['system']['trainExecutionId'] = context.execution_id
-            snapshot.update()
+            snapshot.metadata['system']['trainExecutionId'] = execution_id
+            snapshot.metadata['system'].pop('trainError', None)
+            entities.update(snapshot)
 
             def on_epoch_end(epoch, n_epoch):
                 if progress is not None:
                     progress.update(message='training epoch: {}/{}'.format(epoch, n_epoch), progress=epoch / n_epoch)
 
-            model = snapshot.model
-
-            logger.info("Building Model {n} ({i!r})".format(n=model.name, i=model.id))
-            adapter = model.build()
-
-            if snapshot is not None:
-                logger.info("Loading Adapter with: {n} ({i!r})".format(n=snapshot.name, i=snapshot.id))
-                logger.debug("Snapshot\n{}\n{}".format('=' * 8, snapshot.print(to_return=True)))
-                adapter.load_from_snapshot(snapshot)
-
-            root_path, data_path, output_path = adapter.prepare_training(root_path=os.path.join('tmp', snapshot.id))
+            with train_metrics.timer('snapshot_load'):
+                model = entities.snapshot_model(snapshot)
+
+                logger.info("Building Model {n} ({i!r})".format(n=model.name, i=model.id))
+                adapter = model.build()
+
+                if snapshot is not None:
+                    logger.info("Loading Adapter with: {n} ({i!r})".format(n=snapshot.name, i=snapshot.id))
+                    logger.debug("Snapshot\n{}\n{}".format('=' * 8, snapshot.print(to_return=True)))
+                    load_from_snapshot(adapter=adapter,
+                                       snapshot=snapshot,
+                                       local_path=os.path.join('tmp', snapshot.id, 'snapshot'))
+
+            # the snapshot's bucket holds the checkpoint weights, loaded above
+            checkpoint = get_checkpoint(snapshot)
+            orig_start_epoch = adapter.configuration.get('start_epoch')
+            if checkpoint is not None:
+                logger.info("Resuming training from checkpoint of epoch {e} (saved at {t})".
+                            format(e=checkpoint['epoch'], t=checkpoint['savedAt']))
+                adapter.configuration['start_epoch'] = checkpoint['epoch'] + 1
+
+            with train_metrics.timer('prepare_training'):
+                root_path, data_path, output_path = self._prepare_training(adapter=adapter,
+                                                                           snapshot=snapshot,
+                                                                           use_data_cache=use_data_cache)
             # Start the Train
             logger.info("Training {m_name!r} with snapshot {s_name!r} on data {d_path!r}".
                         format(m_name=adapter.model_name, s_name=snapshot.id, d_path=data_path))
             if progress is not None:
                 progress.update(message='starting training')
 
-            def on_epoch_end_callback(i_epoch, n_epoch):
+            checkpointer = SnapshotCheckpointer(adapter=adapter,
+                                                snapshot=snapshot,
+                                                output_path=output_path,
+                                                every_epochs=checkpoint_every_epochs,
+                                                every_minutes=checkpoint_every_minutes,
+                                                execution_id=execution_id,
+                                                chunked_upload=chunked_upload)
+
+            epoch_tic = [time.perf_counter()]
+
+            def on_epoch_end_callback(i_epoch, n_epoch, metrics=None, **kwargs):
+                train_metrics.observe('epoch', time.perf_counter() - epoch_tic[0])
+                with train_metrics.timer('checkpoint'):
+                    checkpointer.on_epoch_end(i_epoch=i_epoch, n_epoch=n_epoch)
+                epoch_tic[0] = time.perf_counter()
                 if progress is not None:
                     progress.update(progress=int(100 * (i_epoch + 1) / n_epoch),
                                     message='finished epoch: {}/{}'.format(i_epoch, n_epoch))
-
-            adapter.train(data_path=data_path,
-                          output_path=output_path,
-                          on_epoch_end=on_epoch_end,
-                          on_epoch_end_callback=on_epoch_end_callback)
+                if epoch_hook is not None:
+                    epoch_hook(i_epoch, n_epoch, metrics)
+
+            with train_metrics.timer('train'):
+                adapter.train(data_path=data_path,
+                              output_path=output_path,
+                              on_epoch_end=on_epoch_end,
+                              on_epoch_end_callback=on_epoch_end_callback)
             if progress is not None:
                 progress.update(message='saving snapshot',
                                 progress=99)
 
-            adapter.save_to_snapshot(local_path=output_path, replace=True)
+            if orig_start_epoch is None:
+                adapter.configuration.pop('start_epoch', None)
+            else:
+                adapter.configuration['start_epoch'] = orig_start_epoch
+            with train_metrics.timer('save_to_snapshot'):
+                save_to_snapshot(adapter=adapter, local_path=output_path, chunked=chunked_upload)
+            # the exported onnx artifact is of the previous weights
+            if clear_artifact(snapshot):
+                logger.info("Dropped the stale onnx artifact of snapshot {s!r}".format(s=snapshot.id))
+                entities.update(snapshot)
+            checkpointer.clear()
 
             ###########
             # cleanup #
             ###########
             if cleanup:
                 shutil.rmtree(output_path, ignore_errors=True)
-        except Exception:
-            snapshot.status = 'training'
-            snapshot.update()
+        except TrialPruned as err:
+            snapshot.status = 'pruned'
+            snapshot.metadata.setdefault('system', dict())['trainPruned'] = {
+                'message': str(err),
+                'executionId': execution_id,
+                'prunedAt': datetime.datetime.utcnow().isoformat()
+            }
+            entities.update(snapshot)
+            if cleanup:
+                shutil.rmtree(output_path, ignore_errors=True)
+            raise
+        except Exception as err:
+            if isinstance(snapshot, dl.Snapshot):
+                snapshot.status = 'failed'
+                snapshot.metadata.setdefault('system', dict())['trainError'] = {
+                    'message': str(err),
+                    'executionId': execution_id,
+                    'failedAt': datetime.datetime.utcnow().isoformat()
+                }
+                entities.update(snapshot)
             raise
+        finally:
+            train_metrics.report(progress=progress,
+                                 metrics_path=self._metrics_filepath(metrics_path=metrics_path, context=context))
         return adapter.snapshot.id
 
+    @staticmethod
+    def _prepare_training(adapter, snapshot, use_data_cache=True):
+        root_path = os.path.join('tmp', snapshot.id)
+        if not use_data_cache:
+            return adapter.prepare_training(root_path=root_path)
+        data_cache = TrainingDataCache()
+        data_path = os.path.join(root_path, 'data')
+        items_by_partition = data_cache.list_partitions(snapshot=snapshot)
+        data_cache.materialize(items_by_partition=items_by_partition, data_path=data_path)
+        # existing files are not downloaded again
+        root_path, data_path, output_path = adapter.prepare_training(root_path=root_path,
+                                                                     data_path=data_path)
+        data_cache.ingest(items_by_partition=items_by_partition, data_path=data_path)
+        return root_path, data_path, output_path
+
+    @staticmethod
+    def _metrics_filepath(metrics_path, context=None):
+        if metrics_path is None:
+            return None
+        name = context.execution_id if context is not None else 'train-{}'.format(int(time.time()))
+        return os.path.join(metrics_path, '{}.json'.format(name))
+
+    def export_onnx(self,
+                    snapshot: dl.Snapshot,
+                    quantize=False,
+                    batch_size=4,
+                    intra_op_threads=None,
+                    iterations=20,
+                    tolerance=DEFAULT_TOLERANCE,
+                    quantized_tolerance=DEFAULT_QUANTIZED_TOLERANCE,
+                    force=False,
+                    progress: dl.Progress = None,
+                    context: dl.Context = None):
+        """
+            Export the snapshot's model to an onnx artifact for CPU inference, stored next to the snapshot's bucket and
+            loaded by the predict service's 'onnx' load mode. The latency and outputs of the artifact are compared
+            to the eager model's on a batch of the snapshot's validation items
+
+        Args:
+            snapshot (dl.Snapshot): snapshot to export
+            quantize (bool, optional): int8 dynamic quantization of the weights. Defaults to False.
+            batch_size (int, optional): number of validation items in the comparison batch. Defaults to 4.
+            intra_op_threads (int, optional): onnxruntime threads of the comparison. Defaults to None (all cores).
+            iterations (int, optional): timed iterations of each model. Defaults to 20.
+            tolerance (float, optional): max output difference, relative to outputs larger than 1.
+                                         Defaults to 1e-3.
+            quantized_tolerance (float, optional): `tolerance` of a quantized export, whose int8 weights shift the
+                                                   outputs by about a percent. Defaults to 5e-2.
+            force (bool, optional): store the artifact even if its outputs disagree with the eager model's.
+                                    Defaults to False.
+            progress (dl.Progress, optional): execution progress. Defaults to None.
+
+        Returns:
+            dict: export report, with the eager / onnx latencies, the numerical agreement and whether the artifact
+                  was stored
+        """
+        if isinstance(snapshot, str):
+            snapshot = entities.snapshot(snapshot_id=snapshot)
+        model = entities.snapshot_model(snapshot)
+        if model.input_type != 'image':
+            raise ValueError('Onnx export supports image models, {!r} works on {}'.format(model.name,
+                                                                                          model.input_type))
+        adapter = adapter_cache.load(model=model, snapshot=snapshot)
+
+        filters = dl.Filters()
+        filters.add(field='metadata.system.snapshotPartition',
+                    values=partition_value(dl.SnapshotPartitionType.VALIDATION))
+        pages = entities.snapshot_dataset(snapshot).items.list(filters=filters, page_size=int(batch_size))
+        items = next(iter(pages), list())[:int(batch_size)]
+        if len(items) == 0:
+            raise ValueError('Snapshot {!r} has no validation items to compare the export on'.format(snapshot.id))
+        sample_inputs = [decode_image(download_item(item)) for item in items]
+
+        if progress is not None:
+            progress.update(message='exporting to onnx', progress=10)
+        logger.info("Exporting snapshot {s!r} to onnx (quantize={q})".format(s=snapshot.id, q=quantize))
+        local_path = os.path.join('tmp', snapshot.id, 'onnx')
+        try:
+            artifact_path, report = export_onnx_artifact(adapter=adapter,
+                                                         local_path=local_path,
+                                                         sample_inputs=sample_inputs,
+                                                         quantize=quantize,
+                                                         intra_op_threads=intra_op_threads,
+                                                         iterations=iterations,
+                                                         tolerance=tolerance,
+                                                         quantized_tolerance=quantized_tolerance)
+            report['executionId'] = context.execution_id if context is not None else None
+            report['stored'] = report['agreement']['passed'] or bool(force)
+            if not report['agreement']['passed']:
+                logger.warning("Onnx outputs differ from the eager model's{}: {}".
+                               format('' if force else ', not storing the artifact', report['agreement']))
+            if report['stored']:
+                save_artifact(snapshot=snapshot, artifact_path=artifact_path, report=report)
+        finally:
+            shutil.rmtree(local_path, ignore_errors=True)
+        logger.info("Exported snapshot {s!r} to onnx: {r}".format(s=snapshot.id, r=report))
+        return report
+
+    def evaluate_snapshot(self,
+                          snapshot: dl.Snapshot,
+                          partition=dl.SnapshotPartitionType.VALIDATION,
+                          batch_size=16,
+                          iou_thresholds=None,
+                          score_threshold=0.5,
+                          download_workers=8,
+                          progress: dl.Progress = None,
+                          context: dl.Context = None):
+        """
+            Score the snapshot on a partition of its dataset (created by `clone_snapshot_from_dataset`).
+            Items are streamed in batches and predicted without uploading; the metrics are accumulated in
+            fixed size histograms, so the memory does not grow with the partition size.
+            A summary (mAP, AP per label, precision / recall, accuracy, confusion matrix) is stored in the
+            snapshot's system metadata under `evaluation`
+
+        Args:
+            snapshot (dl.Snapshot): snapshot to evaluate
+            partition (str, optional): partition to evaluate on. Defaults to validation.
+            batch_size (int, optional): prediction batch size. Defaults to 16.
+            iou_thresholds (list, optional): detection IoU thresholds. Defaults to None ==> [0.5].
+            score_threshold (float, optional): min score of the predictions counted in precision / recall and in
+                                               the confusion matrix. Defaults to 0.5.
+            download_workers (int, optional): number of concurrent item downloads. Defaults to 8.
+            progress (dl.Progress, optional): [description]. Defaults to None.
+
+        Returns:
+            dict: evaluation summary
+        """
+        if isinstance(snapshot, str):
+            snapshot = entities.snapshot(snapshot_id=snapshot)
+        logger.info("Evaluating snapshot {s!r} on partition {p!r}".format(s=snapshot.id, p=partition))
+        tic = time.perf_counter()
+        model = entities.snapshot_model(snapshot)
+        adapter = adapter_cache.load(model=model, snapshot=snapshot)
+        accumulator = EvaluationAccumulator(iou_thresholds=iou_thresholds or DEFAULT_IOU_THRESHOLDS,
+                                            score_threshold=score_threshold)
+
+        filters = dl.Filters()
+        filters.add(field='metadata.system.snapshotPartition', values=partition_value(partition))
+        pages = entities.snapshot_dataset(snapshot).items.list(filters=filters, page_size=DEFAULT_EVALUATION_PAGE_SIZE)
+        total = getattr(pages, 'items_count', None)
+        items = (item for page in pages for item in page)
+        failed = 0
+
+        def evaluate_batch(batch):
+            items_batch = [item for item, _, _ in batch]
+            if model.input_type == 'image':
+                predictions = adapter.predict([array for _, array, _ in batch])
+            else:
+                predictions = adapter.predict_items(items=items_batch, with_upload=False)
+            for (_, _, ground_truth), prediction in zip(batch, predictions):
+                accumulator.add(ground_truth=ground_truth, prediction=prediction)
+            if progress is not None and total:
+                progress.update(progress=int(100 * accumulator.items / total),
+                                message='evaluated items: {}/{}'.format(accumulator.items, total))
+
+        def download(item):
+            # the ground truth is fetched with the binary, in the download workers
+            buffer = download_item(item) if model.input_type == 'image' else None
+            return buffer, list(item.annotations.list())
+
+        def decode(downloaded):
+            buffer, ground_truth = downloaded
+            return (decode_image(buffer) if buffer is not None else None), ground_truth
+
+        pipeline = PrefetchPipeline(download_fn=download,
+                                    decode_fn=decode,
+                                    download_workers=download_workers,
+                                    queue_depth=2 * batch_size)
+        batch = list()
+        try:
+            for item, decoded, error in pipeline.iterate(items):
+                if error is not None:
+                    logger.warning("Skipping item {i!r}: {e}".format(i=item.id, e=error))
+                    failed += 1
+                    continue
+                array, ground_truth = decoded
+                batch.append((item, array, ground_truth))
+                if len(batch) == batch_size:
+                    evaluate_batch(batch)
+                    batch = list()
+            if batch:
+                evaluate_batch(batch)
+        finally:
+            pipeline.close()
+
+        summary = accumulator.summary()
+        summary.update({'partition': partition_value(partition),
+                        'failedItems': failed,
+                        'evaluatedAt': datetime.datetime.utcnow().isoformat(),
+                        'executionId': context.execution_id if context is not None else None,
+                        'elapsedSeconds': time.perf_counter() - tic})
+        snapshot.metadata.setdefault('system', dict())['evaluation'] = summary
+        entities.update(snapshot)
+        logger.info("Evaluated {n} items in {t:.1f}s: {s}".format(n=summary['items'], t=summary['elapsedSeconds'],
+                                                                  s=summary.get('detection',
+                                                                                summary.get('classification'))))
+        return summary
+
     def train_from_dataset(self,
                            from_snapshot: dl.Snapshot,
                            dataset: dl.Dataset,
@@ -96,6 +425,8 @@ class ServiceRunner(dl.BaseServiceRunner):
                            # new training params
                            snapshot_name=None,
                            configuration=None,
+                           partitions=None,
+                           incremental=False,
                            progress: dl.Progress = None):
         """
             Create a cloned snapshot from dataset
@@ -105,8 +436,12 @@ class ServiceRunner(dl.BaseServiceRunner):
             from_snapshot (dl.Snapshot, optional): What is the `source` Snapshot to clone from
             dataset (dl.Dataset): source dataset
             filters (dl.Filters, optional): how to create the cloned dataset. Defaults to None.
-            snapshot_name (str, optional): New cloned snapshot name. Defaults to None==> <model_name>-<dataset_name>-<YYMMDD-HHMMSS>.
+            snapshot_name (str, optional): New cloned snapshot name.
+                                           Defaults to None==> <model_name>-<dataset_name>-<YYMMDD-HHMMSS>.
             configuration (dict, optional): updated configuration in the cloned snapshot. Defaults to None.
+            partitions (dict, optional): partition -> ratio. Defaults to None ==> 0.8 train, 0.2 validation.
+            incremental (bool, optional): sync the dataset of `from_snapshot` in place (it is modified) instead of
+                                          cloning `dataset`. Defaults to False.
             progress (dl.Progress, optional): [description]. Defaults to None.
 
         Returns:
@@ -119,12 +454,150 @@ class ServiceRunner(dl.BaseServiceRunner):
             from_snapshot=from_snapshot,
             snapshot_name=snapshot_name,
             configuration=configuration,
+            partitions=partitions,
+            incremental=incremental,
             progress=progress
         )
 
         return self.train_on_snapshot(snapshot=snapshot,
                                       progress=progress)
 
+    def train_sweep(self,
+                    from_snapshot: dl.Snapshot,
+                    dataset: dl.Dataset,
+                    search_space: dict,
+                    filters=None,
+                    search='grid',
+                    n_trials=None,
+                    max_workers=2,
+                    metric='val_loss',
+                    mode='min',
+                    early_stopping=True,
+                    grace_epochs=1,
+                    snapshot_name=None,
+                    configuration=None,
+                    partitions=None,
+                    incremental=False,
+                    seed=None,
+                    progress: dl.Progress = None,
+                    context: dl.Context = None):
+        """
+            Hyperparameter sweep: train a cloned snapshot per configuration in the search space.
+            The dataset is cloned and its binaries are downloaded once, all the trials train on the same data.
+            With `early_stopping`, trials whose `metric` (from the epoch metrics the adapter passes to
+            `on_epoch_end_callback`) is worse than the median of the other trials at the same epoch are stopped
+
+        Args:
+            from_snapshot (dl.Snapshot): What is the `source` Snapshot to clone from
+            dataset (dl.Dataset): source dataset
+            search_space (dict): configuration key -> list of values, or {'min': , 'max': , 'log': , 'type': }
+                                 range for random search
+            filters (dl.Filters, optional): how to create the cloned dataset. Defaults to None.
+            search (str, optional): 'grid' or 'random'. Defaults to 'grid'.
+            n_trials (int, optional): number of trials. Defaults to None ==> whole grid / 10 random trials.
+            max_workers (int, optional): number of trials trained concurrently. Defaults to 2.
+            metric (str, optional): epoch metric to rank (and stop) the trials by. Defaults to 'val_loss'.
+            mode (str, optional): 'min' or 'max' - which metric values are better. Defaults to 'min'.
+            early_stopping (bool, optional): stop trials that fall behind. Defaults to True.
+            grace_epochs (int, optional): epochs before a trial can be stopped. Defaults to 1.
+            snapshot_name (str, optional): trials snapshots names prefix.
+                                           Defaults to None==> <model_name>-<dataset_name>-<YYMMDD-HHMMSS>.
+            configuration (dict, optional): base configuration of all the trials. Defaults to None.
+            partitions (dict, optional): partition -> ratio. Defaults to None ==> 0.8 train, 0.2 validation.
+            incremental (bool, optional): sync the dataset of `from_snapshot` in place (it is modified) instead of
+                                          cloning `dataset`. Defaults to False.
+            seed (int, optional): random search seed. Defaults to None.
+            progress (dl.Progress, optional): [description]. Defaults to None.
+
+        Returns:
+            list: the trials ranked by their metric: rank, snapshot id and name, configuration, status,
+                  metric and number of epochs
+        """
+        trials_configurations = expand_search_space(search_space=search_space,
+                                                    search=search,
+                                                    n_trials=n_trials,
+                                                    seed=seed)
+        logger.info("Sweep of {n} trials on dataset {d!r}".format(n=len(trials_configurations), d=dataset.id))
+        cloned_dataset = self._prepare_cloned_dataset(from_snapshot=from_snapshot,
+                                                      dataset=dataset,
+                                                      filters=filters,
+                                                      partitions=partitions,
+                                                      incremental=incremental,
+                                                      progress=progress)
+        if snapshot_name is None:
+            snapshot_name = '{}-{}-{}'.format(entities.snapshot_model(from_snapshot).name,
+                                              cloned_dataset.name,
+                                              datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+        trials = list()
+        for i_trial, trial_configuration in enumerate(trials_configurations):
+            snapshot = self._clone_snapshot(from_snapshot=from_snapshot,
+                                            project=dataset.project,
+                                            cloned_dataset=cloned_dataset,
+                                            snapshot_name='{}-trial-{}'.format(snapshot_name, i_trial),
+                                            configuration=dict(configuration or dict(), **trial_configuration))
+            trials.append({'snapshot_id': snapshot.id,
+                           'snapshot_name': snapshot.name,
+                           'configuration': trial_configuration,
+                           'status': 'pending',
+                           'metric': None,
+                           'epochs': 0,
+                           'snapshot': snapshot})
+
+        if progress is not None:
+            progress.update(message='downloading training data', progress=15)
+        self._warm_training_data(snapshot=trials[0]['snapshot'])
+
+        stopper = MedianStopper(metric=metric, mode=mode, grace_epochs=grace_epochs) if early_stopping else None
+        finished = [0]
+        lock = threading.Lock()
+
+        def run_trial(trial):
+            def epoch_hook(i_epoch, n_epoch, epoch_metrics):
+                trial['epochs'] = i_epoch + 1
+                if epoch_metrics and metric in epoch_metrics:
+                    trial['metric'] = float(epoch_metrics[metric])
+                if stopper is not None and stopper.report(trial_id=trial['snapshot_id'],
+                                                          epoch=i_epoch,
+                                                          metrics=epoch_metrics):
+                    raise TrialPruned('{m}={v} fell behind the other trials at epoch {e}'.
+                                      format(m=metric, v=trial['metric'], e=i_epoch))
+
+            trial['status'] = 'training'
+            try:
+                self._train_on_snapshot(snapshot=trial.pop('snapshot'),
+                                        cleanup=True,
+                                        epoch_hook=epoch_hook)
+                trial['status'] = 'completed'
+            except TrialPruned as err:
+                logger.info("Trial {s!r} stopped: {e}".format(s=trial['snapshot_name'], e=err))
+                trial['status'] = 'pruned'
+            except Exception as err:
+                logger.exception("Trial {s!r} failed".format(s=trial['snapshot_name']))
+                trial['status'] = 'failed'
+                trial['error'] = str(err)
+            with lock:
+                finished[0] += 1
+                if progress is not None:
+                    progress.update(message='finished trial {}/{}'.format(finished[0], len(trials)),
+                                    progress=15 + int(85 * finished[0] / len(trials)))
+
+        with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as pool:
+            list(pool.map(run_trial, trials))
+
+        ranked = rank_trials(trials=trials, mode=mode)
+        logger.info("Sweep results:\n{}".format(format_table(ranked=ranked, metric=metric)))
+        return ranked
+
+    def _warm_training_data(self, snapshot):
+        """
+            Download the snapshot's dataset into the training data cache once, so concurrent trials on the same
+            dataset only link the cached binaries
+        """
+        adapter = entities.snapshot_model(snapshot).build()
+        # no weights are needed to download the data
+        adapter.snapshot = snapshot
+        self._prepare_training(adapter=adapter, snapshot=snapshot, use_data_cache=True)
+
     def clone_snapshot_from_dataset(self,
                                     from_snapshot: dl.Snapshot,
                                     dataset: dl.Dataset,
@@ -132,17 +605,30 @@ class ServiceRunner(dl.BaseServiceRunner):
                                     # new training params
                                     snapshot_name=None,
                                     configuration=None,
+                                    partitions=None,
+                                    incremental=False,
                                     progress: dl.Progress = None):
         """Creates a new snapshot from dataset
             Functionality is split - for the use from UI
-        
+
+            In incremental mode the dataset of `from_snapshot`, if it was cloned from `dataset`, is synced in place
+            (only added, removed and modified items are cloned from `dataset`) instead of cloning the whole dataset,
+            and the new snapshot uses it too. The dataset of `from_snapshot` is modified: it no longer holds the
+            data `from_snapshot` was trained on.
+            Partitions are assigned by a hash of the item's filepath, so items keep their partition across syncs,
+            unless the partitions ratios changed
+
 
         Args:
             from_snapshot (dl.Snapshot, optional): What is the `source` Snapshot to clone from
             dataset (dl.Dataset): source dataset
             filters (dl.Filters, optional): how to create the cloned dataset. Defaults to None.
-            snapshot_name (str, optional): New cloned snapshot name. Defaults to None==> <model_name>-<dataset_name>-<YYMMDD-HHMMSS>.
+            snapshot_name (str, optional): New cloned snapshot name.
+                                           Defaults to None==> <model_name>-<dataset_name>-<YYMMDD-HHMMSS>.
             configuration (dict, optional): updated configuration in the cloned snapshot. Defaults to None.
+            partitions (dict, optional): partition -> ratio. Defaults to None ==> 0.8 train, 0.2 validation.
+            incremental (bool, optional): sync the dataset of `from_snapshot` in place (it is modified) instead of
+                                          cloning `dataset`. Defaults to False.
             progress (dl.Progress, optional): [description]. Defaults to None.
 
         Returns:
@@ -150,10 +636,21 @@ class ServiceRunner(dl.BaseServiceRunner):
         """
         logger.info("Recieved a dataset {d!r} to use in cloned version of orig snapshot {s!r} ".
                     format(d=dataset.id, s=from_snapshot.id))
-        # Base entities
-        model = from_snapshot.model
-        project = dataset.project  # This is the destenation project
-
+        cloned_dataset = self._prepare_cloned_dataset(from_snapshot=from_snapshot,
+                                                      dataset=dataset,
+                                                      filters=filters,
+                                                      partitions=partitions,
+                                                      incremental=incremental,
+                                                      progress=progress)
+        return self._clone_snapshot(from_snapshot=from_snapshot,
+                                    project=dataset.project,
+                                    cloned_dataset=cloned_dataset,
+                                    snapshot_name=snapshot_name,
+                                    configuration=configuration,
+                                    progress=progress)
+
+    def _prepare_cloned_dataset(self, from_snapshot, dataset, filters=None, partitions=None, incremental=False,
+                                progress=None):
         if isinstance(filters, dict):
             t_filters = filters
             filters = dl.Filters()
@@ -161,11 +658,24 @@ class ServiceRunner(dl.BaseServiceRunner):
         if progress is not None:
             progress.update(message='preparing dataset', progress=5)
 
-        partitions = {dl.SnapshotPartitionType.TRAIN: 0.8,
-                      dl.SnapshotPartitionType.VALIDATION: 0.2}
-        cloned_dataset = prepare_dataset(dataset,
-                                         partitions=partitions,
-                                         filters=filters)
+        if partitions is None:
+            partitions = DEFAULT_PARTITIONS
+        if incremental:
+            cloned_dataset = self._sync_previous_dataset(from_snapshot=from_snapshot,
+                                                         dataset=dataset,
+                                                         filters=filters,
+                                                         partitions=partitions,
+                                                         progress=progress)
+        else:
+            cloned_dataset = prepare_dataset(dataset,
+                                             partitions=partitions,
+                                             filters=filters)
+        return cloned_dataset
+
+    @staticmethod
+    def _clone_snapshot(from_snapshot, project, cloned_dataset, snapshot_name=None, configuration=None,
+                        progress=None):
+        model = entities.snapshot_model(from_snapshot)
         if snapshot_name is None:
             snapshot_name = '{}-{}-{}'.format(model.name,
                                               cloned_dataset.name,
@@ -184,8 +694,44 @@ class ServiceRunner(dl.BaseServiceRunner):
                                               bucket=bucket,
                                               project_id=project.id,
                                               dataset_id=cloned_dataset.id)
+        # the clone's bucket has no onnx artifact of its own, and the clone has no training state of its own:
+        # a checkpoint record or a training error of the source must not be resumed from or reported
+        cleared = clear_artifact(cloned_snapshot)
+        for key in [CHECKPOINT_METADATA_KEY, 'trainError']:
+            cleared = cloned_snapshot.metadata.get('system', dict()).pop(key, None) is not None or cleared
+        # chunked artifacts are stored next to the source's bucket, not in it
+        cleared = clone_artifacts(from_snapshot=from_snapshot, snapshot=cloned_snapshot) or cleared
+        if cleared:
+            entities.update(cloned_snapshot)
         return cloned_snapshot
 
+    @staticmethod
+    def _sync_previous_dataset(from_snapshot, dataset, filters, partitions, progress=None):
+        previous_dataset = None
+        if getattr(from_snapshot, 'dataset_id', None) is not None:
+            previous_dataset = entities.snapshot_dataset(from_snapshot)
+            record = get_sync_record(previous_dataset)
+            if record is None or record['sourceDatasetId'] != dataset.id:
+                previous_dataset = None
+
+        if previous_dataset is None:
+            logger.info("No previous clone of dataset {d!r}, cloning it".format(d=dataset.id))
+            clone_name = '{}-clone-{}'.format(dataset.name, datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+            return clone_dataset(dataset=dataset,
+                                 clone_name=clone_name,
+                                 partitions=partitions,
+                                 filters=filters)
+
+        # synced in place: copying it first would cost as much as cloning `dataset` again
+        delta = sync_cloned_dataset(dataset=dataset,
+                                    cloned_dataset=previous_dataset,
+                                    partitions=partitions,
+                                    filters=filters,
+                                    progress=progress,
+                                    record=record)
+        logger.info("Synced dataset {d!r} in place: {delta}".format(d=previous_dataset.id, delta=delta))
+        return previous_dataset
+
 
 def train_yolox_test(env='prod'):
     import logging
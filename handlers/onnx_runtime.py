@@ -0,0 +1,212 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import datetime
+
+import numpy as np
+
+logger = logging.getLogger(name=__name__)
+
+# snapshot metadata (under 'system') describing the exported runtime artifact
+METADATA_KEY = 'onnx'
+# path of the artifact in the sidecar of the snapshot's bucket (see snapshot_transfer.ItemBucketStore), so the
+# adapter's own download of the bucket does not fetch it
+ARTIFACT_PATH = 'runtime/model.onnx'
+MODEL_FILENAME = 'model.onnx'
+# max output difference of the artifact, relative to outputs larger than 1. The int8 weights of a quantized
+# artifact shift the outputs by about a percent, far above the float export's rounding
+DEFAULT_TOLERANCE = 1e-3
+DEFAULT_QUANTIZED_TOLERANCE = 5e-2
+
+
+def supports_onnx(adapter):
+    """
+        An adapter supports the onnx export and load mode if it implements:
+            export_onnx(local_path, sample_inputs) -> path of the exported .onnx file of the loaded model
+            preprocess(batch) -> dict of input name -> numpy array, the model's inputs for a batch
+            forward(inputs) -> list of numpy arrays, the eager model's outputs (for the agreement check)
+            postprocess(outputs, batch) -> the predictions of the batch from the model's outputs
+    """
+    return all(callable(getattr(adapter, name, None))
+               for name in ['export_onnx', 'preprocess', 'forward', 'postprocess'])
+
+
+def file_sha256(filepath, chunk_size=2 ** 20):
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def create_session(model_path, intra_op_threads=None):
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if intra_op_threads:
+        options.intra_op_num_threads = int(intra_op_threads)
+    return ort.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+class OnnxAdapter:
+    """
+    The adapter with its forward pass run by onnxruntime on CPU: the adapter's `preprocess` and `postprocess`
+    around the exported graph. Everything else (model entity, snapshot, configuration...) is the adapter's
+    """
+
+    def __init__(self, adapter, model_path, intra_op_threads=None):
+        self.adapter = adapter
+        self.model_path = model_path
+        self.session = create_session(model_path=model_path, intra_op_threads=intra_op_threads)
+
+    def __getattr__(self, name):
+        if name == 'adapter':
+            raise AttributeError(name)
+        return getattr(self.adapter, name)
+
+    def predict(self, batch, **kwargs):
+        outputs = self.session.run(None, self.adapter.preprocess(batch))
+        return self.adapter.postprocess(outputs, batch)
+
+    def predict_items(self, items, with_upload=True, **kwargs):
+        batch = [item.download(save_locally=False, to_array=True) for item in items]
+        predictions = self.predict(batch)
+        if with_upload:
+            for item, prediction in zip(items, predictions):
+                item.annotations.upload(prediction)
+        return predictions
+
+
+def _latency_ms(fn, batch, iterations):
+    fn(batch)
+    timings = list()
+    for _ in range(max(int(iterations), 1)):
+        tic = time.perf_counter()
+        fn(batch)
+        timings.append((time.perf_counter() - tic) * 1000)
+    return {'p50': float(np.percentile(timings, 50)), 'p95': float(np.percentile(timings, 95))}
+
+
+def agreement(expected, actual, tolerance):
+    """
+        Numerical agreement of the eager and onnx outputs
+    """
+    expected = [np.asarray(output, dtype=np.float64) for output in expected]
+    actual = [np.asarray(output, dtype=np.float64) for output in actual]
+    if [e.shape for e in expected] != [a.shape for a in actual]:
+        return {'passed': False,
+                'error': 'outputs shapes differ: {} vs {}'.format([e.shape for e in expected],
+                                                                  [a.shape for a in actual])}
+    abs_diffs = [np.abs(e - a) for e, a in zip(expected, actual)]
+    scales = [np.maximum(np.abs(e), 1.0) for e in expected]
+    return {'passed': all(bool(np.all(d <= tolerance * s)) for d, s in zip(abs_diffs, scales)),
+            'tolerance': tolerance,
+            'maxAbsDiff': max(float(d.max()) if d.size else 0.0 for d in abs_diffs),
+            'meanAbsDiff': float(np.mean([d.mean() for d in abs_diffs if d.size])) if any(d.size for d in abs_diffs)
+            else 0.0}
+
+
+def export(adapter, local_path, sample_inputs, quantize=False, intra_op_threads=None, iterations=20,
+           tolerance=DEFAULT_TOLERANCE, quantized_tolerance=DEFAULT_QUANTIZED_TOLERANCE):
+    """
+        Export the loaded adapter's model to onnx, optimized offline, optionally with int8 dynamic quantization of
+        the weights, and compare its latency and outputs to the eager model on `sample_inputs`, within `tolerance`
+        (`quantized_tolerance` for a quantized export)
+
+    Returns:
+        (path of the artifact, report dict)
+    """
+    import onnxruntime as ort
+    if not supports_onnx(adapter):
+        raise ValueError('Adapter {!r} does not support the onnx export (export_onnx / preprocess / forward / '
+                         'postprocess)'.format(type(adapter).__name__))
+    shutil.rmtree(local_path, ignore_errors=True)
+    os.makedirs(local_path)
+    tic = time.perf_counter()
+    exported_path = adapter.export_onnx(local_path=local_path, sample_inputs=sample_inputs)
+    artifact_path = os.path.join(local_path, MODEL_FILENAME)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        # quantized from the exported graph, the runtime optimizes the quantized one when it loads it
+        quantize_dynamic(model_input=exported_path, model_output=artifact_path, weight_type=QuantType.QInt8)
+    else:
+        # the extended optimizations are portable across cpus, the layout ones are made when loading
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+        options.optimized_model_filepath = artifact_path
+        ort.InferenceSession(exported_path, sess_options=options, providers=['CPUExecutionProvider'])
+    export_seconds = time.perf_counter() - tic
+
+    onnx_adapter = OnnxAdapter(adapter=adapter, model_path=artifact_path, intra_op_threads=intra_op_threads)
+    inputs = adapter.preprocess(sample_inputs)
+    report = {
+        'quantized': bool(quantize),
+        'intraOpThreads': intra_op_threads,
+        'batchSize': len(sample_inputs),
+        'exportSeconds': export_seconds,
+        'sizeBytes': os.path.getsize(artifact_path),
+        'eagerLatencyMs': _latency_ms(adapter.predict, sample_inputs, iterations=iterations),
+        'onnxLatencyMs': _latency_ms(onnx_adapter.predict, sample_inputs, iterations=iterations),
+        'agreement': agreement(expected=adapter.forward(inputs),
+                               actual=onnx_adapter.session.run(None, inputs),
+                               tolerance=quantized_tolerance if quantize else tolerance),
+    }
+    report['speedup'] = report['eagerLatencyMs']['p50'] / max(report['onnxLatencyMs']['p50'], 1e-9)
+    return artifact_path, report
+
+
+def save_artifact(snapshot, artifact_path, report):
+    """
+        Upload the artifact to the sidecar of the snapshot's bucket and describe it in the snapshot's metadata
+    """
+    from handlers.entities import entities
+    from handlers.snapshot_transfer import ItemBucketStore
+    if not ItemBucketStore.supports(snapshot.bucket):
+        raise ValueError('Snapshot {!r} bucket does not support storing the onnx artifact'.format(snapshot.id))
+    with open(artifact_path, 'rb') as f:
+        ItemBucketStore(snapshot.bucket).write(ARTIFACT_PATH, f.read())
+    snapshot.metadata.setdefault('system', dict())[METADATA_KEY] = {
+        'path': ARTIFACT_PATH,
+        'sha256': file_sha256(artifact_path),
+        'exportedAt': datetime.datetime.utcnow().isoformat(),
+        'report': report,
+    }
+    entities.update(snapshot)
+
+
+def clear_artifact(snapshot):
+    """
+        Drop the artifact's description from the snapshot's metadata, when the artifact no longer matches the
+        snapshot's weights (retrained) or is not in its bucket (cloned). Does not update the snapshot
+
+    Returns:
+        bool: True if the snapshot described an artifact
+    """
+    return snapshot.metadata.get('system', dict()).pop(METADATA_KEY, None) is not None
+
+
+def artifact_info(snapshot):
+    if snapshot is None:
+        return None
+    return (getattr(snapshot, 'metadata', None) or dict()).get('system', dict()).get(METADATA_KEY)
+
+
+def fetch_artifact(snapshot, local_path):
+    """
+        Download the snapshot's onnx artifact into `local_path`, verified
+
+    Returns:
+        str: path of the model file
+    """
+    from handlers.snapshot_transfer import ItemBucketStore
+    info = artifact_info(snapshot)
+    data = ItemBucketStore(snapshot.bucket).read(info['path'])
+    if data is None or hashlib.sha256(data).hexdigest() != info['sha256']:
+        raise ValueError('Missing or corrupted onnx artifact of snapshot {!r}'.format(snapshot.id))
+    os.makedirs(local_path, exist_ok=True)
+    model_path = os.path.join(local_path, MODEL_FILENAME)
+    with open(model_path, 'wb') as f:
+        f.write(data)
+    return model_path
@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+
+from handlers.columnar import COLUMNAR_FORMAT, ColumnarPredictions
+
+logger = logging.getLogger(name=__name__)
+
+DEFAULT_CACHE_PATH = os.environ.get('MODEL_MGMT_PREDICTION_CACHE_PATH',
+                                    os.path.join(os.path.expanduser('~'), '.dataloop', 'model_mgmt', 'predictions.db'))
+
+
+def content_hash(item, buffer=None):
+    """
+        Hash of the item's binary: the platform's md5 if available, else the md5 of the downloaded buffer.
+        None if neither is available
+    """
+    md5 = item.metadata.get('system', dict()).get('md5')
+    if md5:
+        return md5
+    if buffer is not None:
+        return hashlib.md5(buffer.getvalue() if hasattr(buffer, 'getvalue') else buffer).hexdigest()
+    return None
+
+
+def snapshot_version(snapshot):
+    """
+        Hash of everything in the snapshot that changes its predictions: its configuration and update time
+    """
+    configuration = json.dumps(getattr(snapshot, 'configuration', None), sort_keys=True, default=str)
+    updated_at = getattr(snapshot, 'updated_at', None) or getattr(snapshot, 'created_at', None)
+    return hashlib.sha1('{}:{}'.format(configuration, updated_at).encode()).hexdigest()
+
+
+def serialize(prediction):
+    return json.dumps(prediction.to_json() if hasattr(prediction, 'to_json') else prediction)
+
+
+def deserialize(payload, item=None):
+    _json = json.loads(payload)
+    if isinstance(_json, dict) and _json.get('format') == COLUMNAR_FORMAT:
+        return ColumnarPredictions.from_json(_json)
+    if isinstance(_json, dict) and 'annotations' in _json:
+        import dtlpy as dl
+        return dl.AnnotationCollection.from_json(_json=_json['annotations'], item=item)
+    return _json
+
+
+class PredictionCache:
+    """
+    Local persistent (sqlite) cache of predictions keyed by (snapshot id, snapshot version, item content hash).
+    Bounded by the total payload size, least recently used entries are evicted first.
+    Also remembers to which items a cached prediction was already uploaded, to skip identical uploads
+    """
+
+    def __init__(self, path=None, max_size_mb=512):
+        self.path = path if path is not None else DEFAULT_CACHE_PATH
+        self.max_size = int(max_size_mb * 1024 ** 2)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS predictions ('
+                         'key TEXT PRIMARY KEY, snapshot_id TEXT, version TEXT, payload TEXT, '
+                         'size INTEGER, last_used REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS predictions_snapshot ON predictions (snapshot_id, version)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS uploads (key TEXT, item_id TEXT, PRIMARY KEY (key, item_id))')
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(snapshot, content, variant=None):
+        key = '{}:{}:{}'.format(snapshot.id, snapshot_version(snapshot), content)
+        if variant is not None:
+            # e.g. the post processing applied to the adapter's predictions
+            key = '{}:{}'.format(key, variant)
+        return key
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT payload FROM predictions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute('UPDATE predictions SET last_used = ? WHERE key = ?', (time.time(), key))
+            return row[0]
+
+    def put(self, key, snapshot, payload):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)',
+                             (key, snapshot.id, snapshot_version(snapshot), payload, len(payload), time.time()))
+            self._evict()
+
+    def was_uploaded(self, key, item_id):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM uploads WHERE key = ? AND item_id = ?',
+                                    (key, item_id)).fetchone() is not None
+
+    def mark_uploaded(self, key, item_id):
+        with self._lock:
+            self._db.execute('INSERT OR IGNORE INTO uploads VALUES (?, ?)', (key, item_id))
+
+    def invalidate_snapshot(self, snapshot):
+        """
+            Drop the entries of older versions of the snapshot
+        """
+        with self._lock:
+            keys = [row[0] for row in self._db.execute(
+                'SELECT key FROM predictions WHERE snapshot_id = ? AND version != ?',
+                (snapshot.id, snapshot_version(snapshot)))]
+            self._delete(keys)
+        if keys:
+            logger.info("Invalidated {n} cached predictions of snapshot {s!r}".format(n=len(keys), s=snapshot.id))
+
+    def _delete(self, keys):
+        for key in keys:
+            self._db.execute('DELETE FROM predictions WHERE key = ?', (key,))
+            self._db.execute('DELETE FROM uploads WHERE key = ?', (key,))
+
+    def _evict(self):
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM predictions').fetchone()[0]
+        if total <= self.max_size:
+            return
+        keys = list()
+        for key, size in self._db.execute('SELECT key, size FROM predictions ORDER BY last_used'):
+            if total <= self.max_size:
+                break
+            keys.append(key)
+            total -= size
+        self._delete(keys)
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM predictions').fetchone()
+        requests = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else None,
+                'entries': entries,
+                'size_mb': size / 1024 ** 2}
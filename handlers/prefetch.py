@@ -0,0 +1,129 @@
+import io
+import time
+import logging
+import threading
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(name=__name__)
+
+
+def download_item(item):
+    """
+        Download the item's binary into memory
+    """
+    return item.download(save_locally=False)
+
+
+def decode_image(buffer):
+    """
+        Decode an in-memory image into an RGB HxWx3 uint8 array
+    """
+    if isinstance(buffer, (bytes, bytearray)):
+        buffer = io.BytesIO(buffer)
+    with Image.open(buffer) as image:
+        return np.asarray(image.convert('RGB'))
+
+
+class PrefetchPipeline:
+    """
+    Producer / consumer pipeline that keeps the model busy:
+        download (thread pool) -> decode (thread pool) -> bounded queue -> consumer
+    At most `queue_depth` items are in flight, which also caps the memory of the decoded arrays
+    """
+
+    def __init__(self, download_fn=download_item, decode_fn=decode_image,
+                 download_workers=4, decode_workers=2, queue_depth=16):
+        self.download_fn = download_fn
+        self.decode_fn = decode_fn
+        self.download_workers = max(int(download_workers), 1)
+        self.decode_workers = max(int(decode_workers), 1)
+        self.queue_depth = max(int(queue_depth), 1)
+        self._download_pool = ThreadPoolExecutor(max_workers=self.download_workers,
+                                                 thread_name_prefix='prefetch-download')
+        self._decode_pool = ThreadPoolExecutor(max_workers=self.decode_workers,
+                                               thread_name_prefix='prefetch-decode')
+        self._lock = threading.Lock()
+        self._busy = collections.defaultdict(float)
+        self._counts = collections.defaultdict(int)
+        self._started = None
+
+    def _timed(self, stage, fn, *args):
+        tic = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self._busy[stage] += time.perf_counter() - tic
+                self._counts[stage] += 1
+
+    def _submit(self, item):
+        result = Future()
+
+        def on_downloaded(download_future):
+            try:
+                buffer = download_future.result()
+                decode_future = self._decode_pool.submit(self._timed, 'decode', self.decode_fn, buffer)
+            except Exception as err:
+                result.set_exception(err)
+                return
+            decode_future.add_done_callback(on_decoded)
+
+        def on_decoded(decode_future):
+            try:
+                result.set_result(decode_future.result())
+            except Exception as err:
+                result.set_exception(err)
+
+        self._download_pool.submit(self._timed, 'download', self.download_fn, item).add_done_callback(on_downloaded)
+        return result
+
+    def iterate(self, items):
+        """
+            Yield (item, array, error) in the input order, prefetching up to `queue_depth` items ahead.
+            `error` is the download / decode exception of the item (and `array` is None)
+        """
+        if self._started is None:
+            self._started = time.perf_counter()
+        pending = collections.deque()
+        items = iter(items)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.queue_depth:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending.append((item, self._submit(item)))
+            if len(pending) == 0:
+                return
+            item, future = pending.popleft()
+            tic = time.perf_counter()
+            try:
+                array, error = future.result(), None
+            except Exception as err:
+                array, error = None, err
+            with self._lock:
+                self._busy['consumer_wait'] += time.perf_counter() - tic
+            yield item, array, error
+
+    def stats(self):
+        """
+            Busy time, number of calls and utilization of every stage.
+            A high `consumer_wait` means the model is starved by the download / decode stages
+        """
+        elapsed = time.perf_counter() - self._started if self._started is not None else 0
+        workers = {'download': self.download_workers, 'decode': self.decode_workers, 'consumer_wait': 1}
+        with self._lock:
+            return {stage: {'busy_s': busy,
+                            'count': self._counts[stage],
+                            'utilization': busy / (elapsed * workers[stage]) if elapsed > 0 else 0}
+                    for stage, busy in self._busy.items()}
+
+    def close(self):
+        self._download_pool.shutdown(wait=True)
+        self._decode_pool.shutdown(wait=True)
@@ -0,0 +1,470 @@
+import time
+import uuid
+import hashlib
+import logging
+import datetime
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import dtlpy as dl
+
+logger = logging.getLogger(name=__name__)
+
+# key of the sharded prediction runs records in the dataset's system metadata
+SHARDS_METADATA_KEY = 'modelMgmtShardedPredict'
+SHARD_BY = ('page_range', 'id_hash')
+# items per page of the page range shards, the shards are made of whole pages
+DEFAULT_SHARD_PAGE_SIZE = 100
+# executions the service running the shards must run at once when the coordinator is one of them
+MIN_COORDINATED_CAPACITY = 2
+# a shard is a straggler when it runs this many times longer than the median shard
+DEFAULT_STRAGGLER_FACTOR = 1.5
+# execution statuses of a shard
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCESS = 'success'
+FAILED = 'failed'
+
+
+def shard_of(item_id, num_shards):
+    """
+        Deterministic shard of an item - the same id always falls in the same shard
+    """
+    return int(hashlib.md5(item_id.encode()).hexdigest()[:8], 16) % num_shards
+
+
+def shard_pages(num_pages, shard, num_shards):
+    """
+        [first, last) pages of a shard, the pages split in `num_shards` contiguous ranges
+    """
+    return num_pages * shard // num_shards, num_pages * (shard + 1) // num_shards
+
+
+def build_filters(filters=None):
+    """
+        The items query of a shard, sorted by id so the pages are the same in every execution.
+        dict is used as a custom filter: the whole query if it has a 'filter', else its 'filter'
+    """
+    if isinstance(filters, dl.Filters):
+        query = filters
+    else:
+        query = dl.Filters()
+        if filters:
+            query.custom_filter = dict(filters) if 'filter' in filters else {'filter': dict(filters)}
+    # id last, after the query's own sort if any, to make the order total
+    query.sort_by(field='id')
+    if query.custom_filter is not None:
+        # a custom filter is sent as is, without the filters' sort
+        sort = dict(query.custom_filter.get('sort') or dict())
+        sort.pop('id', None)
+        sort['id'] = 'ascending'
+        query.custom_filter['sort'] = sort
+    return query
+
+
+def shard_items(dataset, shard, num_shards, shard_by='page_range', filters=None,
+                page_size=DEFAULT_SHARD_PAGE_SIZE):
+    """
+        The pages of the items of a shard of the (filtered) dataset.
+        'page_range' shards fetch only their pages, 'id_hash' shards list the whole query and keep their ids:
+        slower to list, but the assignment does not move when items are added or removed during the run
+
+    Returns:
+        (pages iterable, number of items - None if unknown before listing)
+    """
+    if shard_by not in SHARD_BY:
+        raise ValueError('Unknown shard_by {!r}, expected one of {}'.format(shard_by, SHARD_BY))
+    pages = dataset.items.list(filters=build_filters(filters), page_size=page_size)
+    if shard_by == 'id_hash':
+        return ([item for item in page if shard_of(item.id, num_shards) == shard] for page in pages), None
+    num_pages = -(-pages.items_count // page_size)
+    first, last = shard_pages(num_pages=num_pages, shard=shard, num_shards=num_shards)
+    total = max(min(last * page_size, pages.items_count) - first * page_size, 0)
+    return (pages[i_page] for i_page in range(first, last)), total
+
+
+def get_run_record(dataset, run_id):
+    return dataset.metadata.get('system', dict()).get(SHARDS_METADATA_KEY, dict()).get(run_id)
+
+
+def save_run_record(dataset, record):
+    record['updatedAt'] = datetime.datetime.utcnow().isoformat()
+    dataset.metadata.setdefault('system', dict()).setdefault(SHARDS_METADATA_KEY, dict())[record['runId']] = record
+    dataset.update(system_metadata=True)
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def shards_stats(record, wall_seconds=None, ran_shards=None, straggler_factor=DEFAULT_STRAGGLER_FACTOR):
+    """
+        Aggregate throughput of the run and the stragglers: the shards that ran `straggler_factor` times longer
+        than the median shard. The throughput counts the items of `ran_shards`, those run in `wall_seconds`
+    """
+    shards = record['shards']
+    finished = {shard: s for shard, s in shards.items() if s['status'] == SUCCESS}
+    durations = {shard: s['elapsedSeconds'] for shard, s in finished.items() if s.get('elapsedSeconds') is not None}
+    success = sum(s.get('success') or 0 for s in finished.values())
+    failed = sum(s.get('failed') or 0 for s in finished.values())
+    ran_items = sum((s.get('success') or 0) + (s.get('failed') or 0) for shard, s in finished.items()
+                    if ran_shards is None or shard in ran_shards)
+    stats = {
+        'shards': len(shards),
+        'shardsSucceeded': len(finished),
+        'shardsFailed': sum(s['status'] == FAILED for s in shards.values()),
+        'attempts': sum(s['attempts'] for s in shards.values()),
+        'items': success + failed,
+        'success': success,
+        'failed': failed,
+        'wallSeconds': wall_seconds,
+        'itemsPerSecond': ran_items / wall_seconds if wall_seconds else None,
+        # the throughput of a single replica
+        'shardItemsPerSecond': _percentile([s['itemsPerSecond'] for s in finished.values()
+                                            if s.get('itemsPerSecond')], 50),
+        'shardSeconds': {'p50': _percentile(list(durations.values()), 50),
+                         'p95': _percentile(list(durations.values()), 95),
+                         'max': max(durations.values()) if durations else None},
+    }
+    median = stats['shardSeconds']['p50']
+    stats['stragglers'] = sorted([{'shard': int(shard),
+                                   'elapsedSeconds': seconds,
+                                   'items': finished[shard].get('items'),
+                                   'ratio': seconds / median}
+                                  for shard, seconds in durations.items()
+                                  if median and seconds > straggler_factor * median],
+                                 key=lambda straggler: -straggler['ratio'])
+    # wall time lost waiting for the slowest shard
+    stats['imbalance'] = stats['shardSeconds']['max'] / median if median else None
+    return stats
+
+
+def service_capacity(service):
+    """
+        Max number of executions the service runs at once: its concurrency times its max replicas
+    """
+    runtime = getattr(service, 'runtime', None)
+    autoscaler = getattr(runtime, 'autoscaler', None)
+    concurrency = getattr(runtime, 'concurrency', None) or 1
+    max_replicas = getattr(autoscaler, 'max_replicas', None) or 1
+    return int(concurrency) * int(max_replicas)
+
+
+class ServiceShardExecutor:
+    """
+    Runs the shards as executions of the predict service, so the platform spreads them over its replicas
+    """
+
+    def __init__(self, service, function_name='predict_shard'):
+        self.service = service
+        self.function_name = function_name
+
+    def submit(self, shard, shard_input):
+        execution_input = dict(shard_input)
+        execution_input['dataset'] = {'dataset_id': execution_input.pop('dataset_id')}
+        execution = self.service.execute(execution_input=execution_input,
+                                         function_name=self.function_name,
+                                         project_id=self.service.project_id,
+                                         sync=False)
+        return execution.id
+
+    @staticmethod
+    def attach(execution_id):
+        """
+            The handle of a shard's execution submitted by a previous coordinator
+        """
+        return execution_id
+
+    @staticmethod
+    def poll(handle):
+        """
+        Returns:
+            (status, output, error, percent complete)
+        """
+        execution = dl.executions.get(execution_id=handle)
+        latest_status = execution.latest_status or dict()
+        status = latest_status.get('status')
+        if status == 'success':
+            return SUCCESS, execution.output, None, 100
+        if status in ('failed', 'aborted', 'terminated'):
+            return FAILED, None, latest_status.get('message') or status, None
+        return RUNNING, None, None, latest_status.get('percentComplete')
+
+    @staticmethod
+    def cancel(handle):
+        dl.executions.get(execution_id=handle).terminate()
+
+    def close(self):
+        pass
+
+
+class _LocalProgress:
+    """
+    dl.Progress of a local shard, shared with the coordinator's process
+    """
+
+    def __init__(self, shared, shard):
+        self.shared = shared
+        self.shard = shard
+
+    def update(self, progress=None, message=None, **kwargs):
+        if progress is not None:
+            self.shared[self.shard] = progress
+
+
+# runner of the local shards process, built on its first shard
+_local_runner = None
+
+
+def _run_local_shard(runner_kwargs, shard_input, shared_progress):
+    global _local_runner
+    from handlers.entities import entities
+    from handlers.model_mgmt_utils_predict import ServiceRunner
+    if _local_runner is None:
+        _local_runner = ServiceRunner(**runner_kwargs)
+    shard_input = dict(shard_input)
+    dataset = entities.dataset(dataset_id=shard_input.pop('dataset_id'))
+    return _local_runner.predict_shard(dataset=dataset,
+                                       progress=_LocalProgress(shared=shared_progress, shard=shard_input['shard']),
+                                       **shard_input)
+
+
+class LocalShardExecutor:
+    """
+    Stand-in for the predict service: the shards run in local processes, each with its own runner
+    """
+
+    def __init__(self, runner_kwargs, workers=2, start_method=None):
+        """
+        Args:
+            runner_kwargs (dict): init inputs of the processes' predict runners
+            workers (int, optional): number of processes. Defaults to 2.
+            start_method (str, optional): multiprocessing start method. Defaults to None ==> that of the worker
+                                          processes (see handlers/worker_pool.py).
+        """
+        from handlers.worker_pool import DEFAULT_START_METHOD
+        context = multiprocessing.get_context(start_method or DEFAULT_START_METHOD)
+        self.runner_kwargs = runner_kwargs
+        self._manager = context.Manager()
+        self._progress = self._manager.dict()
+        self._pool = ProcessPoolExecutor(max_workers=int(workers), mp_context=context)
+
+    def submit(self, shard, shard_input):
+        return shard, self._pool.submit(_run_local_shard, self.runner_kwargs, shard_input, self._progress)
+
+    @staticmethod
+    def attach(execution_id):
+        # the processes of a previous coordinator are gone
+        return None
+
+    def poll(self, handle):
+        shard, future = handle
+        if not future.done():
+            return RUNNING, None, None, self._progress.get(shard)
+        error = future.exception()
+        if error is not None:
+            return FAILED, None, '{}: {}'.format(type(error).__name__, error), None
+        return SUCCESS, future.result(), None, 100
+
+    @staticmethod
+    def cancel(handle):
+        # only a shard still queued is cancelled, a running one finishes in its process
+        handle[1].cancel()
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self._manager.shutdown()
+
+
+class ShardedPrediction:
+    """
+    Coordinator of a sharded prediction run over a dataset query. The shards are deterministic, so the run is
+    resumable: its record in the dataset's metadata holds every shard's status, attempts and report, and a
+    coordinator given the same `run_id` runs only the shards that did not succeed
+    """
+
+    def __init__(self, executor, dataset, num_shards, shard_by='page_range', filters=None,
+                 page_size=DEFAULT_SHARD_PAGE_SIZE, shard_kwargs=None, run_id=None, max_parallel=None,
+                 max_attempts=3, poll_interval_s=5, shard_timeout_s=None, straggler_factor=DEFAULT_STRAGGLER_FACTOR):
+        """
+        Args:
+            executor: ServiceShardExecutor or LocalShardExecutor
+            dataset (dl.Dataset): dataset to predict
+            num_shards (int): number of shards
+            shard_by (str, optional): 'page_range' or 'id_hash'. Defaults to 'page_range'.
+            filters (dict, optional): items query, used as a custom filter. Defaults to None.
+            page_size (int, optional): items per page. Defaults to 100.
+            shard_kwargs (dict, optional): other inputs of every shard (batch_size, with_upload...). Defaults to None.
+            run_id (str, optional): id of the run to resume. Defaults to None (a new run).
+            max_parallel (int, optional): max number of shards running at once. Defaults to None (all).
+            max_attempts (int, optional): runs of a failing shard before it is given up. Defaults to 3.
+            poll_interval_s (float, optional): seconds between polls of the running shards. Defaults to 5.
+            shard_timeout_s (float, optional): a shard running longer is cancelled and failed. Defaults to None.
+            straggler_factor (float, optional): a shard slower than this times the median shard is reported as a
+                                                straggler. Defaults to 1.5.
+        """
+        if shard_by not in SHARD_BY:
+            raise ValueError('Unknown shard_by {!r}, expected one of {}'.format(shard_by, SHARD_BY))
+        if isinstance(filters, dl.Filters):
+            filters = filters.prepare()
+        self.executor = executor
+        self.dataset = dataset
+        self.max_parallel = int(max_parallel) if max_parallel else int(num_shards)
+        self.max_attempts = max(int(max_attempts), 1)
+        self.poll_interval_s = poll_interval_s
+        self.shard_timeout_s = shard_timeout_s
+        self.straggler_factor = straggler_factor
+        self.record = get_run_record(dataset=dataset, run_id=run_id) if run_id is not None else None
+        if self.record is None:
+            self.record = {
+                'runId': run_id or uuid.uuid4().hex,
+                'datasetId': dataset.id,
+                'numShards': int(num_shards),
+                'shardBy': shard_by,
+                'pageSize': int(page_size),
+                'filters': filters,
+                'shardInputs': shard_kwargs or dict(),
+                'createdAt': datetime.datetime.utcnow().isoformat(),
+                'shards': {str(shard): {'status': PENDING, 'attempts': 0} for shard in range(int(num_shards))},
+            }
+        elif (self.record['numShards'], self.record['shardBy'], self.record['filters']) != \
+                (int(num_shards), shard_by, filters):
+            # other shards would repeat or skip items
+            raise ValueError('Run {!r} was sharded as {} {!r} shards of {}, can not resume it differently'.format(
+                run_id, self.record['numShards'], self.record['shardBy'], self.record['filters']))
+
+    @property
+    def run_id(self):
+        return self.record['runId']
+
+    def _shard_input(self, shard):
+        shard_input = dict(self.record['shardInputs'])
+        shard_input.update(dataset_id=self.record['datasetId'],
+                           shard=int(shard),
+                           num_shards=self.record['numShards'],
+                           shard_by=self.record['shardBy'],
+                           filters=self.record['filters'],
+                           page_size=self.record['pageSize'])
+        return shard_input
+
+    def _submit(self, shard):
+        state = self.record['shards'][shard]
+        handle = self.executor.submit(shard=int(shard), shard_input=self._shard_input(shard))
+        state.update(status=RUNNING, attempts=state['attempts'] + 1, submittedAt=time.time(), progress=0)
+        state.pop('error', None)
+        if isinstance(handle, str):
+            state['executionId'] = handle
+        logger.info("Submitted shard {s}/{n} of run {r!r} (attempt {a})".format(
+            s=shard, n=self.record['numShards'], r=self.run_id, a=state['attempts']))
+        return handle
+
+    def _finished(self, shard, output):
+        state = self.record['shards'][shard]
+        state.update(status=SUCCESS,
+                     finishedAt=time.time(),
+                     progress=100,
+                     items=output.get('items'),
+                     success=output.get('success'),
+                     failed=output.get('failed'),
+                     elapsedSeconds=output.get('elapsedSeconds'),
+                     itemsPerSecond=output.get('itemsPerSecond'))
+
+    def _failed(self, shard, error, pending):
+        state = self.record['shards'][shard]
+        state.update(finishedAt=time.time(), error=str(error))
+        if state['attempts'] < self.max_attempts:
+            logger.warning("Shard {s} of run {r!r} failed, retrying: {e}".format(s=shard, r=self.run_id, e=error))
+            state['status'] = PENDING
+            pending.append(shard)
+        else:
+            logger.error("Shard {s} of run {r!r} failed {a} times, giving up: {e}".format(
+                s=shard, r=self.run_id, a=state['attempts'], e=error))
+            state['status'] = FAILED
+
+    def run(self, progress=None):
+        """
+            Run the shards that did not succeed yet, until each succeeds or runs out of attempts
+
+        Returns:
+            dict: the run's id, status and statistics
+        """
+        tic = time.perf_counter()
+        shards = self.record['shards']
+        running = dict()
+        pending = collections.deque()
+        for shard, state in shards.items():
+            if state['status'] == SUCCESS:
+                continue
+            # still running from a previous coordinator
+            handle = self.executor.attach(state['executionId']) if state['status'] == RUNNING and state.get(
+                'executionId') else None
+            if handle is not None:
+                running[shard] = handle
+                continue
+            if state['status'] == FAILED:
+                # a new run of a given up shard gets a fresh budget
+                state['attempts'] = 0
+            state['status'] = PENDING
+            pending.append(shard)
+        logger.info("Sharded prediction run {r!r}: {p} shards to run, {a} running, {d} done".format(
+            r=self.run_id, p=len(pending), a=len(running), d=len(shards) - len(pending) - len(running)))
+
+        ran_shards = set(pending) | set(running)
+        self.record['status'] = RUNNING
+        try:
+            while pending or running:
+                changed = bool(pending) and len(running) < self.max_parallel
+                while pending and len(running) < self.max_parallel:
+                    shard = pending.popleft()
+                    running[shard] = self._submit(shard)
+                if changed:
+                    # the executions ids, for a coordinator resuming the run
+                    save_run_record(dataset=self.dataset, record=self.record)
+                time.sleep(self.poll_interval_s)
+                for shard, handle in list(running.items()):
+                    state = shards[shard]
+                    try:
+                        status, output, error, percent = self.executor.poll(handle)
+                    except Exception as err:
+                        logger.warning("Failed polling shard {s}: {e}".format(s=shard, e=err))
+                        continue
+                    if status == RUNNING:
+                        if percent is not None and percent != state.get('progress'):
+                            state['progress'] = percent
+                            changed = True
+                        if self.shard_timeout_s is not None and \
+                                time.time() - state['submittedAt'] > self.shard_timeout_s:
+                            self.executor.cancel(handle)
+                            running.pop(shard)
+                            self._failed(shard, error='timed out after {}s'.format(self.shard_timeout_s),
+                                         pending=pending)
+                            changed = True
+                        continue
+                    running.pop(shard)
+                    changed = True
+                    if status == SUCCESS:
+                        self._finished(shard, output=output or dict())
+                    else:
+                        self._failed(shard, error=error, pending=pending)
+                if progress is not None:
+                    done = sum(state['status'] == SUCCESS for state in shards.values())
+                    progress.update(progress=int(np.mean([state.get('progress') or 0 for state in shards.values()])),
+                                    message='shards: {}/{} done, {} running'.format(done, len(shards), len(running)))
+                if changed and running:
+                    save_run_record(dataset=self.dataset, record=self.record)
+        finally:
+            failed = any(state['status'] != SUCCESS for state in shards.values())
+            self.record['status'] = FAILED if failed else SUCCESS
+            self.record['stats'] = shards_stats(record=self.record,
+                                                wall_seconds=time.perf_counter() - tic,
+                                                ran_shards=ran_shards,
+                                                straggler_factor=self.straggler_factor)
+            save_run_record(dataset=self.dataset, record=self.record)
+        logger.info("Sharded prediction run {r!r} {s}: {stats}".format(r=self.run_id, s=self.record['status'],
+                                                                       stats=self.record['stats']))
+        return {'runId': self.run_id,
+                'status': self.record['status'],
+                'failedShards': sorted((int(shard) for shard, state in shards.items() if state['status'] != SUCCESS)),
+                'stats': self.record['stats']}
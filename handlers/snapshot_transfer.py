@@ -0,0 +1,469 @@
+import io
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(name=__name__)
+
+DEFAULT_CHUNK_SIZE_MB = float(os.environ.get('MODEL_MGMT_TRANSFER_CHUNK_SIZE_MB', 64))
+DEFAULT_WORKERS = int(os.environ.get('MODEL_MGMT_TRANSFER_WORKERS', 8))
+# the chunked artifacts are stored next to the bucket's directory, in <bucket directory><SIDECAR_SUFFIX>
+SIDECAR_SUFFIX = '.model_mgmt'
+# the remote manifest is written last - a sidecar without it was never (fully) saved
+MANIFEST_FILENAME = 'manifest.json'
+CHUNKS_DIRNAME = 'chunks'
+# snapshot metadata (under 'system') marking the snapshots saved with the chunked layout
+METADATA_KEY = 'modelMgmtArtifacts'
+# local record of the files hashes, to not hash unchanged files again
+STATE_FILENAME = '.model_mgmt_transfer_state.json'
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class ItemBucketStore:
+    """
+    Sidecar of a snapshot's item bucket: chunks, manifest and other artifacts of this package, stored as items in
+    a directory next to the bucket's directory item - never among the bucket's own files
+    """
+
+    def __init__(self, bucket):
+        directory_item = bucket.directory_item
+        self.dataset = directory_item.dataset
+        self.bucket_root = directory_item.filename.rstrip('/')
+        self.root = self.bucket_root + SIDECAR_SUFFIX
+
+    @staticmethod
+    def supports(bucket):
+        return getattr(bucket, 'directory_item', None) is not None
+
+    def _remote_path(self, rel_path):
+        return '{}/{}'.format(self.root, rel_path)
+
+    def _list(self, field, values):
+        import dtlpy as dl
+        filters = dl.Filters()
+        filters.add(field=field, values=values)
+        return [item for page in self.dataset.items.list(filters=filters) for item in page]
+
+    def list_chunks(self):
+        return {item.name for item in self._list(field='dir', values=self._remote_path(CHUNKS_DIRNAME))}
+
+    def copy_chunks(self, shas, store):
+        """
+            Copy chunks to another sidecar, on the platform (the binaries are not transferred)
+        """
+        for item in self._list(field='dir', values=self._remote_path(CHUNKS_DIRNAME)):
+            if item.name in shas:
+                item.clone(dst_dataset_id=store.dataset.id,
+                           remote_filepath=store._remote_path('{}/{}'.format(CHUNKS_DIRNAME, item.name)))
+
+    def clear_bucket(self):
+        """
+            Delete the bucket's own files (saved by the adapter)
+
+        Returns:
+            int: number of deleted files
+        """
+        items = self._list(field='filename', values='{}/*'.format(self.bucket_root))
+        for item in items:
+            item.delete()
+        return len(items)
+
+    def read(self, rel_path):
+        import dtlpy as dl
+        try:
+            item = self.dataset.items.get(filepath=self._remote_path(rel_path))
+        except dl.exceptions.NotFound:
+            return None
+        return item.download(save_locally=False).getvalue()
+
+    def write(self, rel_path, data):
+        buffer = io.BytesIO(data)
+        buffer.name = os.path.basename(rel_path)
+        self.dataset.items.upload(local_path=buffer,
+                                  remote_path=os.path.dirname(self._remote_path(rel_path)),
+                                  overwrite=True)
+
+    def delete(self, rel_path):
+        self.dataset.items.delete(filename=self._remote_path(rel_path))
+
+
+class SnapshotTransfer:
+    """
+    Chunked, parallel and resumable transfer of a snapshot's artifacts directory.
+
+    The files are split in fixed size chunks, stored once by their sha256 in the bucket's sidecar (see
+    ItemBucketStore), with a manifest listing every file's chunks. This layout replaces the bucket's own files:
+    the adapter's `load_from_snapshot` finds an empty bucket, the snapshots saved this way (marked by
+    metadata.system.modelMgmtArtifacts) are read with `load_from_snapshot` / `download_artifacts` below. So:
+        - a save uploads only the chunks the sidecar does not have yet
+        - an interrupted upload resumes: the chunks uploaded before the interruption are in the sidecar
+        - an interrupted download resumes from the verified chunks in the staging directory, and chunks
+          of the previous local version of the files are copied instead of downloaded: a file that changed in
+          a few places (e.g. only the head weights) moves only the changed chunks
+    Every chunk and every assembled file is verified against its sha256.
+    A save that does not go through this transfer must `discard` the sidecar's manifest
+    """
+
+    def __init__(self, store, chunk_size_mb=None, workers=None, max_retries=3, backoff_s=0.5):
+        self.store = store
+        self.chunk_size = int((chunk_size_mb if chunk_size_mb is not None else DEFAULT_CHUNK_SIZE_MB) * 1024 ** 2)
+        self.workers = workers if workers is not None else DEFAULT_WORKERS
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+
+    #########
+    # local #
+    #########
+    @staticmethod
+    def _read_state(local_path):
+        try:
+            with open(os.path.join(local_path, STATE_FILENAME), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    @staticmethod
+    def _write_state(local_path, state):
+        with open(os.path.join(local_path, STATE_FILENAME), 'w') as f:
+            json.dump(state, f)
+
+    def _hash_file(self, filepath):
+        chunks = list()
+        file_sha = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for data in iter(lambda: f.read(self.chunk_size), b''):
+                file_sha.update(data)
+                chunks.append({'sha256': sha256(data), 'size': len(data)})
+        return {'size': os.path.getsize(filepath), 'sha256': file_sha.hexdigest(), 'chunks': chunks}
+
+    def local_manifest(self, local_path):
+        """
+            rel path -> size, sha256 and chunks of every file in the directory.
+            Files with the same size and modification time as in the last transfer are not hashed again
+        """
+        state = self._read_state(local_path)
+        files = dict()
+        for dirpath, _, filenames in os.walk(local_path):
+            for filename in filenames:
+                if filename == STATE_FILENAME:
+                    continue
+                filepath = os.path.join(dirpath, filename)
+                rel_path = os.path.relpath(filepath, local_path).replace(os.sep, '/')
+                stat = os.stat(filepath)
+                cached = state.get(rel_path)
+                if cached is not None and cached.get('chunkSize') == self.chunk_size and \
+                        cached['size'] == stat.st_size and cached.get('mtime') == stat.st_mtime_ns:
+                    entry = {k: cached[k] for k in ('size', 'sha256', 'chunks')}
+                else:
+                    entry = self._hash_file(filepath)
+                files[rel_path] = entry
+                state[rel_path] = dict(entry, mtime=stat.st_mtime_ns, chunkSize=self.chunk_size)
+        self._write_state(local_path, {rel_path: state[rel_path] for rel_path in files})
+        return files
+
+    ##########
+    # remote #
+    ##########
+    def _retry(self, fn, *args):
+        for i_try in range(self.max_retries + 1):
+            try:
+                return fn(*args)
+            except Exception:
+                if i_try == self.max_retries:
+                    raise
+                time.sleep(self.backoff_s * 2 ** i_try)
+
+    def remote_manifest(self):
+        data = self._retry(self.store.read, MANIFEST_FILENAME)
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def upload(self, local_path):
+        """
+            Save the directory to the sidecar, replacing its previous content and the bucket's own files
+
+        Returns:
+            dict: transfer stats
+        """
+        tic = time.perf_counter()
+        files = self.local_manifest(local_path)
+        previous = self.remote_manifest()
+        remote_chunks = self._retry(self.store.list_chunks)
+
+        # chunk sha -> (file, offset, size) of the chunks missing in the sidecar
+        missing = dict()
+        for rel_path, entry in files.items():
+            offset = 0
+            for chunk in entry['chunks']:
+                if chunk['sha256'] not in remote_chunks and chunk['sha256'] not in missing:
+                    missing[chunk['sha256']] = (os.path.join(local_path, rel_path), offset, chunk['size'])
+                offset += chunk['size']
+
+        def upload_chunk(sha):
+            filepath, offset, size = missing[sha]
+            with open(filepath, 'rb') as f:
+                f.seek(offset)
+                data = f.read(size)
+            if sha256(data) != sha:
+                raise ValueError('File {!r} changed during the upload'.format(filepath))
+            self._retry(self.store.write, '{}/{}'.format(CHUNKS_DIRNAME, sha), data)
+            return size
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            uploaded_bytes = sum(pool.map(upload_chunk, list(missing)))
+        manifest = {'chunkSize': self.chunk_size, 'savedAt': time.time(), 'files': files}
+        self._retry(self.store.write, MANIFEST_FILENAME, json.dumps(manifest).encode())
+
+        if previous is None:
+            # files of an earlier save by the adapter, stale from now on
+            deleted = self._retry(self.store.clear_bucket)
+            if deleted:
+                logger.info("Deleted {n} files saved to the bucket without the chunked layout".format(n=deleted))
+
+        # chunks of the replaced files
+        referenced = {chunk['sha256'] for entry in files.values() for chunk in entry['chunks']}
+        for sha in remote_chunks - referenced:
+            try:
+                self.store.delete('{}/{}'.format(CHUNKS_DIRNAME, sha))
+            except Exception:
+                logger.warning("Failed deleting unused chunk {!r}".format(sha))
+
+        previous_files = previous['files'] if previous is not None else dict()
+        stats = {'files': len(files),
+                 'unchanged_files': sum(previous_files.get(rel_path, dict()).get('sha256') == entry['sha256']
+                                        for rel_path, entry in files.items()),
+                 'bytes': sum(entry['size'] for entry in files.values()),
+                 'uploaded_chunks': len(missing),
+                 'uploaded_bytes': uploaded_bytes,
+                 'elapsed_s': time.perf_counter() - tic}
+        logger.info("Uploaded {c} chunks ({b:.1f}MB of {t:.1f}MB) in {e:.1f}s, {u}/{f} files unchanged".
+                    format(c=stats['uploaded_chunks'], b=uploaded_bytes / 1024 ** 2, t=stats['bytes'] / 1024 ** 2,
+                           e=stats['elapsed_s'], u=stats['unchanged_files'], f=stats['files']))
+        return stats
+
+    def discard(self):
+        """
+            Delete the manifest and the chunks, after the adapter saved the snapshot's files to the bucket itself
+
+        Returns:
+            bool: True if there was a manifest
+        """
+        manifest = self.remote_manifest()
+        if manifest is not None:
+            self._retry(self.store.delete, MANIFEST_FILENAME)
+        for sha in self._retry(self.store.list_chunks):
+            try:
+                self.store.delete('{}/{}'.format(CHUNKS_DIRNAME, sha))
+            except Exception:
+                logger.warning("Failed deleting unused chunk {!r}".format(sha))
+        return manifest is not None
+
+    def download(self, local_path, staging_path=None, reuse_paths=None):
+        """
+            Download the snapshot's files from the sidecar into the directory
+
+        Args:
+            local_path (str): destination directory
+            staging_path (str, optional): where chunks are kept until all the files are assembled, so an
+                                          interrupted download resumes. Defaults to None ==> <local_path>/.partial
+            reuse_paths (list, optional): directories with a previous version of the files, whose unchanged
+                                          chunks are copied instead of downloaded. Defaults to None.
+
+        Returns:
+            dict: transfer stats, None if the snapshot was not saved with the chunked layout
+        """
+        tic = time.perf_counter()
+        manifest = self.remote_manifest()
+        if manifest is None:
+            return None
+        chunk_size = manifest['chunkSize']
+        if staging_path is None:
+            staging_path = os.path.join(local_path, '.partial')
+        os.makedirs(local_path, exist_ok=True)
+        os.makedirs(staging_path, exist_ok=True)
+
+        # chunk sha -> local file and offset holding it
+        local_chunks = dict()
+        for path in [local_path] + list(reuse_paths or list()):
+            for rel_path, entry in self._read_state(path).items():
+                if entry.get('chunkSize') != chunk_size:
+                    continue
+                offset = 0
+                for chunk in entry['chunks']:
+                    local_chunks.setdefault(chunk['sha256'], (os.path.join(path, rel_path), offset, chunk['size']))
+                    offset += chunk['size']
+
+        state = self._read_state(local_path)
+        pending = dict()
+        for rel_path, entry in manifest['files'].items():
+            filepath = os.path.join(local_path, rel_path)
+            cached = state.get(rel_path)
+            if cached is not None and cached['sha256'] == entry['sha256'] and os.path.isfile(filepath) and \
+                    os.stat(filepath).st_mtime_ns == cached.get('mtime') and os.path.getsize(filepath) == entry['size']:
+                continue
+            pending[rel_path] = entry
+
+        stats = {'files': len(manifest['files']), 'unchanged_files': len(manifest['files']) - len(pending),
+                 'downloaded_chunks': 0, 'downloaded_bytes': 0, 'reused_chunks': 0, 'resumed_chunks': 0}
+        lock = threading.Lock()
+
+        def fetch_chunk(sha):
+            staged = os.path.join(staging_path, sha)
+            if os.path.isfile(staged):
+                with open(staged, 'rb') as f:
+                    if sha256(f.read()) == sha:
+                        with lock:
+                            stats['resumed_chunks'] += 1
+                        return
+            data = None
+            if sha in local_chunks:
+                filepath, offset, size = local_chunks[sha]
+                try:
+                    with open(filepath, 'rb') as f:
+                        f.seek(offset)
+                        data = f.read(size)
+                except OSError:
+                    data = None
+                if data is not None and sha256(data) == sha:
+                    with lock:
+                        stats['reused_chunks'] += 1
+                else:
+                    data = None
+            if data is None:
+                data = self._retry(self._read_chunk, sha)
+                with lock:
+                    stats['downloaded_chunks'] += 1
+                    stats['downloaded_bytes'] += len(data)
+            tmp_path = '{}.tmp'.format(staged)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, staged)
+
+        needed = list({chunk['sha256'] for entry in pending.values() for chunk in entry['chunks']})
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(fetch_chunk, needed))
+
+        for rel_path, entry in pending.items():
+            filepath = os.path.join(local_path, rel_path)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            tmp_path = '{}.tmp'.format(filepath)
+            file_sha = hashlib.sha256()
+            with open(tmp_path, 'wb') as f:
+                for chunk in entry['chunks']:
+                    with open(os.path.join(staging_path, chunk['sha256']), 'rb') as chunk_f:
+                        data = chunk_f.read()
+                    file_sha.update(data)
+                    f.write(data)
+            if file_sha.hexdigest() != entry['sha256']:
+                os.remove(tmp_path)
+                raise ValueError('Checksum mismatch of downloaded file {!r}'.format(rel_path))
+            os.replace(tmp_path, filepath)
+            state[rel_path] = dict(entry, mtime=os.stat(filepath).st_mtime_ns, chunkSize=chunk_size)
+        self._write_state(local_path, {rel_path: state[rel_path] for rel_path in manifest['files']})
+        shutil.rmtree(staging_path, ignore_errors=True)
+
+        stats['elapsed_s'] = time.perf_counter() - tic
+        logger.info("Downloaded {c} chunks ({b:.1f}MB) in {e:.1f}s, reused {r} local chunks, {u}/{f} files unchanged".
+                    format(c=stats['downloaded_chunks'], b=stats['downloaded_bytes'] / 1024 ** 2,
+                           e=stats['elapsed_s'], r=stats['reused_chunks'] + stats['resumed_chunks'],
+                           u=stats['unchanged_files'], f=stats['files']))
+        return stats
+
+    def _read_chunk(self, sha):
+        data = self.store.read('{}/{}'.format(CHUNKS_DIRNAME, sha))
+        if data is None or sha256(data) != sha:
+            raise ValueError('Missing or corrupted chunk {!r}'.format(sha))
+        return data
+
+
+def get_transfer(snapshot):
+    """
+        The chunked transfer of the snapshot's bucket, None if the bucket does not support it
+    """
+    bucket = getattr(snapshot, 'bucket', None)
+    if bucket is None or not ItemBucketStore.supports(bucket):
+        return None
+    return SnapshotTransfer(store=ItemBucketStore(bucket))
+
+
+def save_to_snapshot(adapter, local_path, chunked=True):
+    """
+        `adapter.save_to_snapshot` through the chunked transfer.
+        Falls back to the adapter's own upload if disabled or if the snapshot's bucket does not support it, the
+        chunked artifacts of a previous save are then discarded
+    """
+    from handlers.entities import entities
+    snapshot = adapter.snapshot
+    transfer = get_transfer(snapshot)
+    if transfer is None or not chunked:
+        result = adapter.save_to_snapshot(local_path=local_path, replace=True)
+        if transfer is not None and transfer.discard():
+            snapshot.metadata.get('system', dict()).pop(METADATA_KEY, None)
+            entities.update(snapshot)
+        return result
+    adapter.save(local_path=local_path)
+    stats = transfer.upload(local_path=local_path)
+    snapshot.metadata.setdefault('system', dict())[METADATA_KEY] = {'layout': 'chunked', 'path': transfer.store.root}
+    entities.update(snapshot)
+    return stats
+
+
+def download_artifacts(snapshot, local_path, staging_path=None, reuse_paths=None):
+    """
+        The reader of the chunked layout, for any consumer of the snapshot's files: download them into `local_path`.
+        See `SnapshotTransfer.download` for the arguments
+
+    Returns:
+        dict: transfer stats, None if the snapshot was not saved with the chunked layout (its files are in the
+              bucket, as saved by the adapter)
+    """
+    transfer = get_transfer(snapshot)
+    if transfer is None:
+        return None
+    return transfer.download(local_path=local_path, staging_path=staging_path, reuse_paths=reuse_paths)
+
+
+def load_from_snapshot(adapter, snapshot, local_path, staging_path=None, reuse_paths=None):
+    """
+        `adapter.load_from_snapshot` through the chunked transfer.
+        Falls back to the adapter's own download for snapshots without the chunked layout
+    """
+    stats = download_artifacts(snapshot=snapshot,
+                               local_path=local_path,
+                               staging_path=staging_path,
+                               reuse_paths=reuse_paths)
+    if stats is None:
+        return adapter.load_from_snapshot(snapshot=snapshot, local_path=local_path)
+    adapter.snapshot = snapshot
+    adapter.load(local_path=local_path)
+    return stats
+
+
+def clone_artifacts(from_snapshot, snapshot):
+    """
+        Copy the chunked artifacts of `from_snapshot` to the sidecar of its clone `snapshot` (on the platform, the
+        binaries are not transferred) and mark the clone's metadata accordingly. Does not update the snapshot
+
+    Returns:
+        bool: True if the clone's metadata changed
+    """
+    source = get_transfer(from_snapshot)
+    target = get_transfer(snapshot)
+    manifest = source.remote_manifest() if source is not None and target is not None else None
+    if manifest is None:
+        # the clone's metadata is copied from the source's
+        return snapshot.metadata.get('system', dict()).pop(METADATA_KEY, None) is not None
+    shas = {chunk['sha256'] for entry in manifest['files'].values() for chunk in entry['chunks']}
+    source.store.copy_chunks(shas=shas, store=target.store)
+    target.store.write(MANIFEST_FILENAME, json.dumps(manifest).encode())
+    snapshot.metadata.setdefault('system', dict())[METADATA_KEY] = {'layout': 'chunked', 'path': target.store.root}
+    return True
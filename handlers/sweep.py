@@ -0,0 +1,142 @@
+import math
+import random
+import logging
+import itertools
+import threading
+
+logger = logging.getLogger(name=__name__)
+
+
+class TrialPruned(Exception):
+    """
+    Raised from the epoch callback to stop a trial that fell behind the others
+    """
+
+
+def expand_search_space(search_space, search='grid', n_trials=None, seed=None):
+    """
+        The configurations of the sweep's trials
+
+    Args:
+        search_space (dict): configuration key -> list of values (grid and random search), or for random search
+                             a range: {'min': , 'max': , 'log': bool, 'type': 'int'/'float'}
+        search (str, optional): 'grid' - every combination, 'random' - `n_trials` samples. Defaults to 'grid'.
+        n_trials (int, optional): number of trials. Defaults to None ==> whole grid / 10 random samples.
+        seed (int, optional): random seed. Defaults to None.
+
+    Returns:
+        list: list of configuration updates, one per trial
+    """
+    if not search_space:
+        raise ValueError('Empty search space')
+    keys = sorted(search_space)
+    rng = random.Random(seed)
+    if search == 'grid':
+        for key in keys:
+            if not isinstance(search_space[key], (list, tuple)):
+                raise ValueError('Grid search needs a list of values for {!r}'.format(key))
+        trials = [dict(zip(keys, values)) for values in itertools.product(*[search_space[key] for key in keys])]
+        if n_trials is not None and n_trials < len(trials):
+            trials = rng.sample(trials, n_trials)
+        return trials
+    if search == 'random':
+        return [{key: _sample(search_space[key], rng=rng) for key in keys}
+                for _ in range(n_trials if n_trials is not None else 10)]
+    raise ValueError('Unknown search {!r}, expected "grid" or "random"'.format(search))
+
+
+def _sample(space, rng):
+    if isinstance(space, (list, tuple)):
+        return rng.choice(space)
+    low, high = space['min'], space['max']
+    if space.get('log', False):
+        value = math.exp(rng.uniform(math.log(low), math.log(high)))
+    else:
+        value = rng.uniform(low, high)
+    if space.get('type', 'float') == 'int':
+        return int(round(value))
+    return value
+
+
+class MedianStopper:
+    """
+    Median stopping rule: after `grace_epochs`, a trial whose best metric so far is worse than the median
+    of the other trials' best at the same epoch is stopped.
+    Trials report concurrently, so a trial is compared only with the trials that already reached its epoch
+    """
+
+    def __init__(self, metric, mode='min', grace_epochs=1, min_trials=2):
+        if mode not in ('min', 'max'):
+            raise ValueError('Unknown mode {!r}, expected "min" or "max"'.format(mode))
+        self.metric = metric
+        self.mode = mode
+        self.grace_epochs = grace_epochs
+        self.min_trials = min_trials
+        # trial -> list of best value so far, per epoch
+        self._best = dict()
+        self._lock = threading.Lock()
+
+    def better(self, a, b):
+        return a < b if self.mode == 'min' else a > b
+
+    def report(self, trial_id, epoch, metrics):
+        """
+            Record the trial's epoch metrics
+
+        Returns:
+            bool: True if the trial should stop
+        """
+        if not metrics or self.metric not in metrics:
+            return False
+        value = float(metrics[self.metric])
+        with self._lock:
+            history = self._best.setdefault(trial_id, list())
+            # epochs of a resumed trial start after its checkpoint
+            while len(history) < epoch:
+                history.append(history[-1] if history else value)
+            best = value if not history or self.better(value, history[-1]) else history[-1]
+            history.append(best)
+            if epoch + 1 < self.grace_epochs:
+                return False
+            others = sorted(values[epoch] for other_id, values in self._best.items()
+                            if other_id != trial_id and len(values) > epoch)
+        if len(others) < self.min_trials:
+            return False
+        middle = len(others) // 2
+        median = others[middle] if len(others) % 2 else (others[middle - 1] + others[middle]) / 2
+        return self.better(median, best)
+
+
+def rank_trials(trials, mode='min'):
+    """
+        Completed trials first, ordered by their final metric, then the pruned ones by their last metric,
+        then the failed ones
+    """
+    status_order = {'completed': 0, 'pruned': 1}
+
+    def sort_key(trial):
+        metric = trial.get('metric')
+        if metric is None:
+            metric_key = math.inf
+        else:
+            metric_key = metric if mode == 'min' else -metric
+        return status_order.get(trial['status'], 2), metric_key
+
+    ranked = sorted(trials, key=sort_key)
+    for rank, trial in enumerate(ranked):
+        trial['rank'] = rank + 1
+    return ranked
+
+
+def format_table(ranked, metric):
+    row = '{:<5} {:<32} {:<10} {:>12} {:>7}  {}'
+    lines = [row.format('rank', 'snapshot', 'status', metric, 'epochs', 'configuration')]
+    for trial in ranked:
+        value = trial.get('metric')
+        lines.append(row.format(trial['rank'],
+                                str(trial['snapshot_name'])[-32:],
+                                trial['status'],
+                                '-' if value is None else '{:.5g}'.format(value),
+                                trial.get('epochs', 0),
+                                trial['configuration']))
+    return '\n'.join(lines)
@@ -0,0 +1,117 @@
+import time
+import queue
+import atexit
+import logging
+import threading
+from concurrent.futures import Future, wait
+
+logger = logging.getLogger(name=__name__)
+
+
+class AnnotationUploader:
+    """
+    Background upload of predicted annotations.
+    Every upload request is dispatched to the next free worker, so the workers upload concurrently. Predictions
+    of the same item queued before a worker picks it up are merged into its upload request, and failed uploads
+    are retried with an exponential backoff
+    """
+
+    def __init__(self, workers=2, max_bulk_size=32, max_retries=3, backoff_s=0.5):
+        """
+        Args:
+            workers (int, optional): number of upload threads. Defaults to 2.
+            max_bulk_size (int, optional): max number of requests of an item merged in one upload. Defaults to 32.
+            max_retries (int, optional): retries of a failed upload. Defaults to 3.
+            backoff_s (float, optional): wait before the first retry, doubled on every retry. Defaults to 0.5.
+        """
+        self.max_bulk_size = max(int(max_bulk_size), 1)
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+        self._queue = queue.Queue()
+        self._pending = set()
+        # item id -> the queued upload (item, annotations, futures) not yet picked up by a worker
+        self._open = dict()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._workers = [threading.Thread(target=self._run, name='annotation-uploader-{}'.format(i), daemon=True)
+                         for i in range(max(int(workers), 1))]
+        for worker in self._workers:
+            worker.start()
+        atexit.register(self.close)
+
+    def submit(self, item, annotations) -> Future:
+        """
+            Queue the annotations upload of an item
+
+        Returns:
+            Future: resolved once the annotations are uploaded, or with the last upload error
+        """
+        if self._closed:
+            raise RuntimeError('AnnotationUploader is closed')
+        future = Future()
+        with self._lock:
+            self._pending.add(future)
+            upload = self._open.get(item.id)
+            if upload is None or len(upload[2]) >= self.max_bulk_size:
+                upload = (item, list(), list())
+                self._open[item.id] = upload
+                self._queue.put(upload)
+            upload[1].extend(annotations)
+            upload[2].append(future)
+        future.add_done_callback(self._discard)
+        return future
+
+    def _discard(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def flush(self, timeout=None):
+        """
+            Block until every upload submitted so far is done
+        """
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending, timeout=timeout)
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _run(self):
+        while True:
+            upload = self._queue.get()
+            if upload is None:
+                return
+            item, annotations, futures = upload
+            with self._lock:
+                # no more requests are merged into it
+                if self._open.get(item.id) is upload:
+                    self._open.pop(item.id)
+            try:
+                self._upload(item=item, annotations=annotations)
+            except Exception as err:
+                for future in futures:
+                    future.set_exception(err)
+            else:
+                for future in futures:
+                    future.set_result(item.id)
+
+    def _upload(self, item, annotations):
+        for i_try in range(self.max_retries + 1):
+            try:
+                return item.annotations.upload(annotations)
+            except Exception:
+                if i_try == self.max_retries:
+                    logger.exception("Failed uploading {n} annotations to item {i!r}".
+                                     format(n=len(annotations), i=item.id))
+                    raise
+                backoff = self.backoff_s * 2 ** i_try
+                logger.warning("Annotations upload to item {i!r} failed, retrying in {b:.1f}s".
+                               format(i=item.id, b=backoff))
+                time.sleep(backoff)
@@ -0,0 +1,181 @@
+import json
+import queue
+import logging
+import threading
+import subprocess
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(name=__name__)
+
+DEFAULT_LOOKAHEAD = 32
+# dHash of (DHASH_SIZE + 1) x DHASH_SIZE grayscale pixels, 64 bits
+DHASH_SIZE = 8
+FFMPEG = 'ffmpeg'
+FFPROBE = 'ffprobe'
+
+
+def dhash(frame, hash_size=DHASH_SIZE):
+    """
+        Difference hash of a frame: the signs of the horizontal gradients of a tiny grayscale thumbnail.
+        Near identical frames have hashes a few bits apart
+    """
+    thumbnail = Image.fromarray(frame).convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    return int.from_bytes(np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes(), 'big')
+
+
+def hamming(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+
+def _fraction(value):
+    if value is None:
+        return None
+    if isinstance(value, str) and '/' in value:
+        numerator, denominator = value.split('/')
+        return float(numerator) / float(denominator) if float(denominator) else None
+    return float(value)
+
+
+def probe(source, headers=None, ffprobe=FFPROBE):
+    """
+        Width, height, fps and number of frames (None if unknown) of the first video stream.
+        Reads only the container headers
+    """
+    cmd = [ffprobe, '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'stream=width,height,avg_frame_rate,r_frame_rate,nb_frames', '-of', 'json']
+    if headers:
+        cmd += ['-headers', ''.join('{}: {}\r\n'.format(key, value) for key, value in headers.items())]
+    cmd.append(source)
+    stream = json.loads(subprocess.run(cmd, check=True, capture_output=True).stdout)['streams'][0]
+    nb_frames = stream.get('nb_frames')
+    return {'width': int(stream['width']),
+            'height': int(stream['height']),
+            'fps': _fraction(stream.get('avg_frame_rate')) or _fraction(stream.get('r_frame_rate')),
+            'frames': int(nb_frames) if nb_frames not in (None, 'N/A') else None}
+
+
+def item_video_info(item, source, headers=None):
+    """
+        The video info from the item's metadata when the platform computed it, else from the stream's headers
+    """
+    system = item.metadata.get('system', dict())
+    if system.get('width') and system.get('height') and system.get('fps'):
+        frames = system.get('nb_frames') or system.get('frames')
+        return {'width': int(system['width']),
+                'height': int(system['height']),
+                'fps': _fraction(system['fps']),
+                'frames': int(frames) if frames else None}
+    return probe(source=source, headers=headers)
+
+
+class FrameStream:
+    """
+    Decodes the sampled frames of a video with ffmpeg, straight from its url: nothing is written to disk and at
+    most `lookahead` decoded frames are held, whatever the video length.
+    Iterating yields (frame index in the source video, HxWx3 uint8 array)
+    """
+
+    def __init__(self, source, width, height, stride=1, fps=None, source_fps=None, lookahead=DEFAULT_LOOKAHEAD,
+                 headers=None, ffmpeg=FFMPEG):
+        """
+        Args:
+            source (str): url or path of the video
+            width (int): frames width
+            height (int): frames height
+            stride (int, optional): keep one frame out of `stride`. Defaults to 1.
+            fps (float, optional): sample at this rate instead of a stride. Defaults to None.
+            source_fps (float, optional): the video's frame rate, to index the frames sampled by `fps`.
+            lookahead (int, optional): max number of decoded frames waiting for the consumer. Defaults to 32.
+            headers (dict, optional): http headers of the request. Defaults to None.
+        """
+        if fps is not None and not source_fps:
+            raise ValueError('Sampling by fps needs the video frame rate')
+        self.width = int(width)
+        self.height = int(height)
+        self.stride = max(int(stride or 1), 1)
+        self.fps = fps
+        self.source_fps = source_fps
+        self.frame_bytes = self.width * self.height * 3
+        cmd = [ffmpeg, '-nostdin', '-loglevel', 'error']
+        if headers:
+            cmd += ['-headers', ''.join('{}: {}\r\n'.format(key, value) for key, value in headers.items())]
+        cmd += ['-i', source]
+        if fps is not None:
+            cmd += ['-vf', 'fps={}'.format(fps)]
+        elif self.stride > 1:
+            # decoded, but not converted nor piped
+            cmd += ['-vf', 'select=not(mod(n\\,{}))'.format(self.stride), '-vsync', '0']
+        cmd += ['-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1']
+        self._cmd = cmd
+        self._frames = queue.Queue(maxsize=max(int(lookahead), 1))
+        self._closed = threading.Event()
+        self._process = None
+        self._reader = None
+        self.error = None
+
+    def frame_index(self, i_sample):
+        if self.fps is not None:
+            return int(round(i_sample * self.source_fps / self.fps))
+        return i_sample * self.stride
+
+    def _read(self):
+        try:
+            i_sample = 0
+            while not self._closed.is_set():
+                buffer = bytearray(self.frame_bytes)
+                view = memoryview(buffer)
+                n_read = 0
+                while n_read < self.frame_bytes:
+                    n = self._process.stdout.readinto(view[n_read:])
+                    if not n:
+                        break
+                    n_read += n
+                if n_read < self.frame_bytes:
+                    if n_read > 0:
+                        logger.warning("Dropping a truncated last frame ({} bytes)".format(n_read))
+                    break
+                frame = np.frombuffer(buffer, dtype=np.uint8).reshape(self.height, self.width, 3)
+                self._put((self.frame_index(i_sample), frame))
+                i_sample += 1
+            if self._process.wait() != 0 and not self._closed.is_set():
+                self.error = RuntimeError('ffmpeg failed: {}'.format(
+                    self._process.stderr.read().decode(errors='replace')))
+        except Exception as err:
+            self.error = err
+        finally:
+            self._put(None)
+
+    def _put(self, entry):
+        while not self._closed.is_set():
+            try:
+                self._frames.put(entry, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        self._process = subprocess.Popen(self._cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                         bufsize=self.frame_bytes)
+        self._reader = threading.Thread(target=self._read, name='frame-stream', daemon=True)
+        self._reader.start()
+        try:
+            while True:
+                entry = self._frames.get()
+                if entry is None:
+                    break
+                yield entry
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
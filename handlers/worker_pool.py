@@ -0,0 +1,396 @@
+import os
+import atexit
+import time
+import logging
+import threading
+import itertools
+import multiprocessing
+from multiprocessing import connection, resource_tracker, shared_memory
+from concurrent.futures import Future
+
+import numpy as np
+
+logger = logging.getLogger(name=__name__)
+
+DEFAULT_START_METHOD = os.environ.get('MODEL_MGMT_WORKER_START_METHOD', 'spawn')
+DISPATCH_MODES = ('least_loaded', 'round_robin')
+
+
+def _pack(arrays):
+    """
+        Copy the arrays into a single new shared memory block
+
+    Returns:
+        (SharedMemory, list of (shape, dtype, offset))
+    """
+    layout = list()
+    offset = 0
+    for array in arrays:
+        array = np.asarray(array)
+        layout.append((array.shape, array.dtype.str, offset))
+        offset += array.nbytes
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for array, (shape, dtype, offset) in zip(arrays, layout):
+        np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)[...] = array
+    return block, layout
+
+
+def _unpack(block, layout):
+    return [np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset) for shape, dtype, offset in layout]
+
+
+def _attach(name):
+    """
+        Attach to the parent's block. The parent owns (and unlinks) it
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13 registers the block again with the (shared) resource tracker, a no-op
+        return shared_memory.SharedMemory(name=name)
+
+
+def load_adapter(model_id, snapshot_id=None, load_mode='default', intra_op_threads=None):
+    """
+        Default adapter loader of the workers: the snapshot's artifacts are already in the host's disk cache,
+        loaded there by the parent runner
+    """
+    from handlers.adapter_cache import adapter_cache
+    from handlers.entities import entities
+    adapter_cache.configure(load_mode=load_mode, intra_op_threads=intra_op_threads)
+    snapshot = entities.snapshot(snapshot_id=snapshot_id) if snapshot_id is not None else None
+    adapter = adapter_cache.restore(snapshot=snapshot) if snapshot is not None else None
+    if adapter is None:
+        adapter = adapter_cache.load(model=entities.model(model_id=model_id), snapshot=snapshot)
+    return adapter
+
+
+def _worker_main(worker_id, loader, loader_kwargs, requests, responses, warmup_input):
+    from handlers.prediction_cache import serialize
+    try:
+        adapter = loader(**loader_kwargs)
+        if warmup_input is not None:
+            adapter.predict([warmup_input])
+    except Exception as err:
+        try:
+            responses.send(('failed', worker_id, None, err, 0))
+        except Exception:
+            # not picklable
+            responses.send(('failed', worker_id, None, RuntimeError(repr(err)), 0))
+        return
+    responses.send(('ready', worker_id, None, os.getpid(), 0))
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, block_name, layout = request
+        tic = time.perf_counter()
+        block = _attach(block_name)
+        try:
+            arrays = _unpack(block, layout)
+            predictions = [serialize(prediction) for prediction in adapter.predict(arrays)]
+            del arrays
+            response = ('result', worker_id, request_id, predictions, time.perf_counter() - tic)
+        except Exception as err:
+            response = ('error', worker_id, request_id, repr(err), time.perf_counter() - tic)
+        finally:
+            block.close()
+        responses.send(response)
+
+
+class _Worker:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.process = None
+        self.requests = None
+        self.responses = None
+        self.pid = None
+        self.ready = threading.Event()
+        self.in_flight = set()
+        self.requests_count = 0
+        self.items_count = 0
+        self.busy_s = 0.0
+        self.restarts = 0
+        # loads that ended without the worker being ready, since its last successful load
+        self.load_failures = 0
+        self.load_error = None
+        self.started_at = time.monotonic()
+
+
+class PredictWorkerPool:
+    """
+    K worker processes, each with its own adapter, to use all the cores of a replica.
+    The parent process keeps its own adapter too (other snapshots, non image items, the warm-up input), so the
+    replica holds K + 1 copies of the weights in memory - unless they are mapped (the 'mmap' load mode), when all
+    the processes share the same page cache pages.
+    The decoded arrays are passed through shared memory, only their layout is pickled, and a batch is split
+    across the workers. A worker that dies is restarted, and its in-flight requests are sent again (once).
+    A worker that fails loading `max_load_attempts` times in a row fails the pool, with the loader's exception
+    """
+
+    def __init__(self, workers, loader_kwargs, loader=load_adapter, dispatch='least_loaded', warmup_input=None,
+                 start_method=None, ready_timeout_s=600, max_attempts=2, max_load_attempts=3):
+        """
+        Args:
+            workers (int): number of worker processes
+            loader_kwargs (dict): arguments of the loader, e.g. model_id, snapshot_id, load_mode
+            loader (callable, optional): module level function that returns a loaded adapter in the worker.
+                                         Defaults to load_adapter.
+            dispatch (str, optional): 'least_loaded' or 'round_robin'. Defaults to 'least_loaded'.
+            warmup_input (optional): synthetic input each worker predicts before it is ready. Defaults to None.
+            start_method (str, optional): multiprocessing start method. Defaults to None ==> 'spawn' (the runner's
+                                          threads make forking unsafe), or MODEL_MGMT_WORKER_START_METHOD.
+            ready_timeout_s (float, optional): max time to wait for the workers to load. Defaults to 600.
+            max_attempts (int, optional): tries of a request whose worker died. Defaults to 2.
+            max_load_attempts (int, optional): consecutive failed loads of a worker before the pool fails.
+                                               Defaults to 3.
+        """
+        if dispatch not in DISPATCH_MODES:
+            raise ValueError('Unknown dispatch {!r}, expected one of {}'.format(dispatch, DISPATCH_MODES))
+        self.dispatch = dispatch
+        self.loader = loader
+        self.loader_kwargs = loader_kwargs
+        self.warmup_input = warmup_input
+        self.ready_timeout_s = ready_timeout_s
+        self.max_attempts = max_attempts
+        self.max_load_attempts = max(int(max_load_attempts), 1)
+        self._context = multiprocessing.get_context(start_method or DEFAULT_START_METHOD)
+        self._workers = [_Worker(worker_id=i) for i in range(int(workers))]
+        # request id -> [worker, block, layout, future, attempts]
+        self._requests = dict()
+        self._ids = itertools.count()
+        self._round_robin = itertools.cycle(range(len(self._workers)))
+        self._lock = threading.Lock()
+        self._closed = False
+        # set when a worker could not be loaded, the pool is failed
+        self._error = None
+        self.started_at = time.monotonic()
+
+        # started before the workers so they share it, otherwise every worker starts its own tracker which
+        # unlinks the blocks the worker attached to when it exits
+        resource_tracker.ensure_running()
+        for worker in self._workers:
+            self._start(worker)
+        self._collector = threading.Thread(target=self._collect, name='predict-pool-collector', daemon=True)
+        self._collector.start()
+        self._monitor = threading.Thread(target=self._watch, name='predict-pool-monitor', daemon=True)
+        self._monitor.start()
+        atexit.register(self.close)
+        try:
+            self.wait_ready()
+        except Exception:
+            self.close()
+            raise
+
+    def _start(self, worker):
+        worker.ready.clear()
+        worker.requests = self._context.Queue()
+        # a pipe per worker: a worker killed while writing breaks only its own pipe
+        reader, writer = self._context.Pipe(duplex=False)
+        worker.process = self._context.Process(target=_worker_main,
+                                               args=(worker.worker_id, self.loader, self.loader_kwargs,
+                                                     worker.requests, writer, self.warmup_input),
+                                               name='predict-worker-{}'.format(worker.worker_id),
+                                               daemon=True)
+        worker.process.start()
+        writer.close()
+        worker.responses = reader
+        with self._lock:
+            # the stats are of the current process of the worker
+            worker.pid = worker.process.pid
+            worker.requests_count = 0
+            worker.items_count = 0
+            worker.busy_s = 0.0
+            worker.started_at = time.monotonic()
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError(str(self._error)) from self._error.__cause__
+
+    def wait_ready(self):
+        deadline = time.monotonic() + self.ready_timeout_s
+        for worker in self._workers:
+            while not worker.ready.wait(timeout=min(max(deadline - time.monotonic(), 0), 0.5)):
+                self._raise_if_failed()
+                if time.monotonic() >= deadline:
+                    raise TimeoutError('Predict worker {} did not load in {}s'.format(worker.worker_id,
+                                                                                      self.ready_timeout_s))
+        logger.info("Predict worker pool ready: {} workers".format(len(self._workers)))
+
+    def _pick(self):
+        with self._lock:
+            ready = [worker for worker in self._workers if worker.ready.is_set()] or self._workers
+            if self.dispatch == 'round_robin':
+                while True:
+                    worker = self._workers[next(self._round_robin)]
+                    if worker in ready:
+                        return worker
+            return min(ready, key=lambda w: len(w.in_flight))
+
+    def submit(self, arrays):
+        """
+            Predict a batch of arrays in one worker
+
+        Returns:
+            Future: list of serialized predictions
+        """
+        self._raise_if_failed()
+        if self._closed:
+            raise RuntimeError('Worker pool is closed')
+        block, layout = _pack(arrays)
+        future = Future()
+        request_id = next(self._ids)
+        worker = self._pick()
+        with self._lock:
+            self._requests[request_id] = [worker, block, layout, future, 1]
+            worker.in_flight.add(request_id)
+        worker.requests.put((request_id, block.name, layout))
+        return future
+
+    def predict(self, arrays):
+        """
+            Predict the arrays, split in contiguous sub batches across the workers
+
+        Returns:
+            list: serialized predictions, in the arrays order
+        """
+        n_splits = min(len(self._workers), len(arrays))
+        bounds = np.linspace(0, len(arrays), n_splits + 1).astype(int)
+        futures = [self.submit(arrays[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+        return [prediction for future in futures for prediction in future.result()]
+
+    def _finish(self, request_id, result=None, error=None):
+        with self._lock:
+            request = self._requests.pop(request_id, None)
+            if request is None:
+                return
+            worker, block, layout, future, _ = request
+            worker.in_flight.discard(request_id)
+        block.close()
+        block.unlink()
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _collect(self):
+        while not self._closed:
+            readers = {worker.responses: worker for worker in self._workers if worker.responses is not None}
+            # the timeout picks up the pipes of restarted workers
+            for reader in connection.wait(list(readers), timeout=0.5):
+                worker = readers[reader]
+                try:
+                    kind, worker_id, request_id, payload, busy_s = reader.recv()
+                except (EOFError, OSError):
+                    # the worker exited, restarted by the monitor
+                    if worker.responses is reader:
+                        worker.responses = None
+                    continue
+                self._handle(worker, kind, request_id, payload, busy_s)
+
+    def _handle(self, worker, kind, request_id, payload, busy_s):
+        if kind == 'ready':
+            worker.pid = payload
+            worker.load_failures = 0
+            worker.load_error = None
+            worker.ready.set()
+        elif kind == 'failed':
+            logger.error("Predict worker {} failed loading: {!r}".format(worker.worker_id, payload))
+            worker.load_error = payload
+        else:
+            with self._lock:
+                worker.requests_count += 1
+                worker.busy_s += busy_s
+                if request_id in self._requests:
+                    worker.items_count += len(self._requests[request_id][2])
+            if kind == 'result':
+                self._finish(request_id, result=payload)
+            else:
+                self._finish(request_id, error=RuntimeError('Prediction failed in worker {}: {}'.
+                                                            format(worker.worker_id, payload)))
+
+    def _watch(self):
+        while not self._closed:
+            time.sleep(0.5)
+            for worker in self._workers:
+                if self._closed or self._error is not None or worker.process.is_alive():
+                    continue
+                if not worker.ready.is_set():
+                    worker.load_failures += 1
+                    if worker.load_failures >= self.max_load_attempts:
+                        self._fail(worker)
+                        break
+                logger.warning("Predict worker {w} (pid {p}) exited with code {c}, restarting".
+                               format(w=worker.worker_id, p=worker.pid, c=worker.process.exitcode))
+                with self._lock:
+                    orphans = list(worker.in_flight)
+                    worker.in_flight.clear()
+                    worker.restarts += 1
+                self._start(worker)
+                for request_id in orphans:
+                    self._retry(request_id)
+
+    def _fail(self, worker):
+        """
+            Fail the pool and its requests: the worker's load keeps failing, restarting it again would not help
+        """
+        cause = worker.load_error
+        if cause is None:
+            cause = RuntimeError('worker exited with code {}'.format(worker.process.exitcode))
+        error = RuntimeError('Predict worker {} failed loading {} times in a row: {!r}'.format(
+            worker.worker_id, worker.load_failures, cause))
+        error.__cause__ = cause
+        self._error = error
+        logger.error(str(error))
+        for request_id in list(self._requests):
+            self._finish(request_id, error=self._error)
+
+    def _retry(self, request_id):
+        with self._lock:
+            request = self._requests.get(request_id)
+            if request is None:
+                return
+            if request[4] >= self.max_attempts:
+                retry = False
+            else:
+                retry = True
+                request[4] += 1
+        if not retry:
+            self._finish(request_id, error=RuntimeError('Predict worker died {} times running the request'.
+                                                        format(self.max_attempts)))
+            return
+        worker = self._pick()
+        with self._lock:
+            request[0] = worker
+            worker.in_flight.add(request_id)
+        worker.requests.put((request_id, request[1].name, request[2]))
+
+    def stats(self):
+        """
+            Per worker: pid, requests, items, busy seconds, utilization (busy / alive time), in flight, restarts.
+            All but the restarts are of the worker's current process, reset when it is restarted
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [{'worker': worker.worker_id,
+                     'pid': worker.pid,
+                     'requests': worker.requests_count,
+                     'items': worker.items_count,
+                     'busy_s': worker.busy_s,
+                     'utilization': worker.busy_s / max(now - worker.started_at, 1e-9),
+                     'in_flight': len(worker.in_flight),
+                     'restarts': worker.restarts}
+                    for worker in self._workers]
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for worker in self._workers:
+            worker.requests.put(None)
+        for worker in self._workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        for request_id in list(self._requests):
+            self._finish(request_id, error=RuntimeError('Worker pool closed'))
@@ -1,6 +1,29 @@
+import os
+import re
 import json
+import hashlib
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import dtlpy as dl
 
+logger = logging.getLogger(name=__name__)
+
+# a whole string `$param` or `${param}` is replaced by the value (of any json type),
+# `${param}` inside a larger string by the value as a string
+WHOLE_PARAM = re.compile(r'^\$(\w+)$|^\$\{(\w+)\}$')
+INNER_PARAM = re.compile(r'\$\{(\w+)\}')
+# mark the substitutions in the serialized template: a whole value replaces its quotes too
+WHOLE_SLOT = '@@whole:{}@@'
+INNER_SLOT = '@@inner:{}@@'
+SLOT_PATTERN = re.compile(r'"@@whole:(\d+)@@"|@@inner:(\d+)@@')
+RESERVED = ('@@whole:', '@@inner:')
+DEFAULT_TEMPLATE = 'template_pipelines.json'
+DEFAULT_STATE_FILE = '.pipelines_deploy_state.json'
+DEFAULT_DEPLOY_WORKERS = 8
+
 
 def replace(to_replace, replace_values):
     if isinstance(to_replace, dict):
@@ -18,23 +41,302 @@ def replace(to_replace, replace_values):
     return to_replace
 
 
+class TemplateCompiler:
+    """
+    A pipeline template parsed once: the paths of its substitutions are found by a single walk, and the template
+    is serialized once into literal json segments around them. Rendering a parameters set joins the segments with
+    the serialized values - no walk and no copy of the tree - into a canonical json, so equal pipelines have equal
+    hashes
+    """
+
+    def __init__(self, template):
+        """
+        Args:
+            template (dict): pipeline json with `$param` / `${param}` strings
+        """
+        # (path, param of a whole value or None, [literal / param, ...] of a string with inner params)
+        self.paths = list()
+        # (param, whole value or inside a string) by slot index
+        self._slots = list()
+        marked = self._compile(template, path=tuple())
+        serialized = json.dumps(marked, sort_keys=True, separators=(',', ':'))
+        self._segments = list()
+        self._slot_order = list()
+        position = 0
+        for match in SLOT_PATTERN.finditer(serialized):
+            self._segments.append(serialized[position:match.start()])
+            self._slot_order.append(int(match.group(1) or match.group(2)))
+            position = match.end()
+        self._segments.append(serialized[position:])
+        self.params = sorted({param for param, _ in self._slots})
+
+    def _slot(self, param, whole):
+        self._slots.append((param, whole))
+        return (WHOLE_SLOT if whole else INNER_SLOT).format(len(self._slots) - 1)
+
+    @staticmethod
+    def _check_reserved(text, path):
+        if any(marker in text for marker in RESERVED):
+            raise ValueError('Template string at {} contains a reserved marker {}'.format(list(path), RESERVED))
+
+    def _compile(self, node, path):
+        if isinstance(node, dict):
+            for key in node:
+                self._check_reserved(key, path=path + (key,))
+            return {key: self._compile(value, path + (key,)) for key, value in node.items()}
+        if isinstance(node, list):
+            return [self._compile(value, path + (i,)) for i, value in enumerate(node)]
+        if not isinstance(node, str):
+            return node
+        self._check_reserved(node, path=path)
+        match = WHOLE_PARAM.match(node)
+        if match:
+            param = match.group(1) or match.group(2)
+            self.paths.append((path, param, None))
+            return self._slot(param, whole=True)
+        parts = INNER_PARAM.split(node)
+        if len(parts) == 1:
+            return node
+        # odd indices are the params
+        self.paths.append((path, None, parts))
+        return ''.join(self._slot(part, whole=False) if i % 2 else part for i, part in enumerate(parts))
+
+    def missing(self, values):
+        return [param for param in self.params if param not in values]
+
+    def validate(self, values):
+        missing = self.missing(values)
+        if missing:
+            raise ValueError('missing {} in replace dict'.format(', '.join(missing)))
+
+    def render_json(self, values):
+        """
+            The canonical json text of the pipeline with `values`
+        """
+        self.validate(values)
+        rendered = list()
+        for segment, i_slot in zip(self._segments, self._slot_order):
+            param, whole = self._slots[i_slot]
+            rendered.append(segment)
+            if whole:
+                rendered.append(json.dumps(values[param], sort_keys=True, separators=(',', ':')))
+            else:
+                # escaped as the inside of a json string
+                rendered.append(json.dumps(str(values[param]))[1:-1])
+        rendered.append(self._segments[-1])
+        return ''.join(rendered)
+
+    def render(self, values):
+        """
+            A new pipeline json with `values`
+        """
+        return json.loads(self.render_json(values))
+
+    @staticmethod
+    def digest(rendered_json):
+        return hashlib.sha256(rendered_json.encode()).hexdigest()
+
+
+def load_template(template_path):
+    with open(template_path, 'r') as f:
+        return TemplateCompiler(json.load(f))
+
+
+def load_parameter_sets(params_path, default_template=DEFAULT_TEMPLATE):
+    """
+        The parameters sets of a bulk deploy: a json list of {'template': path, 'params': {...}}, or of params
+        dicts rendered with `default_template`. Templates paths are relative to the parameters file
+
+    Returns:
+        list: (template path, params)
+    """
+    with open(params_path, 'r') as f:
+        entries = json.load(f)
+    base = os.path.dirname(os.path.abspath(params_path))
+    parameter_sets = list()
+    for entry in entries:
+        if 'params' in entry:
+            template_path = os.path.join(base, entry.get('template', default_template))
+            parameter_sets.append((template_path, entry['params']))
+        else:
+            parameter_sets.append((os.path.join(base, default_template), entry))
+    return parameter_sets
+
+
+def render_all(parameter_sets):
+    """
+        Compile each template once and render all the parameters sets, failing before anything is deployed if a
+        set misses parameters or two sets render the same pipeline
+
+    Returns:
+        list: (pipeline key 'projectId/name', rendered json text)
+    """
+    compilers = dict()
+    errors = list()
+    rendered = list()
+    keys = dict()
+    for i_set, (template_path, values) in enumerate(parameter_sets):
+        if template_path not in compilers:
+            compilers[template_path] = load_template(template_path)
+        compiler = compilers[template_path]
+        missing = compiler.missing(values)
+        if missing:
+            errors.append('set #{}: missing {}'.format(i_set, ', '.join(missing)))
+            continue
+        rendered_json = compiler.render_json(values)
+        pipeline_json = json.loads(rendered_json)
+        key = '{}/{}'.format(pipeline_json.get('projectId'), pipeline_json.get('name'))
+        if key in keys:
+            errors.append('set #{}: same pipeline {!r} as set #{}'.format(i_set, key, keys[key]))
+            continue
+        keys[key] = i_set
+        rendered.append((key, rendered_json))
+    if errors:
+        raise ValueError('Invalid parameters sets:\n  {}'.format('\n  '.join(errors)))
+    return rendered
+
+
+def load_state(state_path):
+    if state_path is None or not os.path.isfile(state_path):
+        return dict()
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+
+def save_state(state_path, state):
+    tmp_path = '{}.tmp'.format(state_path)
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
+def deploy_pipeline(pipeline_json, pipeline_id=None, install=True, projects=None):
+    """
+        Create the pipeline, or update it in place when it exists
+
+    Returns:
+        (status 'created' / 'updated', pipeline)
+    """
+    if projects is None:
+        projects = dict()
+    project_id = pipeline_json['projectId']
+    if project_id not in projects:
+        projects[project_id] = dl.projects.get(project_id=project_id)
+    project = projects[project_id]
+    pipeline = None
+    try:
+        if pipeline_id is not None:
+            pipeline = project.pipelines.get(pipeline_id=pipeline_id)
+        else:
+            pipeline = project.pipelines.get(pipeline_name=pipeline_json['name'])
+    except dl.exceptions.NotFound:
+        logger.debug("Pipeline {!r} not found, creating it".format(pipeline_json['name']))
+    if pipeline is None:
+        status = 'created'
+        pipeline = project.pipelines.create(pipeline_json=pipeline_json)
+    else:
+        status = 'updated'
+        payload = pipeline.to_json()
+        payload.update(pipeline_json)
+        pipeline = project.pipelines.update(pipeline=dl.Pipeline.from_json(_json=payload,
+                                                                           client_api=dl.client_api,
+                                                                           project=project))
+    if install:
+        pipeline.install()
+    return status, pipeline
+
+
+def bulk_deploy(parameter_sets, workers=DEFAULT_DEPLOY_WORKERS, state_path=None, install=True, force=False):
+    """
+        Render and deploy many pipelines, `workers` at a time. A pipeline whose rendered json did not change
+        since its last deploy recorded in `state_path` is skipped, without calling the platform
+
+    Args:
+        parameter_sets (list): (template path, params), see load_parameter_sets
+        workers (int, optional): max number of concurrent deploys. Defaults to 8.
+        state_path (str, optional): json file of the deployed pipelines ids and hashes. Defaults to None.
+        install (bool, optional): install the created / updated pipelines. Defaults to True.
+        force (bool, optional): deploy the unchanged pipelines too. Defaults to False.
+
+    Returns:
+        dict: pipeline key -> 'created' / 'updated' / 'unchanged' / 'failed: <error>'
+    """
+    rendered = render_all(parameter_sets)
+    state = load_state(state_path)
+    lock = threading.Lock()
+    results = dict()
+    # the pipelines of a project share its entity
+    projects = dict()
+
+    def deploy(key, rendered_json):
+        digest = TemplateCompiler.digest(rendered_json)
+        previous = state.get(key, dict())
+        if not force and previous.get('hash') == digest:
+            return 'unchanged'
+        status, pipeline = deploy_pipeline(pipeline_json=json.loads(rendered_json),
+                                           pipeline_id=previous.get('pipelineId'),
+                                           install=install,
+                                           projects=projects)
+        with lock:
+            state[key] = {'pipelineId': pipeline.id, 'hash': digest}
+        return status
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(int(workers), 1)) as pool:
+            futures = {key: pool.submit(deploy, key, rendered_json) for key, rendered_json in rendered}
+            for key, future in futures.items():
+                try:
+                    results[key] = future.result()
+                except Exception as err:
+                    logger.exception("Failed deploying pipeline {!r}".format(key))
+                    results[key] = 'failed: {}'.format(err)
+    finally:
+        if state_path is not None:
+            save_state(state_path, state)
+    counts = dict()
+    for status in results.values():
+        counts[status.split(':')[0]] = counts.get(status.split(':')[0], 0) + 1
+    logger.info("Deployed {n} pipelines: {c}".format(n=len(results), c=counts))
+    return results
+
+
 def main():
-    dl.setenv('rc')
-    with open('template_pipelines.json', 'r') as f:
-        pipelines_json = json.load(f)
-
-    deploy_project = dl.projects.get('Model Management App')
-    package_project = dl.projects.get('Model Management App')
-    replace_values = {'projectId': deploy_project.id,
-                      'orgId': deploy_project.org['id'],
-                      'funcProjectName': package_project.name,
-                      'funcProjectId': package_project.id,
-                      'funcPackageName': 'model-mgmt-app',
-                      'funcModuleName': 'model-mgmt-app-train',
-                      'funcFunctionName': 'train_on_snapshot',
-                      'funcServiceName': 'model-mgmt-app-train',
-                      }
-
-    ready_pipeline = replace(pipelines_json, replace_values)
-    pipeline = deploy_project.pipelines.create(pipeline_json=ready_pipeline)
-    pipeline.install()
+    parser = argparse.ArgumentParser(description='Render and deploy pipelines from templates')
+    parser.add_argument('command', choices=['render', 'deploy'])
+    parser.add_argument('--params', required=True, help='json list of parameters sets')
+    parser.add_argument('--template', default=DEFAULT_TEMPLATE, help='template of the sets without one')
+    parser.add_argument('--output', help='render: directory for the rendered pipelines')
+    parser.add_argument('--env', default='rc')
+    parser.add_argument('--workers', type=int, default=DEFAULT_DEPLOY_WORKERS, help='concurrent deploys')
+    parser.add_argument('--state', default=DEFAULT_STATE_FILE, help='deployed pipelines hashes')
+    parser.add_argument('--no-install', action='store_true')
+    parser.add_argument('--force', action='store_true', help='deploy unchanged pipelines too')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    parameter_sets = load_parameter_sets(args.params, default_template=args.template)
+    if args.command == 'render':
+        rendered = render_all(parameter_sets)
+        for key, rendered_json in rendered:
+            if args.output is None:
+                print('{} {}'.format(TemplateCompiler.digest(rendered_json), key))
+                continue
+            os.makedirs(args.output, exist_ok=True)
+            with open(os.path.join(args.output, '{}.json'.format(key.replace('/', '_'))), 'w') as f:
+                json.dump(json.loads(rendered_json), f, indent=2)
+        return
+
+    dl.setenv(args.env)
+    results = bulk_deploy(parameter_sets=parameter_sets,
+                          workers=args.workers,
+                          state_path=args.state,
+                          install=not args.no_install,
+                          force=args.force)
+    for key, status in sorted(results.items()):
+        print('{}: {}'.format(key, status))
+    if any(status.startswith('failed') for status in results.values()):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()